@@ -0,0 +1,629 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Load test / benchmark for ulfire, no hardware needed.
+
+Starts ulfire.py on loopback with a number of fake LIFX bulbs, or the
+simulated fleet described by a fake_devices config file (--fleet). It
+times how long ulfire takes to answer its first SSDP search, finds the
+bridges and then drives, one scenario after another at the given
+concurrency:
+
+    lights  GET /api/<user>/lights on every bridge
+    light   GET /api/<user>/lights/<n> across all the lights
+    put     PUT /api/<user>/lights/<n>/state, alternating on and off
+    ssdp    M-SEARCH storm, waiting for every bridge to reply
+
+For each it reports throughput and p50/p99/p999 latency, along with the
+server's resident memory and CPU time. --memory-per-light <n> also
+compares the memory of ulfire with one and with n fake bulbs, both idle
+and after serving every light's JSON (the simulated bulbs live in the
+same process, so they are part of the figure). --color-conversions <n>
+times converting n colours between xy and hue/sat in one batch, in pure
+Python and with NumPy (when installed). --wemo-soap <n> sends n
+SetDeviceStatus calls to a simulated WeMo Link (its local SOAP
+stand-in, each new connection taking --wemo-connect-latency), once with
+a new connection per call as ouimeaux does and once over ulfire's
+connection pool. Results are written as JSON (--output) so runs can be
+compared between versions.
+
+--workers takes a list of worker process counts (ulfire --workers) and
+repeats the scenarios for each, to see how the Hue API scales:
+
+    python bench_ulfire.py --workers 0,1,2,4 --client-processes 4 --scenarios lights,light
+
+    python bench_ulfire.py --bulbs 200 --concurrency 8 --duration 10 --output bench.json
+    python bench_ulfire.py --fleet fleet.json --scenarios put
+    python bench_ulfire.py --memory-per-light 5000 --scenarios ""
+    python bench_ulfire.py --color-conversions 1000 --scenarios ""
+    python bench_ulfire.py --wemo-soap 500 --scenarios ""
+
+HTTP clients are threads in this process (or in --client-processes
+processes), so at high concurrency the client side can become the
+bottleneck; compare runs made with the same settings on the same machine.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fake_devices
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+USERNAME = 'bench'
+SSDP_ADDRESS = ('127.0.0.1', 1900)
+SEARCH_TARGET = 'urn:schemas-upnp-org:device:basic:1'
+SEARCH_TTL = 1.5  # a little over upnp_broadcast_responder.SEARCH_TTL
+SCENARIOS = ('lights', 'light', 'put', 'ssdp')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def search(timeout=1.0, expected=None, sock=None):
+    """One M-SEARCH, from a new socket unless one is given, returns
+    (latency of the first reply or None, [LOCATION of every reply]).
+    Stops waiting once expected replies arrived.
+    """
+    close = sock is None
+    if close:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout)
+    message = ('M-SEARCH * HTTP/1.1\r\n'
+               'HOST: 239.255.255.250:1900\r\n'
+               'MAN: "ssdp:discover"\r\n'
+               'MX: 0\r\n'
+               'ST: %s\r\n\r\n' % SEARCH_TARGET).encode('ascii')
+    started = time.time()
+    first = None
+    locations = []
+    sock.sendto(message, SSDP_ADDRESS)
+    try:
+        while True:
+            data, _sender = sock.recvfrom(4096)
+            if first is None:
+                first = time.time() - started
+            for line in data.decode('latin-1').split('\r\n'):
+                if line.upper().startswith('LOCATION:'):
+                    locations.append(line.split(':', 1)[1].strip())
+            if expected is not None and len(locations) >= expected:
+                break
+            sock.settimeout(0.2)  # collect the other bridges' replies
+    except socket.timeout:
+        pass
+    finally:
+        if close:
+            sock.close()
+    return first, locations
+
+
+class http_client(object):
+    """Minimal keep-alive HTTP/1.1 client"""
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.sock = None
+        self.buffer = b''
+
+    def request(self, method, path, body=b''):
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, timeout=10)
+            self.buffer = b''
+        message = ('%s %s HTTP/1.1\r\nHost: %s:%d\r\nContent-Length: %d\r\n\r\n'
+                   % (method, path, self.address[0], self.address[1], len(body))).encode('ascii') + body
+        try:
+            self.sock.sendall(message)
+            return self.read_response()
+        except (socket.error, ValueError):
+            self.close()
+            raise
+
+    def read_response(self):
+        while b'\r\n\r\n' not in self.buffer:
+            self.recv()
+        head, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        lines = head.decode('latin-1').split('\r\n')
+        status = int(lines[0].split()[1])
+        length = 0
+        keep_alive = True
+        for line in lines[1:]:
+            name, _sep, value = line.partition(':')
+            if name.strip().upper() == 'CONTENT-LENGTH':
+                length = int(value)
+            elif name.strip().upper() == 'CONNECTION':
+                keep_alive = value.strip().lower() != 'close'
+        while len(self.buffer) < length:
+            self.recv()
+        body, self.buffer = self.buffer[:length], self.buffer[length:]
+        if not keep_alive:
+            self.close()
+        return status, body
+
+    def recv(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise socket.error('connection closed')
+        self.buffer += data
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def split_location(location):
+    # http://host:port/description.xml -> (host, port)
+    host, port = location.split('/')[2].split(':')
+    return host, int(port)
+
+
+class server(object):
+    def __init__(self, python, bulbs, fleet, log, workers=0):
+        self.home = tempfile.mkdtemp(prefix='ulfire-bench-')  # empty discovery cache
+        env = dict(os.environ)
+        env[fake_devices.BULBS_ENV] = str(bulbs)
+        if fleet:
+            env[fake_devices.CONFIG_ENV] = os.path.abspath(fleet)
+        command = [python, os.path.join(HERE, 'ulfire.py'), '--simulate', '--ip', '127.0.0.1',
+                   '--cache', os.path.join(self.home, 'cache.json'), '--journal', os.path.join(self.home, 'journal.jsonl'),
+                   '--devices', os.path.join(self.home, 'devices.json')]
+        if workers:
+            command += ['--workers', str(workers)]
+        self.started = time.time()
+        self.process = subprocess.Popen(command, cwd=HERE, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    def wait_for_ssdp(self, timeout):
+        """Seconds from starting the process until it answered a search"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('ulfire exited with %s' % self.process.returncode)
+            latency, _locations = search(timeout=0.01, expected=1)
+            if latency is not None:
+                return time.time() - self.started
+        raise RuntimeError('ulfire did not answer SSDP searches in %ds' % timeout)
+
+    def wait_for_lights(self, expected, timeout, settle=5.0):
+        """Search until the bridges hold at least expected lights, or fewer
+        that did not change for settle seconds (lossy simulated devices
+        can be missed by discovery).
+        Returns [((host, port), [lightnum, ...]), ...].
+        """
+        deadline = time.time() + timeout
+        found = (0, time.time())  # (lights, since)
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('ulfire exited with %s' % self.process.returncode)
+            _latency, locations = search()
+            bridges = []
+            for location in sorted(set(locations)):
+                client = http_client(*split_location(location))
+                try:
+                    status, body = client.request('GET', '/api/%s/lights' % USERNAME)
+                finally:
+                    client.close()
+                bridges.append((split_location(location), sorted(json.loads(body.decode('utf-8')), key=int)))
+            count = sum(len(lights) for _address, lights in bridges)
+            if count >= expected:
+                return bridges
+            if count != found[0]:
+                found = (count, time.time())
+            elif count and time.time() - found[1] > settle:
+                print('WARNING: only %d of %d lights found' % (count, expected))
+                return bridges
+            time.sleep(0.5)
+        raise RuntimeError('ulfire did not come up with %d lights in %ds' % (expected, timeout))
+
+    def usage(self):
+        """(resident memory in bytes, CPU seconds) of the server and its
+        worker processes, Linux only
+        """
+        pid = self.process.pid
+        try:
+            with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+                pids = [pid] + [int(child) for child in f.read().split()]
+        except (IOError, OSError, ValueError):
+            pids = [pid]
+        rss = cpu = 0
+        for pid in pids:
+            try:
+                with open('/proc/%d/status' % pid) as f:
+                    rss += [int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:')][0]
+                with open('/proc/%d/stat' % pid) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+            except (IOError, OSError, IndexError, ValueError):
+                return None, None
+        return rss, cpu
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.home, ignore_errors=True)
+
+
+def http_requests(scenario, bridges):
+    """Endless list of (bridge address, method, path, body) for a scenario"""
+    if scenario == 'lights':
+        return [(address, 'GET', '/api/%s/lights' % USERNAME, b'') for address, _lights in bridges]
+    targets = [(address, lightnum) for address, lights in bridges for lightnum in lights]
+    if scenario == 'light':
+        return [(address, 'GET', '/api/%s/lights/%s' % (USERNAME, lightnum), b'')
+                for address, lightnum in targets]
+    requests = []
+    for state in (b'true', b'false'):
+        for address, lightnum in targets:
+            requests.append((address, 'PUT', '/api/%s/lights/%s/state' % (USERNAME, lightnum),
+                             b'{"on": ' + state + b'}'))
+    return requests
+
+
+def worker(scenario, bridges, offset, deadline, latencies, errors):
+    if scenario == 'ssdp':
+        # ulfire ignores a repeated search from the same address and port
+        # for SEARCH_TTL, so only reuse a socket once that has passed;
+        # letting the OS pick new ports risks hitting a recently used one
+        idle = []  # [(reusable after, socket), ...] oldest first
+        while time.time() < deadline:
+            if idle and idle[0][0] <= time.time():
+                sock = idle.pop(0)[1]
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            latency, _locations = search(timeout=1.0, expected=len(bridges), sock=sock)
+            idle.append((time.time() + SEARCH_TTL, sock))
+            if latency is None:
+                errors.append('no reply')
+            else:
+                latencies.append(latency)
+        for _when, sock in idle:
+            sock.close()
+        return
+    requests = http_requests(scenario, bridges)
+    clients = {}
+    i = offset
+    while time.time() < deadline:
+        address, method, path, body = requests[i % len(requests)]
+        i += 1
+        client = clients.get(address)
+        if client is None:
+            client = clients[address] = http_client(*address)
+        started = time.time()
+        try:
+            status, _body = client.request(method, path, body)
+        except (socket.error, ValueError) as e:
+            errors.append(str(e))
+            continue
+        latencies.append(time.time() - started)
+        if status != 200:
+            errors.append('HTTP %d' % status)
+    for client in clients.values():
+        client.close()
+
+
+def client_threads(scenario, bridges, first, concurrency, deadline):
+    """Runs worker first .. first + concurrency - 1 as threads,
+    returns (latencies, errors)
+    """
+    latencies = []  # list.append is atomic, shared by the workers
+    errors = []
+    threads = [threading.Thread(target=worker, args=(scenario, bridges, n * 7919, deadline, latencies, errors))
+               for n in range(first, first + concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def run_scenario(scenario, bridges, concurrency, duration, ulfire, processes=1):
+    rss_before, cpu_before = ulfire.usage()
+    started = time.time()
+    deadline = started + duration
+    if processes > 1:
+        # the clients spread over processes, each running its share as threads
+        pool = multiprocessing.Pool(processes)
+        shares = [(concurrency * n // processes, concurrency * (n + 1) // processes) for n in range(processes)]
+        pending = [pool.apply_async(client_threads, (scenario, bridges, first, end - first, deadline))
+                   for first, end in shares if end > first]
+        latencies = []
+        errors = []
+        for result in pending:
+            process_latencies, process_errors = result.get()
+            latencies.extend(process_latencies)
+            errors.extend(process_errors)
+        pool.close()
+        pool.join()
+    else:
+        latencies, errors = client_threads(scenario, bridges, 0, concurrency, deadline)
+    elapsed = time.time() - started
+    rss_after, cpu_after = ulfire.usage()
+    latencies.sort()
+    result = {
+        'scenario': scenario,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.50),
+        'p99': percentile(latencies, 0.99),
+        'p999': percentile(latencies, 0.999),
+        'max': latencies and latencies[-1] or None,
+        'server_rss_bytes': rss_after,
+        'server_rss_growth_bytes': rss_after is not None and rss_before is not None and rss_after - rss_before or None,
+        'server_cpu_seconds': cpu_after is not None and cpu_before is not None and cpu_after - cpu_before or None,
+    }
+    if result['server_cpu_seconds'] is not None:
+        result['server_cpu_percent'] = 100.0 * result['server_cpu_seconds'] / elapsed
+    return result
+
+
+def light_memory(python, bulbs, timeout, log):
+    """Returns (lights, idle RSS, RSS after a GET of all lights) of ulfire
+    running with bulbs fake bulbs.
+    """
+    ulfire = server(python, bulbs, None, log)
+    try:
+        bridges = ulfire.wait_for_lights(bulbs, timeout)
+        idle, _cpu = ulfire.usage()
+        for address, lights in bridges:
+            client = http_client(*address)
+            try:
+                client.request('GET', '/api/%s/lights' % USERNAME)
+                for lightnum in lights:
+                    client.request('GET', '/api/%s/lights/%s' % (USERNAME, lightnum))
+            finally:
+                client.close()
+        served, _cpu = ulfire.usage()
+    finally:
+        ulfire.stop()
+    return sum(len(lights) for _address, lights in bridges), idle, served
+
+
+def memory_per_light(python, bulbs, timeout, log):
+    base = light_memory(python, 1, timeout, log)
+    full = light_memory(python, bulbs, timeout, log)
+    if None in base or None in full:
+        return None
+    lights = full[0] - base[0]
+    return {
+        'lights': full[0],
+        'rss_bytes': full[1],
+        'idle_bytes_per_light': (full[1] - base[1]) / float(lights),
+        'served_bytes_per_light': (full[2] - base[2]) / float(lights),
+    }
+
+
+def color_throughput(count):
+    """Colour conversions per second over count random colours, pure
+    Python and, if installed, NumPy (in this interpreter, not --python)
+    """
+    import ulfire
+    rng = random.Random(1)
+    xys = [[rng.uniform(0.0, 0.8), rng.uniform(0.01, 0.8)] for _n in range(count)]
+    hue_sats = [(rng.randint(0, 65535), rng.randint(0, 254)) for _n in range(count)]
+    results = {}
+    for name, converter in (('python', ulfire.color_converter(use_numpy=False)), ('numpy', ulfire.color_converter())):
+        if name == 'numpy' and converter.numpy is None:
+            continue
+        result = {}
+        if converter.numpy is not None:
+            started = time.time()
+            converter.build_xy_table()
+            converter.build_hs_table()
+            result['tables_seconds'] = time.time() - started
+        for direction, convert, colors in (('xy_to_hue_sat', converter.xy_to_hue_sat, xys),
+                                           ('hue_sat_to_xy', converter.hue_sat_to_xy, hue_sats)):
+            started = time.time()
+            convert(colors)
+            result[direction + '_per_second'] = count / (time.time() - started)
+        results[name] = result
+    return results
+
+
+def wemo_soap_throughput(count, concurrency, connect_latency):
+    """SetDeviceStatus calls per second to a simulated bridge, with a
+    connection per call and pooled (in this interpreter, not --python)
+    """
+    import fake_ouimeaux
+    import ulfire
+    bridge = fake_ouimeaux.Bridge('bench bridge', 'BENCH', {'lights': concurrency,
+                                                            'connect_latency': connect_latency,
+                                                            'events': False})
+    bridge.serve()
+    device_ids = sorted(bridge.states)
+    results = {}
+    for name, keep_alive in (('per_request', False), ('pooled', True)):
+        host, port, path = ulfire.wemo_control_address(bridge)
+        client = ulfire.wemo_bridge_client(host, port, keep_alive, path)
+        ulfire.METRICS.collect()
+        before = dict(ulfire.METRICS.wemo_connections)
+        latencies = []
+        errors = []
+
+        def run(offset):
+            for n in range(offset, count, concurrency):
+                started = time.time()
+                try:
+                    client.set_state(device_ids[offset], n % 2, n % 256)
+                except IOError:
+                    errors.append(n)
+                    continue
+                latencies.append(time.time() - started)
+
+        started = time.time()
+        threads = [threading.Thread(target=run, args=(offset,)) for offset in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        client.pool.close()
+        ulfire.METRICS.collect()
+        latencies.sort()
+        counts = dict((event, ulfire.METRICS.wemo_connections.get(event, 0) - before.get(event, 0))
+                      for event in ulfire.METRICS.wemo_connections)
+        results[name] = {
+            'throughput': len(latencies) / elapsed,
+            'errors': len(errors),
+            'p50': percentile(latencies, 0.50),
+            'p99': percentile(latencies, 0.99),
+            'connections_opened': counts.get('opened', 0),
+            'connections_reused': counts.get('reused', 0),
+        }
+    bridge.server.shutdown()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_ms(value):
+    if value is None:
+        return '-'
+    return '%.2f' % (value * 1000)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark ulfire with fake bulbs')
+    parser.add_argument('--bulbs', type=int, default=100, help='number of fake LIFX bulbs')
+    parser.add_argument('--fleet', help='fake_devices config file, overrides --bulbs')
+    parser.add_argument('--memory-per-light', type=int, metavar='BULBS',
+                        help='also measure the memory per light with this many fake bulbs')
+    parser.add_argument('--color-conversions', type=int, metavar='COLORS',
+                        help='also time the colour conversion of this many colours in a batch')
+    parser.add_argument('--wemo-soap', type=int, metavar='CALLS',
+                        help='also time this many WeMo SOAP calls, with and without connection reuse')
+    parser.add_argument('--wemo-connect-latency', type=float, default=0.02,
+                        help='seconds the simulated WeMo Link takes on a new connection')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent clients per scenario')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated, from %s' % ', '.join(SCENARIOS))
+    parser.add_argument('--workers', default='0',
+                        help='comma separated ulfire worker process counts, the scenarios are run for each')
+    parser.add_argument('--client-processes', type=int, default=1,
+                        help='spread the concurrent clients over this many processes')
+    parser.add_argument('--python', default=sys.executable, help='interpreter to run ulfire.py with')
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--server-log', help='file for the output of ulfire (default: discarded)')
+    options = parser.parse_args(argv)
+
+    scenarios = [scenario.strip() for scenario in options.scenarios.split(',') if scenario.strip()]
+    unknown = [scenario for scenario in scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error('unknown scenario(s): %s' % ', '.join(unknown))
+    try:
+        worker_counts = [int(count) for count in options.workers.split(',')]
+    except ValueError:
+        parser.error('--workers takes a comma separated list of numbers')
+
+    log = open(options.server_log or os.devnull, 'w')
+    memory = None
+    if options.memory_per_light:
+        memory = memory_per_light(options.python, options.memory_per_light, options.startup_timeout, log)
+        if memory:
+            print('%d lights: %.0f bytes per light idle, %.0f after serving them' % (
+                memory['lights'], memory['idle_bytes_per_light'], memory['served_bytes_per_light']))
+    color = None
+    if options.color_conversions:
+        color = color_throughput(options.color_conversions)
+        for name, result in sorted(color.items()):
+            print('colour conversion (%s): %.0f xy->hue/sat, %.0f hue/sat->xy per second%s' % (
+                name, result['xy_to_hue_sat_per_second'], result['hue_sat_to_xy_per_second'],
+                'tables_seconds' in result and ', tables built in %.3fs' % result['tables_seconds'] or ''))
+    wemo_soap = None
+    if options.wemo_soap:
+        wemo_soap = wemo_soap_throughput(options.wemo_soap, options.concurrency, options.wemo_connect_latency)
+        for name in ('per_request', 'pooled'):
+            result = wemo_soap[name]
+            print('WeMo SOAP (%s): %.1f calls/s, %d errors, p50 %s ms, p99 %s ms, %d connections opened, '
+                  '%d reused' % (name.replace('_', ' '), result['throughput'], result['errors'],
+                                 format_ms(result['p50']), format_ms(result['p99']),
+                                 result['connections_opened'], result['connections_reused']))
+    if options.fleet:
+        expected = sum(fake_devices.fleet_size(fake_devices.load_config(options.fleet)))
+    else:
+        expected = options.bulbs
+    results = []
+    startup = first_reply = bridges = None
+    try:
+        for workers in worker_counts:
+            ulfire = server(options.python, options.bulbs, options.fleet, log, workers)
+            try:
+                run_first_reply = ulfire.wait_for_ssdp(options.startup_timeout)
+                bridges = ulfire.wait_for_lights(expected, options.startup_timeout)
+                run_startup = time.time() - ulfire.started
+                if startup is None:
+                    startup, first_reply = run_startup, run_first_reply
+                rss, _cpu = ulfire.usage()
+                if len(worker_counts) > 1 or workers:
+                    print('%d worker(s)' % workers)
+                print('first SSDP reply after %.3fs' % run_first_reply)
+                print('%d lights on %d bridge(s), up in %.2fs, %s KiB resident' % (
+                    sum(len(lights) for _address, lights in bridges), len(bridges), run_startup,
+                    rss and rss // 1024))
+                print('%-8s %10s %8s %10s %10s %10s %8s %10s' % (
+                    'scenario', 'req/s', 'errors', 'p50 ms', 'p99 ms', 'p999 ms', 'cpu %', 'rss KiB'))
+                for scenario in scenarios:
+                    result = run_scenario(scenario, bridges, options.concurrency, options.duration, ulfire,
+                                          options.client_processes)
+                    result['workers'] = workers
+                    results.append(result)
+                    print('%-8s %10.1f %8d %10s %10s %10s %8s %10s' % (
+                        scenario, result['throughput'], result['errors'], format_ms(result['p50']),
+                        format_ms(result['p99']), format_ms(result['p999']),
+                        result.get('server_cpu_percent') is not None and '%.1f' % result['server_cpu_percent']
+                        or '-', result['server_rss_bytes'] and result['server_rss_bytes'] // 1024 or '-'))
+            finally:
+                ulfire.stop()
+    finally:
+        log.close()
+
+    if options.output:
+        report = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'revision': git_revision(),
+            'python': options.python,
+            'platform': platform.platform(),
+            'bulbs': options.bulbs,
+            'fleet': options.fleet and os.path.basename(options.fleet),
+            'lights': sum(len(lights) for _address, lights in bridges),
+            'bridges': len(bridges),
+            'concurrency': options.concurrency,
+            'client_processes': options.client_processes,
+            'workers': worker_counts,
+            'duration': options.duration,
+            'startup_seconds': startup,
+            'first_ssdp_reply_seconds': first_reply,
+            'results': results,
+            'memory': memory,
+            'color': color,
+            'wemo_soap': wemo_soap,
+        }
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
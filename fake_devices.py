@@ -0,0 +1,151 @@
+#
+# Shared parts of the simulated devices (fake_lazylights, fake_ouimeaux).
+#
+# The fleet is described by a JSON file named in ULFIRE_SIMULATOR, e.g.
+#
+#   {
+#    "seed": 1,
+#    "lifx": [
+#     {"bulbs": 2000, "latency": {"distribution": "lognormal", "median": 0.02, "sigma": 0.5},
+#      "loss": 0.01, "changes_per_minute": 30},
+#     {"bulbs": 5, "label": "flaky bulb %d", "loss": 0.3, "timeout": 0.5}
+#    ],
+#    "wemo": [
+#     {"bridges": 2, "lights": 10, "latency": {"distribution": "uniform", "low": 0.05, "high": 0.3}},
+#     {"lights": 4, "loss": 0.2, "events": false}
+#    ]
+#   }
+#
+# "lifx" and "wemo" are lists of device groups (a single group can be
+# given as an object). Every group takes:
+#
+#   latency             seconds per request: a number, or a distribution
+#                       {"distribution": "constant", "value": s}
+#                       {"distribution": "uniform", "low": s, "high": s}
+#                       {"distribution": "normal", "mean": s, "sigma": s}
+#                       {"distribution": "lognormal", "median": s, "sigma": s}
+#                       {"distribution": "exponential", "mean": s}
+#   loss                probability a request (or a bulb's reply) is lost
+#   timeout             seconds until a lost / too slow request gives up
+#   changes_per_minute  out of band state changes (vendor app, wall switch)
+#
+# LIFX groups have "bulbs" (count) and "label" (with %d), WeMo groups
+# "bridges" (count), "lights" (per bridge), "label", "events" (push
+# changes through the subscription signal, default true), "soap" (serve
+# the SOAP stand-in, default true, without it ulfire falls back to the
+# ouimeaux calls) and "connect_latency" (seconds, or a distribution, a
+# new SOAP connection takes before its first reply).
+#
+# Without ULFIRE_SIMULATOR there is a single instant, lossless LIFX bulb
+# (FAKE_LAZYLIGHTS_BULBS=<n> for n of them) and no WeMo bridges.
+
+import json
+import math
+import os
+import random
+import threading
+import time
+
+CONFIG_ENV = 'ULFIRE_SIMULATOR'
+BULBS_ENV = 'FAKE_LAZYLIGHTS_BULBS'
+
+lock = threading.RLock()  # guards the state of all simulated devices
+rng = random.Random()
+
+
+class DeviceTimeout(IOError):
+    """A simulated request that got no reply"""
+
+
+def load_config(filename=None):
+    if filename is None:
+        filename = os.environ.get(CONFIG_ENV)
+    if filename:
+        with open(filename) as f:
+            config = json.load(f)
+    else:
+        config = {'lifx': {'bulbs': int(os.environ.get(BULBS_ENV, 1))}}
+    for kind in ('lifx', 'wemo'):
+        groups = config.get(kind, [])
+        if isinstance(groups, dict):
+            groups = [groups]
+        config[kind] = groups
+    if 'seed' in config:
+        rng.seed(config['seed'])
+    return config
+
+
+def fleet_size(config):
+    """(lifx bulbs, wemo lights) described by config"""
+    bulbs = sum(group.get('bulbs', 1) for group in config['lifx'])
+    lights = sum(group.get('bridges', 1) * group.get('lights', 1) for group in config['wemo'])
+    return bulbs, lights
+
+
+class behaviour(object):
+    """Latency, loss and timeout of a group of devices"""
+    def __init__(self, group):
+        self.latency = group.get('latency', 0.0)
+        self.loss = group.get('loss', 0.0)
+        self.timeout = group.get('timeout', 1.0)
+
+    def delay(self):
+        latency = self.latency
+        if not isinstance(latency, dict):
+            return float(latency)
+        distribution = latency.get('distribution', 'constant')
+        if distribution == 'constant':
+            value = latency['value']
+        elif distribution == 'uniform':
+            value = rng.uniform(latency['low'], latency['high'])
+        elif distribution == 'normal':
+            value = rng.gauss(latency['mean'], latency['sigma'])
+        elif distribution == 'lognormal':
+            value = rng.lognormvariate(math.log(latency['median']), latency['sigma'])
+        elif distribution == 'exponential':
+            value = rng.expovariate(1.0 / latency['mean'])
+        else:
+            raise ValueError('Unknown latency distribution %r' % distribution)
+        return max(0.0, value)
+
+    def reply(self):
+        """Seconds until the reply to a request, None if it is lost"""
+        delay = self.delay()
+        if rng.random() < self.loss or delay > self.timeout:
+            return None
+        return delay
+
+    def request(self):
+        """Wait like a blocking request would, DeviceTimeout if lost"""
+        delay = self.reply()
+        if delay is None:
+            time.sleep(self.timeout)
+            raise DeviceTimeout('simulated device timed out')
+        time.sleep(delay)
+
+
+def start_changes(groups, change):
+    """Make out of band changes in the background. groups is a list of
+    (changes per minute, [device, ...]), change(device) alters one.
+    """
+    groups = [(rate, devices) for rate, devices in groups if rate > 0 and devices]
+    if not groups:
+        return None
+
+    def run():
+        # Poisson process over all the groups together
+        total = sum(rate for rate, _devices in groups) / 60.0
+        while True:
+            time.sleep(rng.expovariate(total))
+            pick = rng.uniform(0, total * 60.0)
+            for rate, devices in groups:
+                pick -= rate
+                if pick <= 0:
+                    break
+            with lock:
+                change(rng.choice(devices))
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -1,20 +1,83 @@
 #
+# Simulated lazylights, see fake_devices for the fleet configuration
+
+import collections
+import struct
+import time
+
+import fake_devices
+
+Bulb = collections.namedtuple('Bulb', 'gateway_mac mac addr')
+State = collections.namedtuple('State', 'bulb hue saturation brightness kelvin power label')
 
 # TODO consider false/true ?
 OFF = 0
 ON = 1
 
 class MyFakeBulb:
-    def __init__(self, bulb_name):
+    # Bulb state, get_state() returns a State (immutable, as lazylights) of it
+    def __init__(self, bulb_name, mac=b'\xd0\x73\xd5\0\0\x01', behaviour=None):
         self.label = bulb_name
         self.power = OFF
         self.brightness = 0
-        self.bulb = {}  # FIXME
+        self.hue = 0
+        self.saturation = 0
+        self.kelvin = 3500
+        self.bulb = Bulb(b'\0' * 6, mac, ('127.0.0.1', 56700))
+        self.behaviour = behaviour or fake_devices.behaviour({})
+
+def make_fake_bulbs(groups):
+    # returns [(group, [MyFakeBulb, ...]), ...]
+    made = []
+    n = 0
+    for group in groups:
+        behaviour = fake_devices.behaviour(group)
+        label = group.get('label', 'fake bulb %d')
+        bulbs = []
+        for i in range(group.get('bulbs', 1)):
+            n += 1
+            bulbs.append(MyFakeBulb(label % (i + 1), b'\xd0\x73\xd5' + struct.pack('>I', n)[1:], behaviour))
+        made.append((group, bulbs))
+    return made
+
+def change_bulb(state):
+    # out of band, as if from the LIFX app
+    if state.power == ON and fake_devices.rng.random() < 0.5:
+        state.brightness = fake_devices.rng.randint(0, 65535)
+    else:
+        state.power = state.power == ON and OFF or ON
+
+groups = make_fake_bulbs(fake_devices.load_config()['lifx'])
+# mac -> MyFakeBulb
+fake_bulbs = collections.OrderedDict((b.bulb.mac, b) for _group, bulbs in groups for b in bulbs)
+fake_devices.start_changes([(group.get('changes_per_minute', 0), bulbs) for group, bulbs in groups],
+                           change_bulb)
+
+def deliver(bulbs):
+    """Send to bulbs (fire and forget, like the UDP messages of the real
+    thing), returns the states of those that got it.
+    """
+    delay = 0.0
+    delivered = []
+    for bulb in bulbs:
+        state = fake_bulbs.get(bulb.mac)
+        if state is None:
+            continue
+        reply = state.behaviour.reply()
+        if reply is not None:
+            delay = max(delay, reply)
+            delivered.append(state)
+    time.sleep(delay)
+    return delivered
 
 def set_power(iterator_of_bulbs, new_state=True):
     # iterator_of_bulbs - probably a list
-    for bulb in iterator_of_bulbs:
-        print('set_power %r' % ((bulb, new_state),))
+    bulbs = list(iterator_of_bulbs)
+    print('set_power %r' % ((len(bulbs), new_state),))
+    states = deliver(bulbs)
+    with fake_devices.lock:
+        for state in states:
+            state.power = new_state and ON or OFF
 
 """
 set_power ({}, True)
@@ -25,12 +88,21 @@ send '[{"success": {"/lights/1/state/on": false}}]'
 
 """
 
-def get_state(bulbs):
-    return bulbs
+def set_state(iterator_of_bulbs, hue, saturation, brightness, kelvin, fade, raw=False):
+    bulbs = list(iterator_of_bulbs)
+    print('set_state %r' % ((len(bulbs), hue, saturation, brightness, kelvin, fade, raw),))
+    states = deliver(bulbs)
+    with fake_devices.lock:
+        for state in states:
+            state.hue, state.saturation, state.brightness, state.kelvin = hue, saturation, brightness, kelvin
 
-def find_bulbs(timeout=1):
-    #return []
-    return [
-        MyFakeBulb('fake bulb 1')
-    ]
+def get_state(bulbs, timeout=1):
+    # bulbs that do not reply in time are left out, as with lazylights;
+    # the states are snapshots, later changes to the bulbs do not show
+    states = deliver(bulbs)
+    with fake_devices.lock:
+        return [State(state.bulb, state.hue, state.saturation, state.brightness, state.kelvin, state.power,
+                      state.label) for state in states]
 
+def find_bulbs(expected_bulbs=None, timeout=1):
+    return [state.bulb for state in deliver([state.bulb for state in fake_bulbs.values()])]
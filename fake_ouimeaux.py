@@ -0,0 +1,267 @@
+#
+# Simulated ouimeaux with WeMo Link bridges, see fake_devices for the
+# fleet configuration. Covers what ulfire uses: Environment, the bridge
+# light calls and the subscription signal. Each bridge also serves the
+# light actions of the bridge1 SOAP service (SetDeviceStatus,
+# GetDeviceStatus) over HTTP/1.1 keep-alive on 127.0.0.1, at the
+# controlURL of its bridge service, as a stand-in for the real bridge.
+# As with ouimeaux, the bridge has a host but no port.
+
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+import xml.sax.saxutils as saxutils
+
+try:
+    import http.server as BaseHTTPServer
+    import socketserver as SocketServer
+except ImportError:
+    import BaseHTTPServer  # Python 2
+    import SocketServer
+
+import fake_devices
+
+
+class signal(object):
+    """Just enough of a (py)signals Signal"""
+    def __init__(self):
+        self.receivers = []
+
+    def connect(self, receiver, sender=None, weak=True):
+        self.receivers.append(receiver)
+
+    def send(self, sender, **named):
+        return [(receiver, receiver(sender, **named)) for receiver in list(self.receivers)]
+
+
+class signals(object):
+    # stands in for the ouimeaux.signals module
+    subscription = signal()
+
+
+ON_OFF = '10006'
+LEVEL = '10008'
+SERVICE = 'urn:Belkin:service:bridge:1'
+SOAP_RESPONSE = ('<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+                 's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+                 '<u:%(action)sResponse xmlns:u="' + SERVICE + '">%(arguments)s</u:%(action)sResponse>'
+                 '</s:Body></s:Envelope>')
+
+
+class soap_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive unless the client asks to close
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # a new connection costs the bridge's connect_latency
+        time.sleep(self.server.bridge.connect_behaviour.delay())
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        bridge = self.server.bridge
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        action = (self.headers.get('SOAPACTION') or '').strip('"').split('#')[-1]
+        try:
+            request = ElementTree.fromstring(body).find('.//{%s}%s' % (SERVICE, action))
+            arguments = dict((child.tag, child.text or '') for child in request)
+            bridge.behaviour.request()
+            if action == 'SetDeviceStatus':
+                reply = bridge.set_device_status(arguments['DeviceStatusList'])
+            elif action == 'GetDeviceStatus':
+                reply = bridge.get_device_status(arguments['DeviceIDs'])
+            else:
+                self.send_reply(401, '')
+                return
+        except fake_devices.DeviceTimeout:
+            self.close_connection = True  # no reply
+            return
+        except (ElementTree.ParseError, KeyError, TypeError):
+            self.send_reply(500, '')
+            return
+        self.send_reply(200, SOAP_RESPONSE % {'action': action, 'arguments': ''.join(
+            '<%s>%s</%s>' % (name, saxutils.escape(value), name) for name, value in sorted(reply.items()))})
+
+    def send_reply(self, status, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml; charset="utf-8"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class service(object):
+    """Just enough of an ouimeaux Service"""
+    def __init__(self, control_url):
+        self.controlURL = control_url
+
+
+class soap_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, bridge):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), soap_handler)
+        self.bridge = bridge
+
+
+class Bridge(object):
+    def __init__(self, name, serial, group):
+        self.name = name
+        self.serialnumber = serial
+        self.behaviour = fake_devices.behaviour(group)
+        self.connect_behaviour = fake_devices.behaviour({'latency': group.get('connect_latency', 0.0)})
+        self.events = group.get('events', True)
+        self.Lights = {}  # name -> <device> element, as ouimeaux has them
+        self.states = {}  # device id -> {'state': 0 or 1, 'dim': 0-255}
+        label = group.get('label', name + ' light %d')
+        for i in range(group.get('lights', 1)):
+            device_id = '%s%04X' % (serial, i + 1)
+            device = ElementTree.Element('DeviceInfo')
+            ElementTree.SubElement(device, 'DeviceID').text = device_id
+            ElementTree.SubElement(device, 'FriendlyName').text = label % (i + 1)
+            self.Lights[label % (i + 1)] = device
+            self.states[device_id] = {'state': 0, 'dim': 255}
+
+        self.server = None
+        self.host = None
+
+    def __repr__(self):
+        return '<WeMo Bridge (simulated) "%s">' % self.name
+
+    def serve(self):
+        """Start the bridge's SOAP stand-in, sets host and the bridge
+        service (there is none without it)
+        """
+        self.server = soap_server(self)
+        self.host, port = self.server.server_address
+        self.bridge = service('http://%s:%d/upnp/control/bridge1' % (self.host, port))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def set_device_status(self, status_list):
+        # a single DeviceStatus, or several in a DeviceStatusList
+        root = ElementTree.fromstring(status_list.encode('utf-8'))
+        errors = []
+        with fake_devices.lock:
+            for status in root.iter('DeviceStatus'):
+                device_id = status.findtext('DeviceID')
+                values = dict(zip(status.findtext('CapabilityID').split(','),
+                                  status.findtext('CapabilityValue').split(',')))
+                if device_id not in self.states:
+                    errors.append(device_id)
+                    continue
+                if ON_OFF in values:
+                    self.change(device_id, 'state', int(values[ON_OFF]))
+                if LEVEL in values:
+                    self.change(device_id, 'dim', int(values[LEVEL].split(':')[0]))
+        return {'ErrorDeviceIDs': ','.join(errors)}
+
+    def get_device_status(self, device_ids):
+        statuses = []
+        with fake_devices.lock:
+            for device_id in device_ids.split(','):
+                state = self.states.get(device_id)
+                if state is None:
+                    statuses.append('<DeviceStatus><DeviceID available="NO">%s</DeviceID></DeviceStatus>' % device_id)
+                    continue
+                statuses.append('<DeviceStatus><IsGroupAction>NO</IsGroupAction>'
+                                '<DeviceID available="YES">%s</DeviceID><CapabilityID>%s,%s</CapabilityID>'
+                                '<CapabilityValue>%d,%d:0</CapabilityValue></DeviceStatus>' % (
+                                    device_id, ON_OFF, LEVEL, state['state'], state['dim']))
+        return {'DeviceStatusList': '<?xml version="1.0" encoding="utf-8"?><DeviceStatusList>%s</DeviceStatusList>'
+                                    % ''.join(statuses)}
+
+    def light_get_state(self, light):
+        self.behaviour.request()
+        with fake_devices.lock:
+            state = self.states[light.find('DeviceID').text]
+            return {'state': str(state['state']), 'dim': str(state['dim'])}  # strings, as ouimeaux
+
+    def light_set_state(self, light, state=None, dim=None, transition_duration=None):
+        self.behaviour.request()
+        device_id = light.find('DeviceID').text
+        with fake_devices.lock:
+            # as ouimeaux, only the state if both are given
+            if state is not None:
+                self.change(device_id, 'state', int(state))
+            elif dim is not None:
+                self.change(device_id, 'dim', int(dim))
+
+    def change(self, device_id, key, value):
+        # with fake_devices.lock held
+        if self.states[device_id][key] == value:
+            return
+        self.states[device_id][key] = value
+        if self.events:
+            capability, event_value = key == 'state' and (ON_OFF, str(value)) or (LEVEL, '%d:0' % value)
+            event = ('<StateEvent><DeviceID available="YES">%s</DeviceID><CapabilityId>%s</CapabilityId>'
+                     '<Value>%s</Value></StateEvent>' % (device_id, capability, event_value))
+            signals.subscription.send(self, type='StatusChange', value=event)
+
+    def change_light(self):
+        # out of band, as if from the WeMo app
+        device_id = fake_devices.rng.choice(sorted(self.states))
+        state = self.states[device_id]
+        if state['state'] and fake_devices.rng.random() < 0.5:
+            self.change(device_id, 'dim', fake_devices.rng.randint(1, 255))
+        else:
+            self.change(device_id, 'state', 1 - state['state'])
+
+
+def make_bridges(groups):
+    # returns [(group, [Bridge, ...]), ...]
+    made = []
+    n = 0
+    for group in groups:
+        bridges = []
+        for i in range(group.get('bridges', 1)):
+            n += 1
+            bridge = Bridge('WeMo Link %d' % n, '231442B0%04X' % n, group)
+            if group.get('soap', True):
+                bridge.serve()
+            bridges.append(bridge)
+        made.append((group, bridges))
+    return made
+
+
+groups = make_bridges(fake_devices.load_config()['wemo'])
+bridges = dict((bridge.name, bridge) for _group, group_bridges in groups for bridge in group_bridges)
+# changes_per_minute is per bridge
+fake_devices.start_changes([(group.get('changes_per_minute', 0) * len(group_bridges), group_bridges)
+                            for group, group_bridges in groups],
+                           Bridge.change_light)
+
+
+class Environment(object):
+    def __init__(self, *args, **kwargs):
+        self.found = {}
+
+    def start(self):
+        pass
+
+    def discover(self, seconds=2):
+        # the real search waits out the seconds, bridges reply within them
+        wait = 0.0
+        for name, bridge in bridges.items():
+            reply = bridge.behaviour.reply()
+            if reply is not None and reply <= seconds:
+                wait = max(wait, reply)
+                self.found[name] = bridge
+        time.sleep(wait)
+
+    def list_bridges(self):
+        return list(self.found)
+
+    def get_bridge(self, name):
+        return self.found[name]
+
+    def wait(self, timeout=None):
+        if timeout:
+            time.sleep(timeout)
+            return
+        while True:
+            time.sleep(1000)
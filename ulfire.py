@@ -28,56 +28,107 @@ THE SOFTWARE.
 
 # For a complete discussion, see http://www.makermusings.com
 
+import argparse
+import binascii
+import bisect
+import collections
+import colorsys
+import cProfile
 import email.utils
+import fcntl
+import errno
+import functools
+import hashlib
+import heapq
+import importlib
 import json
+import logging
+import numbers
+import os
+import random
 import select
+import signal
 import socket
 import struct
 import sys
+import tempfile
+import threading
 import time
 import uuid
 import warnings
+import xml.etree.ElementTree as ElementTree
+import xml.sax.saxutils as saxutils
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
 
-def fake_module(name):
-    # Fail with a clear message (possibly at an unexpected time)
-    class MissingModule(object):
-        def __getattr__(self, attr):
-            raise ImportError('No module named %s' % name)
-
-        def __bool__(self):  # Not sure __nonzero__ check was working in py3
-            # if checks on this will fail
-            return False
-        __nonzero__ = __bool__
-
-    return MissingModule()
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib  # Python 2
 
 try:
-    import lazylights
+    from urllib.parse import urlsplit
 except ImportError:
-    try:
-        #raise ImportError()  # debug
-        import fake_lazylights as lazylights
-    except ImportError:
-        lazylights = fake_module('lazylights')
+    from urlparse import urlsplit  # Python 2
 
 try:
-    import ouimeaux
-    import ouimeaux.environment
-    from ouimeaux.environment import Environment
+    string_types = basestring  # Python 2
+except NameError:
+    string_types = str
+
+try:
+    import numpy  # optional, batch colour conversion
 except ImportError:
-    ouimeaux = fake_module('ouimeaux')
-    class FakeEnvironment:
-        def start(self):
-            warnings.warn('ouimeaux missing, no WeMo support')
-            pass  # NOOP
-        def list_bridges(self):
-            return ()  # NOOP
-        def discover(self, timeout):
-            pass  # NOOP - timeout ignored
+    numpy = None
 
-    Environment = FakeEnvironment
 
+# The LIFX and WeMo modules are imported by load_backends(), only for the
+# backends that are enabled. Until then, or if a backend is disabled or
+# its module is missing, these are None and that backend is skipped.
+lazylights = None
+ouimeaux = None
+Environment = None
+
+
+def import_first(*names):
+    # the first of the modules that can be imported, None if none can
+    for name in names:
+        try:
+            return importlib.import_module(name)
+        except ImportError as e:
+            log.debug('%s not loaded: %s', name, e)
+    return None
+
+
+def load_backends(lifx=True, wemo=True, simulate=False):
+    """Import the modules of the enabled backends. The simulated devices
+    (fake_lazylights, fake_ouimeaux) are used if simulate is set or the
+    real module is not installed.
+    """
+    global lazylights, ouimeaux, Environment
+    if lifx:
+        if simulate:
+            lazylights = import_first('fake_lazylights')
+        else:
+            lazylights = import_first('lazylights', 'fake_lazylights')
+        if not lazylights:
+            warnings.warn('lazylights missing, no Lifx support')
+    if wemo:
+        module = None
+        if not simulate:
+            module = import_first('ouimeaux.environment')
+        if module:
+            importlib.import_module('ouimeaux.signals')
+            ouimeaux = sys.modules['ouimeaux']
+        else:
+            module = ouimeaux = import_first('fake_ouimeaux')
+        if module:
+            Environment = module.Environment
+        else:
+            warnings.warn('ouimeaux missing, no WeMo support')
 
 
 # This XML is the minimum needed to define one of our virtual Hues
@@ -89,7 +140,7 @@ HUE_SETUP_XML = """<?xml version="1.0" encoding="UTF-8" ?>
 		<major>1</major>
 		<minor>0</minor>
 	</specVersion>
-	<URLBase>%(host)%(port)/</URLBase>
+	<URLBase>http://%(host)s:%(port)s/</URLBase>
 	<device>
 		<deviceType>urn:schemas-upnp-org:device:Basic:1</deviceType>
 		<friendlyName>Philips hue (##URLBASE##)</friendlyName>
@@ -99,8 +150,8 @@ HUE_SETUP_XML = """<?xml version="1.0" encoding="UTF-8" ?>
 		<modelName>Philips hue bridge 2012</modelName>
 		<modelNumber>929000226503</modelNumber>
 		<modelURL>http://www.meethue.com</modelURL>
-		<serialNumber>0017880ae670</serialNumber>
-		<UDN>uuid:2f402f80-da50-11e1-9b23-0017880ae670</UDN>
+		<serialNumber>%(serial)s</serialNumber>
+		<UDN>uuid:%(uuid)s</UDN>
 		<serviceList>
 			<service>
 				<serviceType>(null)</serviceType>
@@ -114,20 +165,265 @@ HUE_SETUP_XML = """<?xml version="1.0" encoding="UTF-8" ?>
 	</device>
 </root>"""
 
-DEBUG = False
-DEBUG = True
+# Messages go to the "ulfire" logger, set up by main() (--log-level,
+# -d for DEBUG). Pass the arguments to the logging call rather than a
+# formatted string, they are only formatted if the level is enabled:
+# at INFO the request payloads logged at DEBUG cost next to nothing.
+
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(process)d] %(message)s'
 
-def dbg(msg):  # FIXME use real logging library
-    global DEBUG
-    if DEBUG:
-        print(msg)
-        sys.stdout.flush()
+log = logging.getLogger('ulfire')
+log.addHandler(logging.NullHandler())  # quiet when imported, e.g. by the benchmark
+
+
+_http_date = [None, None]
+
+def http_date():
+    """Current date for DATE headers, formatted at most once a second"""
+    now = int(time.time())
+    if now != _http_date[0]:
+        _http_date[1] = email.utils.formatdate(timeval=now, localtime=False, usegmt=True)
+        _http_date[0] = now
+    return _http_date[1]
+
+
+# Counters and latency histograms for the /metrics endpoint (Prometheus
+# text format). Everything that updates them runs on the poll loop
+# thread, so they are plain numbers, updating one is an index or dict
+# lookup and an increment.
+
+class histogram(object):
+    BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+               0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def render(self, lines, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, labels, bound, cumulative))
+        lines.append('%s_bucket{%sle="+Inf"} %d' % (name, labels, self.count))
+        labels = labels.rstrip(',')
+        if labels:
+            labels = '{%s}' % labels
+        lines.append('%s_sum%s %r' % (name, labels, self.total))
+        lines.append('%s_count%s %d' % (name, labels, self.count))
+
+
+class metrics_registry(object):
+    ROUTES = ('description.xml', 'lights', 'light', 'state', 'groups', 'metrics', 'debug', 'other', 'bad_request',
+              'forwarded')
+
+    def __init__(self):
+        self.requests = dict((route, histogram()) for route in self.ROUTES)
+        self.ssdp_received = {}  # search target -> count
+        self.ssdp_replied = {}
+        self.ssdp_suppressed = {}
+        self.commands = {}  # handler class name -> histogram
+        self.command_failures = {}
+        self.loop = histogram()
+        self.wemo_connections = {}  # opened, reused, dropped, retried, failed -> count
+        self.posted = collections.deque()  # (counters, key) counted by other threads, see post()
+        self.started = time.time()
+        self.first_ssdp_reply = None  # seconds from start until the first search was answered
+
+    def count(self, counters, key):
+        counters[key] = counters.get(key, 0) + 1
+
+    def post(self, counters, key):
+        # count() for other threads: the counts wait (a deque append
+        # needs no lock) until collect() runs on the poll loop thread,
+        # as each backend command completes and when rendering
+        self.posted.append((counters, key))
+
+    def collect(self):
+        while self.posted:
+            self.count(*self.posted.popleft())
+
+    def observe_command(self, label, latency, result):
+        self.collect()
+        if label not in self.commands:
+            self.commands[label] = histogram()
+            self.command_failures[label] = 0
+        self.commands[label].observe(latency)
+        if not result:
+            self.command_failures[label] += 1
+
+    def render(self, devices=(), dispatcher=None):
+        self.collect()
+        lines = []
+        lines.append('# TYPE ulfire_http_request_duration_seconds histogram')
+        for route, requests in sorted(self.requests.items()):
+            requests.render(lines, 'ulfire_http_request_duration_seconds', 'route="%s",' % route)
+        for name, counters in (('received', self.ssdp_received),
+                               ('replied', self.ssdp_replied),
+                               ('suppressed', self.ssdp_suppressed)):
+            lines.append('# TYPE ulfire_ssdp_searches_%s_total counter' % name)
+            for search_target, count in sorted(counters.items()):
+                lines.append('ulfire_ssdp_searches_%s_total{st="%s"} %d' % (name, search_target, count))
+        lines.append('# TYPE ulfire_backend_command_duration_seconds histogram')
+        for label, commands in sorted(self.commands.items()):
+            commands.render(lines, 'ulfire_backend_command_duration_seconds', 'handler="%s",' % label)
+        lines.append('# TYPE ulfire_backend_command_failures_total counter')
+        for label, count in sorted(self.command_failures.items()):
+            lines.append('ulfire_backend_command_failures_total{handler="%s"} %d' % (label, count))
+        lines.append('# TYPE ulfire_wemo_connections_total counter')
+        for event, count in sorted(self.wemo_connections.items()):
+            lines.append('ulfire_wemo_connections_total{event="%s"} %d' % (event, count))
+        lines.append('# TYPE ulfire_poll_loop_iteration_seconds histogram')
+        self.loop.render(lines, 'ulfire_poll_loop_iteration_seconds', '')
+        lines.append('# TYPE ulfire_start_time_seconds gauge')
+        lines.append('ulfire_start_time_seconds %.3f' % self.started)
+        if self.first_ssdp_reply is not None:
+            lines.append('# TYPE ulfire_first_ssdp_reply_seconds gauge')
+            lines.append('ulfire_first_ssdp_reply_seconds %.6f' % self.first_ssdp_reply)
+        lines.append('# TYPE ulfire_open_client_sockets gauge')
+        lines.append('ulfire_open_client_sockets %d' % sum(len(device.connections) for device in devices))
+        if dispatcher:
+            stats = dispatcher.stats()
+            lines.append('# TYPE ulfire_backend_queue_depth gauge')
+            lines.append('ulfire_backend_queue_depth %d' % stats['queue_depth'])
+            lines.append('# TYPE ulfire_backend_in_flight gauge')
+            lines.append('ulfire_backend_in_flight %d' % stats['in_flight'])
+            lines.append('# TYPE ulfire_backend_rejected_total counter')
+            lines.append('ulfire_backend_rejected_total %d' % stats['rejected'])
+        return '\n'.join(lines) + '\n'
+
+METRICS = metrics_registry()
+
+
+# Request tracing. A sample of the Hue API requests (TRACER.sample_rate,
+# see --trace-sample) get a trace_span timing the parsing of the
+# request, its handler and the writing of the response to the socket.
+# Finished spans are logged to "ulfire.trace" at INFO as one JSON
+# object per line. What the socket did not take at once is sent later
+# from the poll loop, the span only records how many bytes were left
+# ("pending"); requests forwarded to the owner in worker mode end when
+# they have been sent on.
+
+class trace_span(object):
+    __slots__ = ('started', 'parsed', 'send', 'pending')
+
+    def __init__(self):
+        self.started = time.time()
+        self.parsed = None
+        self.send = 0.0
+        self.pending = 0
+
+
+class request_tracer(object):
+    def __init__(self, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self.log = logging.getLogger('ulfire.trace')
+
+    def sample(self):
+        """A new span for this request, or None if it is not traced"""
+        if self.sample_rate and random.random() < self.sample_rate and self.log.isEnabledFor(logging.INFO):
+            return trace_span()
+        return None
+
+    def finish(self, span, request, finished):
+        handler = finished - span.parsed - span.send
+        self.log.info('%s', json.dumps({
+            'pid': os.getpid(),
+            'method': request.method,
+            'path': request.path,
+            'route': request.route,
+            'parse_ms': round((span.parsed - span.started) * 1000, 3),
+            'handler_ms': round(handler * 1000, 3),
+            'send_ms': round(span.send * 1000, 3),
+            'pending': span.pending,
+            'total_ms': round((finished - span.started) * 1000, 3),
+        }, sort_keys=True))
+
+TRACER = request_tracer()
+
+
+# Profiling without a restart. A capture profiles the poll loop thread
+# (the Hue API, SSDP and the timers) of the process with cProfile and
+# writes the stats to a file in PROFILER.directory (--profile-dir),
+# ulfire-<pid>-<time>.prof, to be read with pstats. SIGUSR2 starts a
+# capture and the next SIGUSR2 writes it out (in worker mode send it to
+# the process wanted, see "Started worker" in the log). With
+# --profile-endpoint, GET /debug/profile/<seconds> captures for that
+# long, in the process that took the request.
+
+class profile_capture(object):
+    MAX_SECONDS = 300
+
+    def __init__(self, directory=None):
+        self.directory = directory or tempfile.gettempdir()
+        self.endpoint = False
+        self.profile = None
+        self.filename = None
+        self.timer = None
+        self.poller = None
+
+    def start(self, seconds=None, poller=None):
+        """Start a capture, stopped after seconds (from poller's loop)
+        if given. Returns the file it will be written to, None if a
+        capture is already running.
+        """
+        if self.profile is not None:
+            return None
+        self.filename = os.path.join(self.directory, 'ulfire-%d-%s.prof' % (
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S')))
+        if seconds:
+            self.poller = poller
+            self.timer = poller.call_later(min(seconds, self.MAX_SECONDS), self.stop)
+        log.info('Profiling to %s', self.filename)
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self.filename
+
+    def stop(self):
+        if self.profile is None:
+            return None
+        profile, self.profile = self.profile, None
+        profile.disable()
+        if self.timer is not None:
+            self.poller.cancel(self.timer)
+            self.timer = self.poller = None
+        try:
+            profile.dump_stats(self.filename)
+        except (IOError, OSError) as e:
+            log.warning('Failed to write the profile %s: %s', self.filename, e)
+            return None
+        log.info('Profile written to %s', self.filename)
+        return self.filename
+
+    def toggle(self, signum=None, frame=None):
+        # signal handler
+        if self.profile is None:
+            self.start()
+        else:
+            self.stop()
+
+PROFILER = profile_capture()
 
 
 # A simple utility class to wait for incoming data to be
-# ready on a socket.
+# ready on a socket. It also keeps a heap of timers so that
+# delayed work (e.g. staggered SSDP replies) runs from the same
+# loop without blocking it. Targets with output to send can ask
+# (with watch()) to have do_write() called when the socket is
+# writable, and stop being read in the meantime.
 
 class poller:
+    READABLE = getattr(select, 'POLLIN', 1)
+    WRITABLE = getattr(select, 'POLLOUT', 4)
+
     def __init__(self):
         if 'poll' in dir(select):
             self.use_poll = True
@@ -135,6 +431,40 @@ class poller:
         else:
             self.use_poll = False
         self.targets = {}
+        self.not_reading = set()  # filenos, for select()
+        self.writing = set()
+        self.timers = []
+        self.timer_seq = 0
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) from the poll loop after delay seconds.
+        Returns a handle that can be passed to cancel().
+        """
+        self.timer_seq += 1
+        entry = [time.time() + delay, self.timer_seq, callback, args]
+        heapq.heappush(self.timers, entry)
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None  # left in the heap, skipped when it comes due
+
+    def run_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _when, _seq, callback, args = heapq.heappop(self.timers)
+            if callback:
+                callback(*args)
+
+    def next_timeout(self, timeout):
+        # Shorten the poll timeout (ms) so the next timer fires on time
+        while self.timers and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return timeout
+        delay = max(0, int((self.timers[0][0] - time.time()) * 1000 + 1))
+        if timeout is None or delay < timeout:
+            return delay
+        return timeout
 
     def add(self, target, fileno = None):
         if not fileno:
@@ -149,27 +479,388 @@ class poller:
         if self.use_poll:
             self.poller.unregister(fileno)
         del(self.targets[fileno])
+        self.not_reading.discard(fileno)
+        self.writing.discard(fileno)
 
-    def poll(self, timeout = 0):
+    def watch(self, fileno, read=True, write=False):
+        # Change what a registered fileno is polled for
         if self.use_poll:
-            ready = self.poller.poll(timeout)
+            self.poller.modify(fileno, (read and self.READABLE or 0) | (write and self.WRITABLE or 0))
+        if read:
+            self.not_reading.discard(fileno)
+        else:
+            self.not_reading.add(fileno)
+        if write:
+            self.writing.add(fileno)
         else:
-            ready = []
-            if len(self.targets) > 0:
-                (rlist, wlist, xlist) = select.select(self.targets.keys(), [], [], timeout)
-                ready = [(x, None) for x in rlist]
-        for one_ready in ready:
-            target = self.targets.get(one_ready[0], None)
-            if target:
-                target.do_read(one_ready[0])
+            self.writing.discard(fileno)
+
+    def poll(self, timeout = 0):
+        # timeout is in milliseconds (as for select.poll), None blocks
+        # until at least one target is ready or a timer is due
+        timeout = self.next_timeout(timeout)
+        try:
+            if self.use_poll:
+                ready = self.poller.poll(timeout)
+            else:
+                ready = []
+                if len(self.targets) > 0:
+                    if timeout is not None:
+                        timeout = timeout / 1000.0
+                    (rlist, wlist, xlist) = select.select([fileno for fileno in self.targets if fileno not in self.not_reading],
+                                                          list(self.writing), [], timeout)
+                    ready = [(x, self.WRITABLE) for x in wlist] + [(x, self.READABLE) for x in rlist]
+        except (select.error, IOError, OSError) as e:
+            if e.args and e.args[0] == errno.EINTR:
+                # interrupted by a signal, let the caller loop again
+                self.run_timers()
+                return
+            raise
+        started = time.time()
+        for fileno, events in ready:
+            if events & self.WRITABLE:
+                target = self.targets.get(fileno, None)
+                if target:
+                    target.do_write(fileno)
+            if events & ~self.WRITABLE:
+                # readable, or hung up / failed (which a read reports)
+                target = self.targets.get(fileno, None)
+                if target:
+                    target.do_read(fileno)
+        self.run_timers()
+        METRICS.loop.observe(time.time() - started)
  
 
+# Runs action handler calls (i.e. network round trips to the bulbs) on a
+# small pool of worker threads so a slow or unreachable light does not
+# stall the poll loop. Commands with the same key always go to the same
+# worker, so they run one at a time and in order. Results come back to
+# the poll loop through a pipe, where the submitter's callback is run
+# with True/False. A command that does not finish within TIMEOUT
+# seconds is reported as failed (the worker thread cannot be
+# interrupted, a late result is ignored).
+
+class command_dispatcher(object):
+    WORKERS = 4
+    QUEUE_SIZE = 64  # per worker
+    TIMEOUT = 5.0
+
+    def __init__(self, poller, workers=None):
+        self.poller = poller
+        self.queues = [queue.Queue(self.QUEUE_SIZE) for _ in range(workers or self.WORKERS)]
+        self.done = queue.Queue()
+        self.in_flight = {}  # seq -> (callback, start time, timeout timer)
+        self.seq = 0
+        # stats
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in (self.wake_read, self.wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poller.add(self)
+        for worker_queue in self.queues:
+            thread = threading.Thread(target=self.worker, args=(worker_queue,))
+            thread.daemon = True
+            thread.start()
+
+    def fileno(self):
+        return self.wake_read
+
+    def submit(self, key, func, args, callback, timeout=None, label=None):
+        """Call func(*args) on a worker, then callback(result) from the
+        poll loop. result is False if func raised or timed out. The
+        latency and failures are recorded in METRICS under label, if given.
+        """
+        self.seq += 1
+        worker_queue = self.queues[hash(key) % len(self.queues)]
+        try:
+            worker_queue.put_nowait((self.seq, func, args))
+        except queue.Full:
+            log.warning('Command queue full, dropping command for %r', key)
+            self.rejected += 1
+            if label:
+                METRICS.observe_command(label, 0.0, False)
+            callback(False)
+            return
+        self.track(self.seq, callback, timeout, label)
+
+    def spawn(self, func, args, callback, timeout=None):
+        """As submit() but on a thread of its own, for long running jobs
+        (e.g. discovery) that should not hold up the worker queues.
+        """
+        self.seq += 1
+        thread = threading.Thread(target=self.run, args=(self.seq, func, args))
+        thread.daemon = True
+        thread.start()
+        self.track(self.seq, callback, timeout)
+
+    def post(self, callback, *args):
+        """Run callback(*args) from the poll loop, safe to call from any thread"""
+        self.done.put((None, (callback, args)))
+        self.wake()
+
+    def track(self, seq, callback, timeout, label=None):
+        timer = self.poller.call_later(timeout or self.TIMEOUT, self.timed_out, seq)
+        self.in_flight[seq] = (callback, time.time(), timer, label)
+
+    def worker(self, worker_queue):
+        while True:
+            seq, func, args = worker_queue.get()
+            self.run(seq, func, args)
+
+    def run(self, seq, func, args):
+        try:
+            result = func(*args)
+        except Exception as e:
+            log.warning('Command failed: %r', e)
+            result = False
+        self.done.put((seq, result))
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, b'x')
+        except OSError:
+            pass  # pipe full, the poll loop is already due to wake up
+
+    def do_read(self, fileno):
+        try:
+            os.read(self.wake_read, 4096)
+        except OSError:
+            pass
+        while True:
+            try:
+                seq, result = self.done.get_nowait()
+            except queue.Empty:
+                break
+            if seq is None:
+                callback, args = result  # from post()
+                callback(*args)
+                continue
+            entry = self.in_flight.pop(seq, None)
+            if entry is None:
+                continue  # already reported as timed out
+            callback, started, timer, label = entry
+            self.poller.cancel(timer)
+            latency = time.time() - started
+            self.completed += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            if not result:
+                self.failed += 1
+            if label:
+                METRICS.observe_command(label, latency, result)
+            callback(result)
+
+    def timed_out(self, seq):
+        entry = self.in_flight.pop(seq, None)
+        if entry:
+            self.timeouts += 1
+            callback, started, timer, label = entry
+            if label:
+                METRICS.observe_command(label, time.time() - started, False)
+            callback(False)
+
+    def queue_depth(self):
+        return sum(worker_queue.qsize() for worker_queue in self.queues)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'in_flight': len(self.in_flight),
+            'completed': self.completed,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+            'mean_latency': self.completed and self.total_latency / self.completed,
+            'max_latency': self.max_latency,
+        }
+
+
+# Minimal incremental HTTP/1.x request parser. Each client connection
+# buffers what it receives until the headers and Content-Length worth
+# of body are complete, so requests split over several TCP segments
+# and several (pipelined) requests in one segment are both handled.
+
+class http_error(Exception):
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+
+class http_request(object):
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers  # upper case names
+        self.body = body
+        self.route = 'other'  # set by the handler, for METRICS
+        connection = headers.get('CONNECTION', '').lower()
+        if version == 'HTTP/1.0':
+            self.keep_alive = connection == 'keep-alive'
+        else:
+            self.keep_alive = connection != 'close'
+
+
+# Output (HTTP responses, messages between worker processes) goes out
+# through buffered_socket.write(), which queues the buffers (e.g. the
+# headers and the, often cached, body) and sends as much as the non-blocking socket takes. What is left is
+# sent by flush() when the socket becomes writable; while more than
+# OUTPUT_HIGH_WATER bytes are waiting no more requests are served
+# from that connection. Python 2 has no sendmsg(), so buffers of a
+# small response are still joined, a copy costs less than a send() (and
+# a TCP segment) per buffer; larger ones go out one send() at a time.
+
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)  # Linux value, missing from some Pythons
+COALESCE_SIZE = 65536  # join buffers up to this size for a single send()
+
+
+class buffered_socket(object):
+    OUTPUT_HIGH_WATER = 262144
+
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.address = address
+        self.fd = sock.fileno()  # still known after close()
+        self.buffer = ''  # received, not yet handled
+        self.output = collections.deque()  # buffers, the first one possibly a memoryview of the unsent rest
+        self.output_size = 0
+        self.closing = False  # close once the output is sent
+
+    def fileno(self):
+        return self.fd
+
+    def feed(self, data):
+        self.buffer += data
+
+    def write(self, buffers):
+        """Queue buffers to be sent in order, and send what the socket
+        takes now. Returns True if everything has been sent. Raises
+        socket.error if the connection failed.
+        """
+        size = 0
+        for buf in buffers:
+            size += len(buf)
+        if not self.output and size <= COALESCE_SIZE:
+            # a copy of a small response costs less than a send() per buffer
+            buffers = [''.join(buffers)]
+        for buf in buffers:
+            if buf:
+                self.output.append(buf)
+        self.output_size += size
+        return self.flush()
+
+    def flush(self):
+        # Send queued output until there is none left (returns True) or
+        # the socket would block (returns False)
+        while self.output:
+            try:
+                if len(self.output) > 1 and self.output_size <= COALESCE_SIZE:
+                    # one small copy beats a send() (and TCP segment) per buffer
+                    sent = self.socket.send(''.join([isinstance(buf, memoryview) and buf.tobytes() or buf
+                                                     for buf in self.output]))
+                else:
+                    sent = self.socket.send(self.output[0])
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            self.output_size -= sent
+            while sent:
+                first = self.output[0]
+                if sent >= len(first):
+                    self.output.popleft()
+                    sent -= len(first)
+                else:
+                    # partial write, keep the rest without copying it
+                    self.output[0] = memoryview(first)[sent:]
+                    sent = 0
+        return True
+
+    def close(self):
+        self.output.clear()
+        self.output_size = 0
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+
+class http_connection(buffered_socket):
+    MAX_HEADER_SIZE = 8192
+    MAX_BODY_SIZE = 65536
+
+    def __init__(self, client_socket, address):
+        buffered_socket.__init__(self, client_socket, address)
+        self.scan_from = 0  # where to resume looking for the end of headers
+        self.keep_alive = True
+        self.paused = False  # waiting for a response from elsewhere, see fauxhue_replica
+        self.span = None  # trace_span of the request being handled, if it is traced
+
+    def next_request(self):
+        """Return the next complete request from the buffer, None if more
+        data is needed. Raises http_error for malformed requests.
+        """
+        if self.buffer[:2] == '\r\n':
+            # stray CRLF between pipelined requests
+            self.buffer = self.buffer.lstrip('\r\n')
+            self.scan_from = 0
+        end = self.buffer.find('\r\n\r\n', self.scan_from)
+        if end == -1:
+            if len(self.buffer) > self.MAX_HEADER_SIZE:
+                raise http_error('431 Request Header Fields Too Large')
+            self.scan_from = max(0, len(self.buffer) - 3)
+            return None
+        lines = self.buffer[:end].split('\r\n')
+        request_line = lines[0].split()
+        if len(request_line) != 3:
+            raise http_error('400 Bad Request')
+        method, path, version = request_line
+        if version not in ('HTTP/1.0', 'HTTP/1.1'):
+            raise http_error('505 HTTP Version Not Supported')
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise http_error('400 Bad Request')
+            headers[name.strip().upper()] = value.strip()
+        if 'TRANSFER-ENCODING' in headers:
+            raise http_error('501 Not Implemented')  # no chunked bodies
+        try:
+            length = int(headers.get('CONTENT-LENGTH', 0))
+        except ValueError:
+            raise http_error('400 Bad Request')
+        if length < 0:
+            raise http_error('400 Bad Request')
+        if length > self.MAX_BODY_SIZE:
+            raise http_error('413 Request Entity Too Large')
+        body_start = end + 4
+        if len(self.buffer) < body_start + length:
+            self.scan_from = end
+            return None
+        body = self.buffer[body_start:body_start + length]
+        self.buffer = self.buffer[body_start + length:]
+        self.scan_from = 0
+        request = http_request(method, path, version, headers, body)
+        self.keep_alive = request.keep_alive
+        return request
+
 # Base class for a generic UPnP device. This is far from complete
 # but it supports either specified or automatic IP address and port
 # selection.
 
 class upnp_device(object):
     this_host_ip = None
+    BACKLOG = 128  # listen() queue, see --backlog
+    REUSE_PORT = False  # set in worker mode, see worker_pool
 
     @staticmethod
     def local_ip_address():
@@ -181,13 +872,12 @@ class upnp_device(object):
             except:
                 upnp_device.this_host_ip = '127.0.0.1'
             del(temp_socket)
-            dbg("got local address of %s" % upnp_device.this_host_ip)
+            log.debug('got local address of %s', upnp_device.this_host_ip)
         return upnp_device.this_host_ip
         
 
     def __init__(self, listener, poller, port, root_url, server_version, persistent_uuid, protocol, other_headers = None, ip_address = None):
-        dbg('upnp_device init %r' % ((listener, poller, port, root_url, server_version, persistent_uuid, protocol, other_headers, ip_address),))
-        dbg('upnp_device init root_url %r' % ((root_url, ),))
+        log.debug('upnp_device init %r', (listener, poller, port, root_url, server_version, persistent_uuid, protocol, other_headers, ip_address))
         self.listener = listener
         self.poller = poller
         self.port = port
@@ -204,12 +894,15 @@ class upnp_device(object):
             self.ip_address = upnp_device.local_ip_address()
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.REUSE_PORT:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         self.socket.bind((self.ip_address, self.port))
-        self.socket.listen(5)
+        self.socket.listen(self.BACKLOG)
         if self.port == 0:
             self.port = self.socket.getsockname()[1]
         self.poller.add(self)
-        self.client_sockets = {}
+        self.connections = {}
+        self.search_replies = {}
         self.listener.add_device(self)
 
     def fileno(self):
@@ -217,19 +910,165 @@ class upnp_device(object):
 
     def do_read(self, fileno):
         if fileno == self.socket.fileno():
-            (client_socket, _client_address) = self.socket.accept()
+            (client_socket, client_address) = self.socket.accept()
+            client_socket.setblocking(0)
+            # responses are written whole, Nagle would only hold back the
+            # last segment of one
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.poller.add(self, client_socket.fileno())
-            self.client_sockets[client_socket.fileno()] = client_socket
+            self.connections[client_socket.fileno()] = http_connection(client_socket, client_address)
+            return
+        connection = self.connections[fileno]
+        try:
+            data = connection.socket.recv(4096)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            log.debug('recv failed from %r: %s', connection.address, e)
+            data = None
+        if not data:
+            self.close_connection(fileno)
+            return
+        connection.feed(data)
+        self.serve_requests(connection)
+
+    def serve_requests(self, connection):
+        # Serve every complete request in the buffer, in order, until the
+        # client has too much output waiting to be read
+        fileno = connection.fileno()
+        while fileno in self.connections and not connection.closing and not connection.paused:
+            if connection.output_size > connection.OUTPUT_HIGH_WATER:
+                self.poller.watch(fileno, read=False, write=True)
+                break
+            span = TRACER.sample()
+            try:
+                request = connection.next_request()
+            except http_error as e:
+                log.debug('Bad request from %r: %s', connection.address, e.status)
+                METRICS.requests['bad_request'].observe(0.0)
+                connection.keep_alive = False
+                self.send_error(connection, e.status)
+                self.finish_connection(connection)
+                break
+            if request is None:
+                break
+            started = time.time()
+            if span is not None:
+                span.parsed = started
+                connection.span = span
+            try:
+                self.handle_request(request, connection.address, connection)
+            except Exception:
+                # a handler bug costs this connection, not the server
+                log.error('%s %s from %r failed', request.method, request.path, connection.address, exc_info=True)
+                connection.keep_alive = False
+                connection.paused = False
+                if fileno in self.connections:
+                    self.send_error(connection, '500 Internal Server Error')
+            finished = time.time()
+            METRICS.requests[request.route].observe(finished - started)
+            if span is not None:
+                connection.span = None
+                TRACER.finish(span, request, finished)
+            if fileno not in self.connections:
+                break
+            if not connection.keep_alive and not connection.paused:
+                self.finish_connection(connection)
+
+    def do_write(self, fileno):
+        connection = self.connections.get(fileno)
+        if connection is None:
+            return
+        try:
+            done = connection.flush()
+        except socket.error as e:
+            log.debug('send failed to %r: %s', connection.address, e)
+            self.close_connection(fileno)
+            return
+        if not done:
+            return
+        if connection.closing:
+            self.close_connection(fileno)
+            return
+        self.poller.watch(fileno)
+        self.serve_requests(connection)  # pipelined requests held back
+
+    def finish_connection(self, connection):
+        # close after the last response has been sent
+        if connection.output:
+            connection.closing = True
+            self.poller.watch(connection.fileno(), read=False, write=True)
         else:
-            data, sender = self.client_sockets[fileno].recvfrom(4096)
-            if not data:
-                self.poller.remove(self, fileno)
-                del(self.client_sockets[fileno])
-            else:
-                self.handle_request(data, sender, self.client_sockets[fileno])  # FIXME does not handle json read/decode
+            self.close_connection(connection.fileno())
 
-    def handle_request(self, data, sender, socket):
-        pass
+    def close_connection(self, fileno):
+        connection = self.connections.pop(fileno, None)
+        if connection:
+            self.poller.remove(self, fileno)
+            connection.close()
+
+    def handle_request(self, request, sender, connection):
+        self.send_error(connection, '404 Not Found')
+
+    RESPONSE_HEADERS = ("LAST-MODIFIED: Sat, 01 Jan 2000 00:01:15 GMT\r\n"
+                        "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
+                        "X-User-Agent: redsonic\r\n")
+
+    def send(self, connection, data, content_type='application/json', status='200 OK', headers=None):
+        # FIXME respond to / root requests, include html with link to /api/username/lights ?
+        log.debug('send %r', data)
+        if connection.keep_alive:
+            connection_header = 'keep-alive'
+        else:
+            connection_header = 'close'
+        if status.startswith('304'):
+            entity_headers = ''  # no body
+        else:
+            entity_headers = ("CONTENT-LENGTH: %d\r\n"
+                              "CONTENT-TYPE: %s\r\n" % (len(data), content_type))
+        if headers:
+            entity_headers += ''.join("%s\r\n" % header for header in headers)
+        head = ("HTTP/1.1 %s\r\n"
+                "%s"
+                "DATE: %s\r\n"
+                "%s"
+                "CONNECTION: %s\r\n"
+                "\r\n" % (status, entity_headers, http_date(), self.RESPONSE_HEADERS, connection_header))
+        if status.startswith('304'):
+            data = ''
+        self.write_response(connection, (head, data))
+
+    def write_response(self, connection, buffers):
+        span = connection.span
+        if span is not None:
+            started = time.time()
+        try:
+            done = connection.write(buffers)
+        except socket.error as e:
+            log.debug('send failed to %r: %s', connection.address, e)
+            self.close_connection(connection.fileno())
+            return
+        if span is not None:
+            span.send += time.time() - started
+            span.pending = connection.output_size
+        if not done:
+            self.poller.watch(connection.fileno(), read=connection.output_size <= connection.OUTPUT_HIGH_WATER,
+                              write=True)
+
+    def resume(self, connection, response):
+        # Send a response that was made elsewhere (see fauxhue_replica)
+        # and carry on with the connection
+        connection.paused = False
+        self.write_response(connection, (response,))
+        if connection.fileno() not in self.connections:
+            return
+        if connection.keep_alive:
+            self.serve_requests(connection)
+        else:
+            self.finish_connection(connection)
+
+    def send_error(self, connection, status):
+        self.send(connection, status + '\n', content_type='text/plain', status=status)
 
     def get_name(self):
         return "unknown"
@@ -237,39 +1076,144 @@ class upnp_device(object):
     def get_protocol(self):
         return self.protocol
 
-    def respond_to_search(self, destination, search_target):
-        dbg("Responding to search for %s" % self.get_name())
-        date_str = email.utils.formatdate(timeval=None, localtime=False, usegmt=True)
+    def search_reply(self, search_target):
+        # Everything apart from the DATE value is fixed for a given
+        # search target, so the reply is rendered once and only
+        # re-assembled when the date string changes.
+        date_str = http_date()
+        reply = self.search_replies.get(search_target)
+        if reply is None:
+            location_url = self.root_url % {'ip_address' : self.ip_address, 'port' : self.port}
+            head = ("HTTP/1.1 200 OK\r\n"
+                    "CACHE-CONTROL: max-age=86400\r\n"
+                    "DATE: ")
+            tail = ("\r\n"
+                    "EXT:\r\n"
+                    "LOCATION: %s\r\n"
+                    "OPT: \"http://schemas.upnp.org/upnp/1/0/\"; ns=01\r\n"
+                    "01-NLS: %s\r\n"
+                    "SERVER: %s\r\n"
+                    "ST: %s\r\n"
+                    "USN: uuid:%s::%s\r\n" % (location_url, self.uuid, self.server_version, search_target, self.persistent_uuid, search_target))
+            if self.other_headers:
+                for header in self.other_headers:
+                    tail += "%s\r\n" % header
+            tail += "\r\n"
+            reply = [head, tail, None, None]
+            self.search_replies[search_target] = reply
+        if reply[2] is not date_str:
+            reply[3] = reply[0] + date_str + reply[1]
+            reply[2] = date_str
+        return reply[3]
+
+    def notify_message(self, target):
+        # ssdp:alive announcement, sent when the device's content changes
         location_url = self.root_url % {'ip_address' : self.ip_address, 'port' : self.port}
-        message = ("HTTP/1.1 200 OK\r\n"
-                  "CACHE-CONTROL: max-age=86400\r\n"
-                  "DATE: %s\r\n"
-                  "EXT:\r\n"
-                  "LOCATION: %s\r\n"
-                  "OPT: \"http://schemas.upnp.org/upnp/1/0/\"; ns=01\r\n"
-                  "01-NLS: %s\r\n"
-                  "SERVER: %s\r\n"
-                  "ST: %s\r\n"
-                  "USN: uuid:%s::%s\r\n" % (date_str, location_url, self.uuid, self.server_version, search_target, self.persistent_uuid, search_target))
+        message = ("NOTIFY * HTTP/1.1\r\n"
+                   "HOST: 239.255.255.250:1900\r\n"
+                   "CACHE-CONTROL: max-age=86400\r\n"
+                   "LOCATION: %s\r\n"
+                   "NT: %s\r\n"
+                   "NTS: ssdp:alive\r\n"
+                   "SERVER: %s\r\n"
+                   "USN: uuid:%s::%s\r\n" % (location_url, target, self.server_version, self.persistent_uuid, target))
         if self.other_headers:
-            for header in self.other_headers:
-                message += "%s\r\n" % header
-        message += "\r\n"
-        temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        temp_socket.sendto(message, destination)
+            message += ''.join("%s\r\n" % header for header in self.other_headers)
+        return message + "\r\n"
+
+    def respond_to_search(self, destination, search_target):
+        log.debug('Responding to search for %s', self.get_name())
+        METRICS.count(METRICS.ssdp_replied, search_target)
+        if METRICS.first_ssdp_reply is None:
+            METRICS.first_ssdp_reply = time.time() - METRICS.started
+            log.info('First SSDP reply %.3fs after start', METRICS.first_ssdp_reply)
+        self.listener.sendto(self.search_reply(search_target), destination)
+
+
+# A light of a fauxhue. There can be thousands, so each one is a slotted
+# object holding only what differs between lights; the rest of the Hue
+# light description (model, software version, pointsymbol table) is a
+# shared JSON fragment, and the JSON of a light is rendered when it is
+# asked for.
+
+class hue_light(object):
+    # the members of the "state" object, in JSON order
+    STATE = ('on', 'bri', 'hue', 'sat', 'xy', 'ct', 'alert', 'effect', 'colormode', 'reachable')
+    __slots__ = STATE + ('name', 'extra', 'private', 'action_handler')
+    XY = [0.0, 0.0]  # shared default, replaced (not modified) on change
+    JSON_TAIL = ('}, "type": "Extended color light", "name": %s, "modelid": "LCT001", "swversion": "65003148", '
+                 '"pointsymbol": {"1": "none", "2": "none", "3": "none", "4": "none", '
+                 '"5": "none", "6": "none", "7": "none", "8": "none"}}')
+
+    def __init__(self, name, on=False, bri=0, private=None, action_handler=None):
+        self.name = name
+        self.on = on
+        self.bri = bri
+        self.hue = 0
+        self.sat = 0
+        self.xy = self.XY
+        self.ct = 0
+        self.alert = 'none'
+        self.effect = 'none'
+        self.colormode = 'hs'
+        self.reachable = True
+        self.extra = None  # any other state settings clients PUT
+        self.private = private  # for the action handler
+        self.action_handler = action_handler
+
+    def has(self, setting):
+        return setting in self.STATE or bool(self.extra) and setting in self.extra
+
+    def get(self, setting, default=None):
+        if setting in self.STATE:
+            return getattr(self, setting)
+        if self.extra:
+            return self.extra.get(setting, default)
+        return default
+
+    def set(self, setting, value):
+        if setting in self.STATE:
+            setattr(self, setting, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[setting] = value
+
+    def state(self):
+        state = dict((setting, getattr(self, setting)) for setting in self.STATE)
+        if self.extra:
+            state.update(self.extra)
+        return state
+
+    def render(self):
+        members = ['"%s": %s' % (setting, json.dumps(getattr(self, setting))) for setting in self.STATE]
+        if self.extra:
+            members.extend('%s: %s' % (json.dumps(setting), json.dumps(value))
+                           for setting, value in sorted(self.extra.items()))
+        return '{"state": {' + ', '.join(members) + self.JSON_TAIL % json.dumps(self.name)
 
 
 # This subclass implements Philips Hue compatibility
 
 class fauxhue(upnp_device):
+    COMMAND_WINDOW = 0.2  # seconds, see queue_command()
+
     @staticmethod
     def make_uuid(name):
         return ''.join(["%x" % sum([ord(c) for c in name])] + ["%x" % ord(c) for c in "%sfauxhue!" % name])[:14]
 
-    def __init__(self, name, listener, huepoller, ip_address, port, action_handler = None):
-        self.lights = {}
-        self.privates = {}
-        self.action_handlers = {}
+    def __init__(self, name, listener, huepoller, ip_address, port, action_handler = None, dispatcher = None):
+        self.lights = {}  # lightnum -> hue_light
+        self.json_cache = {}  # lightnum (None for all lights) -> (json, etag)
+        self.pending_commands = {}  # lightnum -> state changes not yet sent
+        self.last_command = {}  # lightnum -> time the last command was sent
+        self.dispatcher = dispatcher  # None runs handlers inline
+        self.groups = {}  # group id -> {"name": ..., "lights": [lightnum, ...]}
+        self.scenes = {}  # scene id -> {"name": ..., "lights": [lightnum, ...], "lightstates": {lightnum: state}}
+        self.transitions = None  # transition_scheduler, without one fades are left to the handlers
+        self.replicas = None  # worker_pool in worker mode
+        self.journal = None  # state_journal, if the lights are journaled
+        self.reserved = set()  # lightnums kept for journaled lights not registered yet
         self.ip_address = ip_address
         self.serial = self.make_uuid(name)
         self.name = name
@@ -285,106 +1229,573 @@ class fauxhue(upnp_device):
             self.action_handler = action_handler
         else:
             self.action_handler = self
-        dbg("FauxHue device '%s' ready on %s:%s" % (self.name, self.ip_address, self.port))
-
-    def add_bulb (self, name, state=False, brightness=0, private=None, action_handler=None):
-        lightstate = {
-            "state": {
-		"on": state,
-		"bri": brightness,
-		"hue": 0,
-		"sat": 0,
-		"xy": [0.0000, 0.0000],
-		"ct": 0,
-		"alert": "none",
-		"effect": "none",
-		"colormode": "hs",
-		"reachable": True
-	    },
-	    "type": "Extended color light",
-	    "name": name,
-	    "modelid": "LCT001",
-	    "swversion": "65003148",
-	    "pointsymbol": {
-		"1": "none",
-		"2": "none",
-		"3": "none",
-		"4": "none",
-		"5": "none",
-		"6": "none",
-		"7": "none",
-                "8": "none"
-	    }
-        }
-        lightnum = len(self.lights) + 1
-        self.lights[str(lightnum)] = lightstate
-        self.privates[str(lightnum)] = private
-        self.action_handlers[str(lightnum)] = action_handler
-        
+        log.info("FauxHue device '%s' ready on %s:%s", self.name, self.ip_address, self.port)
+
+    def add_bulb (self, name, state=False, brightness=0, private=None, action_handler=None, lightnum=None):
+        if lightnum is None or lightnum in self.lights:
+            lightnum = str(max([0] + [int(num) for num in self.lights] + [int(num) for num in self.reserved]) + 1)
+        self.reserved.discard(lightnum)
+        self.lights[lightnum] = hue_light(name, state, brightness, private, action_handler)
+        self.light_changed(lightnum)
+        return lightnum
+
+    def remove_bulb(self, lightnum):
+        """Stop serving a light, and drop it from groups and scenes"""
+        if self.lights.pop(lightnum, None) is None:
+            return
+        self.pending_commands.pop(lightnum, None)
+        self.last_command.pop(lightnum, None)
+        if self.transitions:
+            self.transitions.cancel(self, lightnum)
+        regrouped = False
+        for group in list(self.groups.values()) + list(self.scenes.values()):
+            if lightnum in group['lights']:
+                group['lights'].remove(lightnum)
+                group.get('lightstates', {}).pop(lightnum, None)
+                regrouped = True
+        self.light_changed(lightnum)
+        if regrouped and self.replicas:
+            self.replicas.groups_changed(self)
+
+    def rename_bulb(self, lightnum, name):
+        light = self.lights[lightnum]
+        if light.name != name:
+            light.name = name
+            self.light_changed(lightnum)
+
+    def light_changed(self, lightnum):
+        # Drop the cached JSON for this light and for the full list
+        self.json_cache.pop(lightnum, None)
+        self.json_cache.pop(None, None)
+        if self.replicas:
+            self.replicas.light_changed(self, lightnum)
+        if self.journal:
+            self.journal.light_changed(self, lightnum)
+
+    def update_state(self, lightnum, changes):
+        """Apply a dict of Hue state values to a light.
+        Returns the previous values of the settings that changed, which
+        is empty (false) if nothing did, or if the light has been removed.
+        """
+        light = self.lights.get(lightnum)
+        previous = {}
+        if light is None:
+            return previous
+        changed = False
+        for setting, value in changes.items():
+            if not light.has(setting):
+                light.set(setting, value)
+                changed = True
+            elif light.get(setting) != value:
+                previous[setting] = light.get(setting)
+                light.set(setting, value)
+                changed = True
+        if changed:
+            self.light_changed(lightnum)
+        return previous
+
+    def cached_json(self, lightnum=None):
+        """Return (json, etag) for one light or, if lightnum is None, for
+        all lights. Serialized once and kept until the light changes.
+        """
+        cached = self.json_cache.get(lightnum)
+        if cached is None:
+            if lightnum is None:
+                # assemble from the per light entries
+                body = '{%s}' % ', '.join('"%s": %s' % (num, self.cached_json(num)[0]) for num in sorted(self.lights, key=int))
+            else:
+                body = self.lights[lightnum].render()
+            cached = (body, '"%s"' % hashlib.md5(body).hexdigest()[:16])
+            self.json_cache[lightnum] = cached
+        return cached
+
+    def send_json(self, connection, request, lightnum=None):
+        body, etag = self.cached_json(lightnum)
+        if_none_match = request.headers.get('IF-NONE-MATCH')
+        if if_none_match and (if_none_match == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]):
+            self.send(connection, '', status='304 Not Modified', headers=['ETAG: %s' % etag])
+        else:
+            self.send(connection, body, headers=['ETAG: %s' % etag])
+
+    def queue_command(self, lightnum, changes, previous=None, transitiontime=None):
+        """Send state changes to the light's action handler. A light is
+        sent at most one command per COMMAND_WINDOW, changes arriving
+        inside the window are merged and only the latest values sent.
+        previous holds the state values the changes replaced, they are
+        restored if the command fails. With a transitiontime the light
+        fades to the new state, see transition_scheduler.
+        """
+        previous = previous or {}
+        if self.fade(lightnum, changes, previous, transitiontime):
+            self.drop_pending(lightnum, changes)
+            return
+        if transitiontime is not None:
+            changes = dict(changes, transitiontime=transitiontime)
+        pending = self.pending_commands.get(lightnum)
+        if pending is not None:
+            pending[0].pop('transitiontime', None)  # only the latest applies
+            pending[0].update(changes)
+            for setting, value in previous.items():
+                pending[1].setdefault(setting, value)
+            return
+        wait = self.last_command.get(lightnum, 0) + self.COMMAND_WINDOW - time.time()
+        if wait <= 0:
+            self.send_command(lightnum, changes, previous)
+        else:
+            self.pending_commands[lightnum] = (dict(changes), dict(previous))
+            self.poller.call_later(wait, self.flush_command, lightnum)
+
+    def fade(self, lightnum, changes, previous, transitiontime):
+        # Hand the changes to the transition scheduler if the light's
+        # handler cannot fade by itself, returns True if it took them
+        if self.transitions is None:
+            return False
+        handler = self.lights[lightnum].action_handler
+        if transitiontime and handler is not None and not handler.native_transitions:
+            if self.transitions.start(self, lightnum, changes, previous, transitiontime / 10.0):
+                self.last_command[lightnum] = time.time()
+                return True
+        self.transitions.cancel(self, lightnum)
+        return False
+
+    def drop_pending(self, lightnum, changes):
+        # changes sent other than through the queue, don't let an older
+        # queued command undo them
+        pending = self.pending_commands.get(lightnum)
+        if pending is not None:
+            for setting in changes:
+                pending[0].pop(setting, None)
+
+    def flush_command(self, lightnum):
+        pending = self.pending_commands.pop(lightnum, None)
+        if pending:
+            self.send_command(lightnum, *pending)
+
+    def send_command(self, lightnum, changes, previous):
+        self.last_command[lightnum] = time.time()
+        light = self.lights[lightnum]
+        action_handler = light.action_handler
+        private = light.private
+        if self.dispatcher:
+            self.dispatcher.submit((self.serial, lightnum), action_handler.apply, (private, changes),
+                                   functools.partial(self.command_done, lightnum, changes, previous),
+                                   label=type(action_handler).__name__)
+        else:
+            self.command_done(lightnum, changes, previous, action_handler.apply(private, changes))
+
+    def command_done(self, lightnum, changes, previous, result):
+        # The PUT was answered before the command ran, so on failure put
+        # back the old values (unless they have been changed again since)
+        # and flag the light as unreachable.
+        light = self.lights.get(lightnum)
+        if light is None:
+            return  # removed in the meantime
+        if result:
+            self.update_state(lightnum, {'reachable': True})
+            return
+        log.warning('Failed to set %r on light %s', changes, lightnum)
+        revert = dict((setting, value) for setting, value in previous.items()
+                      if light.get(setting) == changes.get(setting))
+        revert['reachable'] = False
+        self.update_state(lightnum, revert)
+
+    def group_lights(self, group_id):
+        # Group 0 is every light on the bridge, as on a real Hue
+        if group_id == '0':
+            return sorted(self.lights, key=int)
+        group = self.groups.get(group_id)
+        if group is None:
+            return None
+        return group['lights']
+
+    def group_json(self, group_id):
+        lightnums = self.group_lights(group_id)
+        if group_id == '0':
+            name = 'Lightset 0'
+        else:
+            name = self.groups[group_id]['name']
+        action = {}
+        if lightnums:
+            action = self.lights[lightnums[0]].state()
+            action.pop('reachable', None)
+        return {"name": name, "lights": lightnums, "type": "LightGroup", "action": action}
+
+    def group_action(self, group_id, changes):
+        """Apply changes (which may include a transitiontime) to all
+        lights of a group.
+        """
+        self.apply_states([(lightnum, changes) for lightnum in self.group_lights(group_id)])
+
+    def apply_states(self, targets, transitiontime=None):
+        """Set several lights at once, targets is [(lightnum, changes), ...]
+        (a group action or a scene), changes may include a transitiontime
+        overriding the one given. The state of every light is updated at
+        once, and the lights are sent one apply_each() per handler batch
+        (e.g. one LIFX call per colour, one call per WeMo bridge) rather
+        than a command per light.
+        """
+        batches = {}  # (handler class, batch key) -> (handler, [lightnum], [private], [changes], [previous])
+        now = time.time()
+        for lightnum, changes in targets:
+            changes = dict(changes)
+            light_transitiontime = changes.pop('transitiontime', transitiontime)
+            previous = self.update_state(lightnum, self.with_color_mode(changes))
+            self.drop_pending(lightnum, changes)
+            self.last_command[lightnum] = now
+            handler = self.lights[lightnum].action_handler
+            if handler is None or self.fade(lightnum, changes, previous, light_transitiontime):
+                continue
+            if light_transitiontime is not None:
+                changes['transitiontime'] = light_transitiontime
+            private = self.lights[lightnum].private
+            batch = batches.setdefault((type(handler), handler.batch_key(private)), (handler, [], [], [], []))
+            batch[1].append(lightnum)
+            batch[2].append(private)
+            batch[3].append(changes)
+            batch[4].append(previous)
+        for key, (handler, lightnums, privates, changes, previous) in batches.items():
+            done = functools.partial(self.group_done, lightnums, changes, previous)
+            if self.dispatcher:
+                self.dispatcher.submit((self.serial, 'group') + key, handler.apply_each, (privates, changes), done,
+                                       label=type(handler).__name__)
+            else:
+                done(handler.apply_each(privates, changes))
+
+    def group_done(self, lightnums, changes, previous, result):
+        for lightnum, light_changes, light_previous in zip(lightnums, changes, previous):
+            self.command_done(lightnum, light_changes, light_previous, result)
+
+    @staticmethod
+    def scene_state(state):
+        # What a scene keeps of a light's state. Only the colour settings
+        # of its colormode, recalled with the others (see COLOR_MODES) a
+        # light in ct mode would come back in xy mode.
+        mode = state.pop('colormode', None)
+        state.pop('reachable', None)
+        for setting, setting_mode in COLOR_MODES:
+            if setting_mode != mode:
+                state.pop(setting, None)
+        return state
+
+    @staticmethod
+    def with_color_mode(changes):
+        # the changes for the light's state, with the colormode they set
+        mode = color_mode(changes)
+        if mode is None:
+            return changes
+        return dict(changes, colormode=mode)
+
+    @staticmethod
+    def hue_error(error_type, address, description):
+        return json.dumps([{"error": {"type": error_type, "address": address, "description": description}}])
+
+    # (lowest, highest) value of the numeric settings, each xy coordinate
+    # for xy. NaN and infinity are outside every range.
+    SETTING_RANGES = {
+        'bri': (0, 254),
+        'hue': (0, 65535),
+        'sat': (0, 254),
+        'ct': (153, 500),
+        'xy': (0, 1),
+        'transitiontime': (0, 65535),
+    }
+
+    @classmethod
+    def invalid_setting(cls, command):
+        """The first (setting, value) of a state change that cannot be
+        applied (or faded), None if there is none
+        """
+        def in_range(value, lowest, highest):
+            return isinstance(value, numbers.Real) and not isinstance(value, bool) and lowest <= value <= highest
+
+        for setting, value in sorted(command.items()):
+            if setting == 'on':
+                valid = isinstance(value, bool)
+            elif setting == 'transitiontime':
+                valid = isinstance(value, numbers.Integral) and in_range(value, *cls.SETTING_RANGES[setting])
+            elif setting == 'xy':
+                valid = isinstance(value, list) and len(value) == 2 and all(
+                    in_range(v, *cls.SETTING_RANGES[setting]) for v in value)
+            elif setting in cls.SETTING_RANGES:
+                valid = in_range(value, *cls.SETTING_RANGES[setting])
+            else:
+                valid = True
+            if not valid:
+                return setting, value
+        return None
+
+    def read_state(self, connection, request, address):
+        # Returns a state change body, or None after sending an error
+        command = self.read_json(connection, request, address)
+        if command is None:
+            return None
+        invalid = self.invalid_setting(command)
+        if invalid:
+            setting, value = invalid
+            self.send(connection, self.hue_error(7, "%s/%s" % (address, setting),
+                                                 "invalid value, %s, for parameter, %s" % (json.dumps(value), setting)))
+            return None
+        return command
+
+    def send_unknown_light(self, connection, lightnum, address):
+        self.send(connection, self.hue_error(3, address, "resource, /lights/%s, not available" % lightnum))
+
+    def read_json(self, connection, request, address):
+        # Returns the decoded request body (an object), or None after
+        # sending an error
+        try:
+            command = json.loads(request.body)
+        except ValueError:
+            command = None
+        if not isinstance(command, dict):
+            self.send(connection, self.hue_error(2, address, "body contains invalid json"))
+            return None
+        return command
+
+    def read_lights(self, connection, command, address):
+        # The "lights" of a group or scene body, a list of known light
+        # numbers, or None after sending an error
+        lights = command.get('lights', [])
+        if not isinstance(lights, list) or not all(isinstance(lightnum, string_types) for lightnum in lights):
+            self.send(connection, self.hue_error(7, address + "/lights",
+                                                 "invalid value, %s, for parameter, lights" % json.dumps(lights)))
+            return None
+        unknown = [lightnum for lightnum in lights if lightnum not in self.lights]
+        if unknown:
+            self.send(connection, self.hue_error(3, address + "/lights", "resource, /lights/%s, not available" % unknown[0]))
+            return None
+        return [str(lightnum) for lightnum in lights]
+
+    def handle_groups(self, request, requestdata, connection):
+        # /api/<user>/groups[/<id>[/action]]
+        if len(requestdata) == 4:
+            if request.method == 'GET':
+                groups = dict((group_id, self.group_json(group_id)) for group_id in self.groups)
+                self.send(connection, json.dumps(groups))
+            elif request.method == 'POST':
+                command = self.read_json(connection, request, "/groups")
+                if command is None:
+                    return
+                lights = self.read_lights(connection, command, "/groups")
+                if lights is None:
+                    return
+                group_id = str(max([0] + [int(group_id) for group_id in self.groups]) + 1)
+                self.groups[group_id] = {"name": command.get('name', 'Group %s' % group_id), "lights": lights}
+                self.send(connection, json.dumps([{"success": {"id": group_id}}]))
+            else:
+                self.send_error(connection, '405 Method Not Allowed')
+            return
+        group_id = requestdata[4]
+        address = "/groups/%s" % group_id
+        if self.group_lights(group_id) is None:
+            self.send(connection, self.hue_error(3, address, "resource, %s, not available" % address))
+            return
+        if len(requestdata) == 5 and request.method == 'GET':
+            self.send(connection, json.dumps(self.group_json(group_id)))
+        elif len(requestdata) == 5 and request.method == 'DELETE' and group_id != '0':
+            del self.groups[group_id]
+            self.send(connection, json.dumps([{"success": "%s deleted" % address}]))
+        elif len(requestdata) == 5 and request.method == 'PUT' and group_id != '0':
+            command = self.read_json(connection, request, address)
+            if command is None:
+                return
+            lights = None
+            if 'lights' in command:
+                lights = self.read_lights(connection, command, address)
+                if lights is None:
+                    return
+            responses = []
+            if 'name' in command:
+                self.groups[group_id]['name'] = command['name']
+                responses.append({"success": {"%s/name" % address: command['name']}})
+            if lights is not None:
+                self.groups[group_id]['lights'] = lights
+                responses.append({"success": {"%s/lights" % address: lights}})
+            self.send(connection, json.dumps(responses))
+        elif len(requestdata) == 6 and requestdata[5] == 'action' and request.method == 'PUT':
+            command = self.read_state(connection, request, address + "/action")
+            if command is None:
+                return
+            scene = None
+            if 'scene' in command:
+                if isinstance(command['scene'], string_types):
+                    scene = self.scenes.get(command['scene'])
+                if scene is None:
+                    self.send(connection, self.hue_error(7, address + "/action/scene",
+                                                         "invalid value, %s, for parameter, scene" % json.dumps(command['scene'])))
+                    return
+            responses = []
+            for setting in command.keys():
+                apistring = "%s/action/%s" % (address, setting)
+                responses.append({"success":{apistring : command[setting]}})
+            if scene:
+                # recall the scene for the lights it has in this group
+                members = set(self.group_lights(group_id))
+                self.apply_states([(lightnum, state) for lightnum, state in sorted(scene['lightstates'].items())
+                                   if lightnum in members and lightnum in self.lights],
+                                  command.get('transitiontime'))
+            else:
+                self.group_action(group_id, command)
+            self.send(connection, json.dumps(responses))
+        else:
+            self.send_error(connection, '404 Not Found')
+
+    def scene_json(self, scene_id, lightstates=False):
+        scene = self.scenes[scene_id]
+        result = {"name": scene['name'], "lights": scene['lights'], "owner": "ulfire", "recycle": False,
+                  "locked": False, "appdata": {}, "picture": "", "lastupdated": None, "version": 2}
+        if lightstates:
+            result['lightstates'] = scene['lightstates']
+        return result
+
+    def handle_scenes(self, request, requestdata, connection):
+        # /api/<user>/scenes[/<id>[/lightstates/<lightnum>]]
+        if len(requestdata) == 4:
+            if request.method == 'GET':
+                self.send(connection, json.dumps(dict((scene_id, self.scene_json(scene_id)) for scene_id in self.scenes)))
+            elif request.method == 'POST':
+                command = self.read_json(connection, request, "/scenes")
+                if command is None:
+                    return
+                lights = self.read_lights(connection, command, "/scenes")
+                if lights is None:
+                    return
+                given = command.get('lightstates', {})
+                if not isinstance(given, dict) or not all(isinstance(lightstate, dict) and not self.invalid_setting(lightstate)
+                                                          for lightstate in given.values()):
+                    self.send(connection, self.hue_error(7, "/scenes/lightstates",
+                                                         "invalid value, %s, for parameter, lightstates" % json.dumps(given)))
+                    return
+                # the lights' current state, unless the states are given
+                lightstates = dict((lightnum, self.scene_state(self.lights[lightnum].state())) for lightnum in lights)
+                for lightnum, lightstate in given.items():
+                    if str(lightnum) in lightstates:
+                        lightstates[str(lightnum)] = lightstate
+                scene_id = str(max([0] + [int(scene_id) for scene_id in self.scenes if scene_id.isdigit()]) + 1)
+                self.scenes[scene_id] = {"name": command.get('name', 'Scene %s' % scene_id), "lights": lights,
+                                         "lightstates": lightstates}
+                self.send(connection, json.dumps([{"success": {"id": scene_id}}]))
+            else:
+                self.send_error(connection, '405 Method Not Allowed')
+            return
+        scene_id = requestdata[4]
+        address = "/scenes/%s" % scene_id
+        scene = self.scenes.get(scene_id)
+        if scene is None:
+            self.send(connection, self.hue_error(3, address, "resource, %s, not available" % address))
+            return
+        if len(requestdata) == 5 and request.method == 'GET':
+            self.send(connection, json.dumps(self.scene_json(scene_id, lightstates=True)))
+        elif len(requestdata) == 5 and request.method == 'DELETE':
+            del self.scenes[scene_id]
+            self.send(connection, json.dumps([{"success": "%s deleted" % address}]))
+        elif len(requestdata) == 5 and request.method == 'PUT':
+            command = self.read_json(connection, request, address)
+            if command is None:
+                return
+            responses = []
+            if 'name' in command:
+                scene['name'] = command['name']
+                responses.append({"success": {"%s/name" % address: command['name']}})
+            self.send(connection, json.dumps(responses))
+        elif len(requestdata) == 7 and requestdata[5] == 'lightstates' and request.method == 'PUT':
+            lightnum = requestdata[6]
+            address = "%s/lightstates/%s" % (address, lightnum)
+            if lightnum not in scene['lightstates']:
+                self.send(connection, self.hue_error(3, address, "resource, %s, not available" % address))
+                return
+            command = self.read_state(connection, request, address)
+            if command is None:
+                return
+            scene['lightstates'][lightnum].update(command)
+            self.send(connection, json.dumps([{"success": {"%s/%s" % (address, setting): value}}
+                                              for setting, value in command.items()]))
+        else:
+            self.send_error(connection, '404 Not Found')
+
+    def handle_debug(self, requestdata, connection):
+        # GET /debug/profile/<seconds>, see profile_capture
+        if not PROFILER.endpoint or len(requestdata) != 4 or requestdata[2] != 'profile':
+            self.send_error(connection, '404 Not Found')
+            return
+        try:
+            seconds = float(requestdata[3])
+        except ValueError:
+            seconds = 0
+        if not 0 < seconds <= PROFILER.MAX_SECONDS:
+            self.send_error(connection, '400 Bad Request')
+            return
+        filename = PROFILER.start(seconds, self.poller)
+        if filename is None:
+            self.send_error(connection, '409 Conflict')
+            return
+        self.send(connection, json.dumps({'profile': filename, 'seconds': seconds, 'pid': os.getpid()}))
+
     def get_name(self):
         return self.name
 
-    def send(self, msg_socket, data, content_type='application/json'):
-        # FIXME does not handle clients that disconnect prematurely
-        # FIXME respond to / root requests, include html with link to /api/username/lights ?
-        dbg('send %r' % (data,))
-        date_str = email.utils.formatdate(timeval=None, localtime=False, usegmt=True)
-        message = ("HTTP/1.1 200 OK\r\n"
-                   "CONTENT-LENGTH: %d\r\n"
-                   "CONTENT-TYPE: %s\r\n"
-                   "DATE: %s\r\n"
-                   "LAST-MODIFIED: Sat, 01 Jan 2000 00:01:15 GMT\r\n"
-                   "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
-                   "X-User-Agent: redsonic\r\n"
-                   "CONNECTION: close\r\n"
-                   "\r\n"
-                   "%s" % (len(data), content_type, date_str, data))
-        msg_socket.send(message)
-
-    def handle_request(self, data, sender, msg_socket):
-        tokens = data.split()
-        if len(tokens) < 3 or tokens[2] != 'HTTP/1.1':
-            dbg("Unknown request %s\n" % data)
-            return
-        requestdata = tokens[1].split('/')
-        if tokens[0] == 'GET':
-            if requestdata[1] == 'description.xml':
-                dbg("Responding to description.xml for %s" % self.name)
-                xml = HUE_SETUP_XML % {'host' : self.ip_address, 'port' : self.port}
-                self.send(msg_socket, xml, content_type='text/xml')
+    def handle_request(self, request, sender, connection):
+        requestdata = request.path.split('/')
+        if len(requestdata) < 2:
+            log.debug('Unknown request %s %s', request.method, request.path)
+            self.send_error(connection, '404 Not Found')
+            return
+        if len(requestdata) >= 4 and requestdata[3] in ('groups', 'scenes'):
+            request.route = 'groups'
+            if requestdata[3] == 'groups':
+                self.handle_groups(request, requestdata, connection)
+            else:
+                self.handle_scenes(request, requestdata, connection)
+            if self.replicas and request.method != 'GET':
+                self.replicas.groups_changed(self)
+        elif request.method == 'GET':
+            if requestdata[1] == 'metrics':
+                request.route = 'metrics'
+                self.send(connection, METRICS.render(self.listener.devices, self.dispatcher),
+                          content_type='text/plain; version=0.0.4')
+            elif requestdata[1] == 'debug':
+                request.route = 'debug'
+                self.handle_debug(requestdata, connection)
+            elif requestdata[1] == 'description.xml':
+                request.route = 'description.xml'
+                log.debug('Responding to description.xml for %s', self.name)
+                xml = HUE_SETUP_XML % {'host' : self.ip_address, 'port' : self.port, 'serial' : self.serial, 'uuid' : self.persistent_uuid}
+                self.send(connection, xml, content_type='text/xml')
             elif len(requestdata) == 4 and requestdata[3] == 'lights':
-                data = json.dumps(self.lights)
-                self.send(msg_socket, data)
+                request.route = 'lights'
+                self.send_json(connection, request)
             elif len(requestdata) >= 5 and requestdata[3] == 'lights':
-                data = json.dumps(self.lights[requestdata[4]])  # FIXME fails if unknown light
-                self.send(msg_socket, data)
-        elif tokens[0] == 'PUT':
+                request.route = 'light'
+                if requestdata[4] in self.lights:
+                    self.send_json(connection, request, requestdata[4])
+                else:
+                    self.send_unknown_light(connection, requestdata[4], "/lights/%s" % requestdata[4])
+            else:
+                self.send_error(connection, '404 Not Found')
+        elif request.method == 'PUT':
             if len(requestdata) >= 5 and requestdata[3] == 'lights':
+                request.route = 'state'
                 lightnum = requestdata[4]
-                dbg('handle_request raw payload %r' % (data,))  # seeing: 'PUT /api/nouser/lights/1/state HTTP/1.1\r\nHost: XXX.XXX.XXX.XXX:PPPPP\r\nUser-Agent: curl/7.68.0\r\nAccept: application/json\r\nContent-Length: 12\r\nContent-Type: application/x-www-form-urlencoded\r\n\r\n{"on": true}'
-                #import pdb ; pdb.set_trace()
-                #submission = data.split('\n')[6]  # FIXME WTF?
-                submission = data.split('\n')[-1]  # FIXME WTF? - sucks less than previous...
-                dbg('handle_request payload %r' % (submission,))  # seeing '\r'
-                command = json.loads(submission)  # FIXME does not handle json
+                log.debug('handle_request payload %r', request.body)
+                if lightnum not in self.lights:
+                    self.send_unknown_light(connection, lightnum, "/lights/%s/state" % lightnum)
+                    return
+                command = self.read_state(connection, request, "/lights/%s/state" % lightnum)
+                if command is None:
+                    return
                 responses = []
                 for setting in command.keys():
-                    value = command[setting]
-                    private = self.privates[lightnum]
-                    self.lights[lightnum]['state'][setting] = value
-                    action_handler = self.action_handlers[lightnum]
-                    if setting == "on":
-                        if value == True:
-                            action_handler.on(private)
-                        elif value == False:
-                            action_handler.off(private)
-                    elif setting == "bri":
-                        action_handler.dim(private, value)
                     apistring = "/lights/%s/state/%s" % (lightnum, setting)
                     responses.append({"success":{apistring : command[setting]}})
-                self.send(msg_socket, json.dumps(responses))
+                transitiontime = command.pop('transitiontime', None)  # how to get there, not state
+                previous = self.update_state(lightnum, self.with_color_mode(command))
+                self.queue_command(lightnum, command, previous, transitiontime)
+                self.send(connection, json.dumps(responses))
+            else:
+                self.send_error(connection, '404 Not Found')
         else:
-            dbg("Unknown request: %s" % data)
+            log.debug('Unknown request: %s %s', request.method, request.path)
+            self.send_error(connection, '405 Method Not Allowed')
 
     def on(self):
         return False
@@ -393,20 +1804,316 @@ class fauxhue(upnp_device):
         return True
 
 
+# The device registry. Every light has a key that identifies the device,
+# ('lifx', mac), ('wemo', bridge, light) or ('switch', id), backend
+# first. The registry maps the keys to where the lights are served,
+# (fauxhue, lightnum), and indexes them by backend, so nothing has to
+# go through the shards to find a light. The name a light is served
+# under is the one from its backend (or the device config) unless the
+# config renames it, both are kept.
+
+class device_registry(object):
+    def __init__(self):
+        self.devices = {}  # key -> (fauxhue, lightnum)
+        self.names = {}  # key -> name served
+        self.given_names = {}  # key -> name from the backend or config
+        self.by_backend = {}  # backend -> set of keys
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __contains__(self, key):
+        return key in self.devices
+
+    def __iter__(self):
+        return iter(list(self.devices))
+
+    def get(self, key):
+        """(fauxhue, lightnum) of a device, None if it is not registered"""
+        return self.devices.get(key)
+
+    def backend(self, backend):
+        """The keys of a backend's devices ('lifx', 'wemo', 'switch')"""
+        return set(self.by_backend.get(backend, ()))
+
+    def add(self, key, hue, lightnum, name, given_name):
+        self.devices[key] = (hue, lightnum)
+        self.names[key] = name
+        self.given_names[key] = given_name
+        self.by_backend.setdefault(key[0], set()).add(key)
+
+    def set_name(self, key, name):
+        self.names[key] = name
+
+    def remove(self, key):
+        placed = self.devices.pop(key, None)
+        if placed is None:
+            return None
+        del self.names[key]
+        del self.given_names[key]
+        self.by_backend[key[0]].discard(key)
+        return placed
+
+
+# Hue clients fetch (and we serialize) the whole light list of a bridge
+# on every poll, and a real bridge only holds so many lights. So the
+# lights are spread over as many fauxhue instances as needed, up to
+# max_lights each. Every shard looks like a separate bridge to the
+# clients, with its own port and serial. Lights are referred to by
+# (fauxhue, lightnum) pairs as returned by add_bulb(). With a journal,
+# lights added with a key go back to the bridge and number they had.
+# Lights added with a key are in the registry, and can be renamed and
+# removed by key.
+
+class fauxhue_shards(object):
+    MAX_LIGHTS = 50
+
+    def __init__(self, name, listener, poller, ip_address = None, dispatcher = None, max_lights = None, replicas = None,
+                 journal = None, transitions = None):
+        self.name = name
+        self.replicas = replicas
+        self.journal = journal
+        self.transitions = transitions
+        self.listener = listener
+        self.poller = poller
+        self.ip_address = ip_address
+        self.dispatcher = dispatcher
+        self.max_lights = max_lights or self.MAX_LIGHTS
+        self.shards = []
+        self.registry = device_registry()
+        self.names = {}  # key -> name, renames from the device config
+        if journal:
+            # keep the numbers of the journaled lights free for them
+            for bridge, lightnum in journal.placements():
+                self.shard_at(bridge).reserved.add(lightnum)
+
+    def __iter__(self):
+        return iter(self.shards)
+
+    def shard(self):
+        # first shard with room, a new one if they are all full
+        for hue in self.shards:
+            if len(hue.lights) + len(hue.reserved) < self.max_lights:
+                return hue
+        return self.new_shard()
+
+    def shard_at(self, index):
+        while len(self.shards) <= index:
+            self.new_shard()
+        return self.shards[index]
+
+    def new_shard(self):
+        if self.shards:
+            name = '%s %d' % (self.name, len(self.shards) + 1)
+        else:
+            name = self.name  # keep the serial of the original single bridge
+        hue = fauxhue(name, self.listener, self.poller, self.ip_address, 0, dispatcher=self.dispatcher)
+        self.shards.append(hue)
+        hue.journal = self.journal
+        hue.transitions = self.transitions
+        if self.replicas:
+            hue.replicas = self.replicas
+            self.replicas.bridge_added(hue)
+        return hue
+
+    def add_bulb(self, name, key=None, **kwargs):
+        """key identifies the device, in the registry and across restarts
+        (for the journal)
+        """
+        given_name = name
+        if key is not None:
+            name = self.names.get(key, name)
+        placement = key is not None and self.journal and self.journal.placement(key)
+        if placement:
+            bridge, lightnum, state = placement
+            hue = self.shard_at(bridge)
+            lightnum = hue.add_bulb(name, lightnum=lightnum, **kwargs)
+            hue.update_state(lightnum, state)  # the last known state, newer than the cache
+        else:
+            hue = self.shard()
+            lightnum = hue.add_bulb(name, **kwargs)
+        if key is not None:
+            self.registry.add(key, hue, lightnum, name, given_name)
+            if self.journal:
+                self.journal.assign(key, hue, self.shards.index(hue), lightnum)
+        return hue, lightnum
+
+    def remove_bulb(self, key):
+        """Remove a device, returns the fauxhue it was on (None if it was
+        not registered). It gets a new light number if it comes back.
+        """
+        placed = self.registry.remove(key)
+        if placed is None:
+            return None
+        hue, lightnum = placed
+        if self.journal:
+            self.journal.forget(hue, lightnum)
+        hue.remove_bulb(lightnum)
+        return hue
+
+    def rename_bulb(self, key, given_name=None):
+        """Serve a device under its name from the config, or given_name
+        (its own name, if not None) otherwise. Returns the fauxhue if the
+        name changed.
+        """
+        placed = self.registry.get(key)
+        if placed is None:
+            return None
+        if given_name is not None:
+            self.registry.given_names[key] = given_name
+        name = self.names.get(key, self.registry.given_names[key])
+        if self.registry.names[key] == name:
+            return None
+        hue, lightnum = placed
+        self.registry.set_name(key, name)
+        hue.rename_bulb(lightnum, name)
+        return hue
+
+
+# Transitions. Hue clients ask for fades with "transitiontime" (in
+# 100 ms steps, HUE_TRANSITIONTIME when not given). Handlers with
+# native_transitions (LIFX) get it along with the command and leave the
+# fading to the bulb. The lights of the other handlers (WeMo, whose
+# SetDeviceStatus takes a plain level) are stepped by the
+# transition_scheduler: every STEP seconds, on a poller timer, the
+# in-between values of all the lights in transition are worked out and
+# sent with one dispatcher job per handler batch (e.g. per WeMo bridge),
+# so fading a scene of 30 lights costs a job per bridge per step rather
+# than one per light. A batch still busy with the previous step is left
+# out of a tick, its lights catch up on the next one.
+
+HUE_TRANSITIONTIME = 4
+
+
+class transition_scheduler(object):
+    STEP = 0.5  # seconds
+    STEPPED = ('bri', 'hue', 'sat', 'ct')  # the settings faded, others change at the end
+
+    def __init__(self, poller, dispatcher=None):
+        self.poller = poller
+        self.dispatcher = dispatcher
+        self.transitions = {}  # (fauxhue, lightnum) -> (start time, seconds, start values, target changes)
+        self.busy = set()  # batches with a step in flight
+        self.timer = None
+
+    @staticmethod
+    def value_at(transition, setting, now):
+        started, seconds, begin, target = transition
+        if setting not in begin:
+            return target[setting]
+        fraction = min(1.0, (now - started) / seconds)
+        return int(round(begin[setting] + (target[setting] - begin[setting]) * fraction))
+
+    def start(self, hue, lightnum, changes, previous, seconds):
+        """Fade a light to changes over seconds, previous holds the values
+        changes replaced (as returned by fauxhue.update_state()). Returns
+        False if there is nothing to fade, the changes should be sent
+        straight away then.
+        """
+        now = time.time()
+        running = self.transitions.pop((hue, lightnum), None)
+        begin = {}
+        for setting in self.STEPPED:
+            if setting not in changes:
+                continue
+            if running and setting in running[3]:
+                value = self.value_at(running, setting, now)  # where the light is now
+            else:
+                value = previous.get(setting, changes[setting])
+            if isinstance(value, numbers.Real) and value != changes[setting]:
+                begin[setting] = value
+        if not begin or seconds <= 0:
+            return False
+        self.transitions[(hue, lightnum)] = (now, seconds, begin, dict(changes))
+        if self.timer is None:
+            self.timer = self.poller.call_later(0, self.tick)  # first step right away
+        return True
+
+    def cancel(self, hue, lightnum):
+        self.transitions.pop((hue, lightnum), None)
+
+    def tick(self):
+        self.timer = None
+        now = time.time()
+        batches = {}  # (handler class, batch key) -> (handler, [(fauxhue, lightnum)], [private], [changes])
+        for key, transition in list(self.transitions.items()):
+            hue, lightnum = key
+            light = hue.lights.get(lightnum)
+            if light is None or light.action_handler is None:
+                del self.transitions[key]
+                continue
+            handler = light.action_handler
+            batch_key = (type(handler), handler.batch_key(light.private))
+            if batch_key in self.busy:
+                continue
+            if now - transition[0] >= transition[1]:
+                changes = transition[3]  # the end, with the settings that are not faded
+                del self.transitions[key]
+            else:
+                changes = dict((setting, self.value_at(transition, setting, now)) for setting in transition[2])
+                if transition[3].get('on') == True:
+                    changes['on'] = True
+            hue.last_command[lightnum] = now  # keep state_sync off it
+            batch = batches.setdefault(batch_key, (handler, [], [], []))
+            batch[1].append(key)
+            batch[2].append(light.private)
+            batch[3].append(changes)
+        for batch_key, (handler, lights, privates, changes) in batches.items():
+            self.busy.add(batch_key)
+            done = functools.partial(self.stepped, batch_key, lights, changes)
+            if self.dispatcher:
+                self.dispatcher.submit(('transition',) + batch_key, handler.apply_each, (privates, changes), done,
+                                       label=type(handler).__name__)
+            else:
+                done(handler.apply_each(privates, changes))
+        if self.transitions and self.timer is None:
+            self.timer = self.poller.call_later(self.STEP, self.tick)
+
+    def stepped(self, batch_key, lights, changes, result):
+        self.busy.discard(batch_key)
+        if result:
+            return
+        for (hue, lightnum), light_changes in zip(lights, changes):
+            self.cancel(hue, lightnum)
+            if lightnum in hue.lights:
+                hue.command_done(lightnum, light_changes, {}, False)
+
+
 # Since we have a single process managing several virtual UPnP devices,
 # we only need a single listener for UPnP broadcasts. When a matching
 # search is received, it causes each device instance to respond.
 #
-# Note that this is currently hard-coded to recognize only the search
-# from the Amazon Echo for WeMo devices. In particular, it does not
-# support the more common root device general search. The Echo
-# doesn't search for root devices.
+# Besides the device specific searches sent by the Amazon Echo, the
+# general upnp:rootdevice and ssdp:all searches are answered by every
+# device. Repeats of the same search from the same sender inside
+# SEARCH_TTL seconds (the Echo sends them in bursts) are dropped.
 
 class upnp_broadcast_responder(object):
     TIMEOUT = 0
-
-    def __init__(self):
+    MAX_MX = 5  # UPnP 1.0: MX values above 5 should be treated as 5
+    MULTICAST = ('239.255.255.250', 1900)
+    SEARCH_TTL = 1.0
+
+    # Search target as sent by each device protocol
+    PROTOCOL_TARGETS = {
+        'wemo': 'urn:Belkin:device:**',
+        'hue': 'urn:schemas-upnp-org:device:basic:1',
+    }
+
+    # Lower case search target -> protocol, None matches all devices
+    SEARCH_TARGETS = {
+        'urn:belkin:device:**': 'wemo',
+        'urn:schemas-upnp-org:device:basic:1': 'hue',
+        'upnp:rootdevice': None,
+        'ssdp:all': None,
+    }
+
+    def __init__(self, poller):
         self.devices = []
+        self.devices_by_protocol = {}
+        self.poller = poller
+        self.rsock = None
+        self.recent_searches = {}
 
     def init_socket(self):
         ok = True
@@ -425,41 +2132,106 @@ class upnp_broadcast_responder(object):
             try:
                 self.ssock.bind(('', self.port))
             except Exception as e:
-                dbg("WARNING: Failed to bind %s:%d: %s", (self.ip, self.port,
-                                                          e))
+                log.warning('Failed to bind %s:%d: %s', self.ip, self.port, e)
                 ok = False
 
             try:
                 self.ssock.setsockopt(socket.IPPROTO_IP,
                                       socket.IP_ADD_MEMBERSHIP, self.mreq)
             except Exception as e:
-                dbg('WARNING: Failed to join multicast group:', e)  # FIXME could be log.error('Error demo', exc_info=1)  # include traceback
+                log.warning('Failed to join multicast group: %s', e)
                 ok = False
 
+            # Single long lived socket for unicast search replies
+            self.rsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.rsock.setblocking(0)
+
         except Exception as e:
-            dbg("Failed to initialize UPnP sockets:", e)  # FIXME could be log.error('Error demo', exc_info=1)  # include traceback
+            log.error('Failed to initialize UPnP sockets', exc_info=True)
             return False
         if ok:
-            dbg("Listening for UPnP broadcasts")
+            log.info('Listening for UPnP broadcasts')
 
     def fileno(self):
         return self.ssock.fileno()
 
     def do_read(self, fileno):
         data, sender = self.recvfrom(1024)
-        if data:
-            if data.find('M-SEARCH') == 0 and data.find('urn:Belkin:device:**') != -1:
-                for device in self.devices:
-                    if device.get_protocol() == "wemo":
-                        time.sleep(0.1)
-                        device.respond_to_search(sender, 'urn:Belkin:device:**')
-            elif data.find('M-SEARCH') == 0 and data.find('urn:schemas-upnp-org:device:basic:1') != -1:
-                for device in self.devices:
-                    if device.get_protocol() == "hue":
-                        time.sleep(0.1)
-                        device.respond_to_search(sender, 'urn:schemas-upnp-org:device:basic:1')
+        if data and data.find('M-SEARCH') == 0:
+            headers = self.parse_headers(data)
+            search_target = headers.get('ST', '').lower()
+            if search_target in self.SEARCH_TARGETS:
+                METRICS.count(METRICS.ssdp_received, search_target)
+                if self.is_duplicate(sender, search_target):
+                    METRICS.count(METRICS.ssdp_suppressed, search_target)
+                    log.debug('Ignoring repeated search for %s from %r', search_target, sender)
+                else:
+                    self.schedule_responses(headers, sender, search_target)
+
+    @staticmethod
+    def parse_headers(data):
+        headers = {}
+        for line in data.split('\n')[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().upper()] = value.strip()
+        return headers
+
+    def get_mx(self, headers):
+        # MX header, maximum seconds the searcher is willing to wait
+        try:
+            return max(0, min(int(headers.get('MX', 1)), self.MAX_MX))
+        except ValueError:
+            return 1
+
+    def is_duplicate(self, sender, search_target):
+        now = time.time()
+        key = (sender, search_target)
+        if self.recent_searches.get(key, 0) > now:
+            return True
+        if len(self.recent_searches) > 256:
+            for old_key, expires in list(self.recent_searches.items()):
+                if expires <= now:
+                    del self.recent_searches[old_key]
+        self.recent_searches[key] = now + self.SEARCH_TTL
+        return False
+
+    def schedule_responses(self, headers, sender, search_target):
+        # Spread the replies over the MX window as per the UPnP spec
+        # rather than answering back to back
+        mx = self.get_mx(headers)
+        protocol = self.SEARCH_TARGETS[search_target]
+        if protocol is None:
+            devices = self.devices
+        else:
+            devices = self.devices_by_protocol.get(protocol, ())
+        for device in devices:
+            if protocol is None:
+                reply_targets = ['upnp:rootdevice']
+                device_protocol = device.get_protocol()
+                if search_target == 'ssdp:all' and device_protocol in self.PROTOCOL_TARGETS:
+                    reply_targets.append(self.PROTOCOL_TARGETS[device_protocol])
             else:
-                pass
+                reply_targets = [self.PROTOCOL_TARGETS[protocol]]
+            for reply_target in reply_targets:
+                delay = random.uniform(0, mx)
+                self.poller.call_later(delay, device.respond_to_search, sender, reply_target)
+
+    def announce(self, device):
+        """Multicast ssdp:alive for a device, e.g. after its lights changed"""
+        if self.rsock is None:
+            return  # not listening
+        targets = ['upnp:rootdevice']
+        if device.get_protocol() in self.PROTOCOL_TARGETS:
+            targets.append(self.PROTOCOL_TARGETS[device.get_protocol()])
+        for target in targets:
+            self.sendto(device.notify_message(target), self.MULTICAST)
+
+    def sendto(self, message, destination):
+        try:
+            self.rsock.sendto(message, destination)
+        except socket.error as e:
+            log.warning('Failed to send SSDP message to %r: %s', destination, e)
 
     #Receive network data
     def recvfrom(self, size):
@@ -476,19 +2248,277 @@ class upnp_broadcast_responder(object):
             else:
                 return False, False
         except Exception as e:
-            dbg(e)  # FIXME could be log.error('Error demo', exc_info=1)  # include traceback
+            log.warning('SSDP receive failed', exc_info=True)
             return False, False
 
     def add_device(self, device):
         self.devices.append(device)
-        dbg("UPnP broadcast listener: new device registered")
+        self.devices_by_protocol.setdefault(device.get_protocol(), []).append(device)
+        log.debug('UPnP broadcast listener: new device registered')
 
 
-# FIXME generic class, which wemo_api_handler and lifx_api_handler inherit from
 # FIXME pep8 fix wemo_api_handler and lifx_api_handler
 # FIXME no get state API
 
-class DebugPrintAPIhandler(object):
+# Colour conversion between the Hue colour settings and the bulbs. Hue
+# clients set a colour as xy (CIE 1931), ct (mireds) or hue/sat; LIFX
+# bulbs take HSBK (hue, saturation, brightness, kelvin). hue, sat and ct
+# only need scaling, xy is converted following the Philips "RGB to xy"
+# notes: clamped to the lamp gamut, through XYZ to wide gamut RGB, then
+# to hue/saturation (and the same way back for the state read from the
+# bulbs).
+#
+# With NumPy installed, batches of NUMPY_MIN_BATCH or more colours (a
+# scene or group over many bulbs) are converted in one go, by indexing
+# lookup tables computed for the whole xy plane and hue/sat range the
+# first time they are needed. Without it, or for fewer colours, each is
+# converted in pure Python.
+
+class color_converter(object):
+    GAMUT = ((0.6915, 0.3083), (0.17, 0.7), (0.1532, 0.0475))  # red, green, blue corners (Philips gamut C)
+    WHITE = [0.3127, 0.329]  # D65
+    MIN_MIRED = 153
+    MAX_MIRED = 500
+    MIN_KELVIN = 2500  # LIFX range
+    MAX_KELVIN = 9000
+    XY_STEPS = 512  # xy table: points per axis over 0..1
+    HUE_STEPS = 1024  # hue/sat table: hue steps (sat has all 255 values)
+    NUMPY_MIN_BATCH = 16
+
+    def __init__(self, use_numpy=True):
+        self.numpy = use_numpy and numpy or None
+        self.xy_table = None  # (hue, sat) arrays indexed by [x step, y step]
+        self.hs_table = None  # xy array indexed by [hue step, sat]
+
+    def mired_to_kelvin(self, ct):
+        ct = min(max(ct, self.MIN_MIRED), self.MAX_MIRED)
+        return min(max(int(round(1000000.0 / ct)), self.MIN_KELVIN), self.MAX_KELVIN)
+
+    def kelvin_to_mired(self, kelvin):
+        if not kelvin:
+            return self.MIN_MIRED
+        return min(max(int(round(1000000.0 / kelvin)), self.MIN_MIRED), self.MAX_MIRED)
+
+    def xy_to_hue_sat(self, xys):
+        """[(hue 0-65535, sat 0-254), ...] of a list of [x, y]"""
+        if self.numpy is not None and len(xys) >= self.NUMPY_MIN_BATCH:
+            return self.numpy_xy_to_hue_sat(xys)
+        return [self.python_xy_to_hue_sat(x, y) for x, y in xys]
+
+    def hue_sat_to_xy(self, hue_sats):
+        """[[x, y], ...] of a list of (hue 0-65535, sat 0-254)"""
+        if self.numpy is not None and len(hue_sats) >= self.NUMPY_MIN_BATCH:
+            return self.numpy_hue_sat_to_xy(hue_sats)
+        return [self.python_hue_sat_to_xy(hue, sat) for hue, sat in hue_sats]
+
+    # Pure Python, one colour at a time
+
+    def in_gamut(self, x, y):
+        # (x, y), or the closest point of the gamut triangle if outside
+        (rx, ry), (gx, gy), (bx, by) = self.GAMUT
+        def side(ax, ay, bx, by):
+            return (bx - ax) * (y - ay) - (by - ay) * (x - ax)
+        if side(rx, ry, gx, gy) >= 0 and side(gx, gy, bx, by) >= 0 and side(bx, by, rx, ry) >= 0:
+            return x, y
+        best = None
+        for (ax, ay), (bx, by) in ((self.GAMUT[0], self.GAMUT[1]), (self.GAMUT[1], self.GAMUT[2]),
+                                   (self.GAMUT[2], self.GAMUT[0])):
+            dx, dy = bx - ax, by - ay
+            t = min(max(((x - ax) * dx + (y - ay) * dy) / (dx * dx + dy * dy), 0.0), 1.0)
+            px, py = ax + t * dx, ay + t * dy
+            distance = (px - x) ** 2 + (py - y) ** 2
+            if best is None or distance < best[0]:
+                best = (distance, px, py)
+        return best[1], best[2]
+
+    @staticmethod
+    def gamma(value):
+        if value <= 0.0031308:
+            return 12.92 * value
+        return 1.055 * value ** (1 / 2.4) - 0.055
+
+    @staticmethod
+    def inverse_gamma(value):
+        if value > 0.04045:
+            return ((value + 0.055) / 1.055) ** 2.4
+        return value / 12.92
+
+    def python_xy_to_hue_sat(self, x, y):
+        x, y = self.in_gamut(float(x), float(y))
+        X = x / y
+        Z = (1.0 - x - y) / y
+        r = X * 1.656492 - 0.354851 - Z * 0.255038
+        g = -X * 0.707196 + 1.655397 + Z * 0.036152
+        b = X * 0.051713 - 0.121364 + Z * 1.011530
+        h, s, _v = colorsys.rgb_to_hsv(*[self.gamma(max(c, 0.0)) for c in (r, g, b)])
+        return int(round(h * 65535)), int(round(s * 254))
+
+    def python_hue_sat_to_xy(self, hue, sat):
+        r, g, b = [self.inverse_gamma(c) for c in colorsys.hsv_to_rgb(hue / 65535.0, sat / 254.0, 1.0)]
+        X = r * 0.664511 + g * 0.154324 + b * 0.162028
+        Y = r * 0.283881 + g * 0.668433 + b * 0.047685
+        Z = r * 0.000088 + g * 0.072310 + b * 0.986039
+        total = X + Y + Z
+        if total <= 0:
+            return list(self.WHITE)
+        return [round(X / total, 4), round(Y / total, 4)]
+
+    # NumPy, lookup tables
+
+    def numpy_in_gamut(self, x, y):
+        np = self.numpy
+        (rx, ry), (gx, gy), (bx, by) = self.GAMUT
+        def side(ax, ay, bx, by):
+            return (bx - ax) * (y - ay) - (by - ay) * (x - ax)
+        inside = (side(rx, ry, gx, gy) >= 0) & (side(gx, gy, bx, by) >= 0) & (side(bx, by, rx, ry) >= 0)
+        best = None
+        for (ax, ay), (bx, by) in ((self.GAMUT[0], self.GAMUT[1]), (self.GAMUT[1], self.GAMUT[2]),
+                                   (self.GAMUT[2], self.GAMUT[0])):
+            dx, dy = bx - ax, by - ay
+            t = np.clip(((x - ax) * dx + (y - ay) * dy) / (dx * dx + dy * dy), 0.0, 1.0)
+            px, py = ax + t * dx, ay + t * dy
+            distance = (px - x) ** 2 + (py - y) ** 2
+            if best is None:
+                best = (distance, px, py)
+            else:
+                closer = distance < best[0]
+                best = (np.where(closer, distance, best[0]), np.where(closer, px, best[1]),
+                        np.where(closer, py, best[2]))
+        return np.where(inside, x, best[1]), np.where(inside, y, best[2])
+
+    def build_xy_table(self):
+        np = self.numpy
+        axis = np.linspace(0.0, 1.0, self.XY_STEPS)
+        x, y = self.numpy_in_gamut(axis[:, None] + np.zeros((1, self.XY_STEPS)),
+                                   axis[None, :] + np.zeros((self.XY_STEPS, 1)))
+        X = x / y
+        Z = (1.0 - x - y) / y
+        rgb = [X * 1.656492 - 0.354851 - Z * 0.255038,
+               -X * 0.707196 + 1.655397 + Z * 0.036152,
+               X * 0.051713 - 0.121364 + Z * 1.011530]
+        r, g, b = [np.where(c <= 0.0031308, 12.92 * c, 1.055 * np.maximum(c, 0.0031308) ** (1 / 2.4) - 0.055)
+                   for c in [np.maximum(c, 0.0) for c in rgb]]
+        # RGB -> hue/saturation, as colorsys.rgb_to_hsv()
+        top = np.maximum(np.maximum(r, g), b)
+        delta = top - np.minimum(np.minimum(r, g), b)
+        safe_delta = np.where(delta > 0, delta, 1.0)
+        h = np.where(top == r, ((g - b) / safe_delta) % 6.0,
+                     np.where(top == g, (b - r) / safe_delta + 2.0, (r - g) / safe_delta + 4.0)) / 6.0
+        h = np.where(delta > 0, h, 0.0)
+        s = np.where(top > 0, delta / np.where(top > 0, top, 1.0), 0.0)
+        self.xy_table = (np.rint(h * 65535).astype(np.uint16), np.rint(s * 254).astype(np.uint8))
+
+    def build_hs_table(self):
+        np = self.numpy
+        h = (np.arange(self.HUE_STEPS) / float(self.HUE_STEPS))[:, None] + np.zeros((1, 255))
+        s = (np.arange(255) / 254.0)[None, :] + np.zeros((self.HUE_STEPS, 1))
+        # HSV (value 1) -> RGB, as colorsys.hsv_to_rgb()
+        sector = np.floor(h * 6.0)
+        f = h * 6.0 - sector
+        sector = sector.astype(int) % 6
+        p = 1.0 - s
+        q = 1.0 - s * f
+        t = 1.0 - s * (1.0 - f)
+        one = np.ones_like(s)
+        r = np.choose(sector, [one, q, p, p, t, one])
+        g = np.choose(sector, [t, one, one, q, p, p])
+        b = np.choose(sector, [p, p, t, one, one, q])
+        r, g, b = [np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92) for c in (r, g, b)]
+        X = r * 0.664511 + g * 0.154324 + b * 0.162028
+        Y = r * 0.283881 + g * 0.668433 + b * 0.047685
+        Z = r * 0.000088 + g * 0.072310 + b * 0.986039
+        total = X + Y + Z
+        safe_total = np.where(total > 0, total, 1.0)
+        xy = np.empty(X.shape + (2,))
+        xy[..., 0] = np.where(total > 0, X / safe_total, self.WHITE[0])
+        xy[..., 1] = np.where(total > 0, Y / safe_total, self.WHITE[1])
+        self.hs_table = np.round(xy, 4)
+
+    def numpy_xy_to_hue_sat(self, xys):
+        np = self.numpy
+        if self.xy_table is None:
+            self.build_xy_table()
+        xys = np.asarray(xys, dtype=float)
+        steps = np.clip(np.rint(xys * (self.XY_STEPS - 1)), 0, self.XY_STEPS - 1).astype(int)
+        hues, sats = self.xy_table
+        return list(zip(hues[steps[:, 0], steps[:, 1]].tolist(), sats[steps[:, 0], steps[:, 1]].tolist()))
+
+    def numpy_hue_sat_to_xy(self, hue_sats):
+        np = self.numpy
+        if self.hs_table is None:
+            self.build_hs_table()
+        hue_sats = np.asarray(hue_sats, dtype=float)
+        hue_steps = np.rint(hue_sats[:, 0] * (self.HUE_STEPS / 65536.0)).astype(int) % self.HUE_STEPS
+        sats = np.clip(np.rint(hue_sats[:, 1]), 0, 254).astype(int)
+        return self.hs_table[hue_steps, sats].tolist()
+
+COLORS = color_converter()
+
+# The Hue settings that make a colour, the first one in a change wins
+COLOR_MODES = (('xy', 'xy'), ('ct', 'ct'), ('hue', 'hs'), ('sat', 'hs'))
+
+
+def color_mode(changes):
+    """The colormode a state change puts a light in, None if it sets no colour"""
+    for setting, mode in COLOR_MODES:
+        if setting in changes:
+            return mode
+    return None
+
+
+# Base class for the light backends. fauxhue hands each handler the
+# whole state delta for a light via apply(), e.g. {"on": True, "bri": 200},
+# so a backend that can set several attributes at once only needs one
+# command. The default apply() falls back to on(), off() and dim().
+
+class api_handler(object):
+    can_get_states = False
+    native_transitions = False  # apply() honours changes['transitiontime']
+
+    def get_states(self, datas):
+        """Read back the current state of several lights in one go.
+        Returns a list with, for each of datas, None if the light did not
+        answer or (new data, dict of Hue state values).
+        """
+        return [None] * len(datas)
+
+    def needs_polling(self, data):
+        return self.can_get_states
+
+    def batch_key(self, data):
+        # lights with the same batch_key() can share one apply_each() call
+        return None
+
+    def apply_each(self, datas, changes):
+        """Apply changes[i] to datas[i], e.g. the steps of the transitions
+        due at the same time. Returns True if they all succeeded.
+        """
+        result = True
+        for data, light_changes in zip(datas, changes):
+            result = self.apply(data, light_changes) and result
+        return result
+
+    def apply(self, data, changes):
+        result = True
+        if 'bri' in changes and changes.get('on', True):
+            result = self.dim(data, changes['bri']) and result
+        if changes.get('on') == True:
+            result = self.on(data) and result
+        elif changes.get('on') == False:
+            result = self.off(data) and result
+        return result
+
+    def on(self, data):
+        return False
+
+    def off(self, data):
+        return False
+
+    def dim(self, data, value):
+        return False
+
+
+class DebugPrintAPIhandler(api_handler):
     """ Current behavior/output
 OFF None
 send '[{"success": {"/lights/1/state/on": false}}]'
@@ -498,46 +2528,485 @@ send '[{"success": {"/lights/1/state/on": true}}]'
 
     """
     def on(self, data):
-        print('ON %r' % (data,))
+        log.info('ON %r', data)
         return True
 
     def off(self, data):
-        print('OFF %r' % (data,))
+        log.info('OFF %r', data)
         return True
 
     def dim(self, data, value):
-        print('DIM %r' % (data,))
+        log.info('DIM %r %r', data, value)
         return True
 
+# WeMo Link SOAP control. ouimeaux opens a new HTTP connection for every
+# SOAP request, so in a burst of commands connection setup to the
+# (slow) bridge takes most of the time. Bridges that ouimeaux found
+# are instead driven through a soap_pool each, at the control URL of
+# their bridge service: up to MAX_CONNECTIONS persistent, keep-alive connections, each
+# used by one request at a time (more callers wait for one to be free).
+# Before reuse an idle connection is checked: one that has been idle
+# longer than IDLE_TIMEOUT, or that the bridge has closed (the socket
+# reads as ready), is dropped. A request failing on a reused connection
+# is retried once on a new one. The connection events are counted in
+# METRICS.
+
+SOAP_REQUEST = ('<?xml version="1.0" encoding="utf-8"?>'
+                '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+                's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+                '<u:%(action)s xmlns:u="%(service)s">%(arguments)s</u:%(action)s>'
+                '</s:Body></s:Envelope>')
+
+
+class soap_error(IOError):
+    """A SOAP request that was answered with an error"""
+
+
+class soap_pool(object):
+    MAX_CONNECTIONS = 2
+    IDLE_TIMEOUT = 30.0
+    TIMEOUT = 10.0
+
+    def __init__(self, host, port, path, keep_alive=True):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.keep_alive = keep_alive  # False makes a connection per request, as ouimeaux
+        self.slots = threading.Semaphore(self.MAX_CONNECTIONS)
+        self.lock = threading.Lock()
+        self.idle = []  # [(connection, time it was returned)], latest last
+
+    def count(self, event):
+        METRICS.post(METRICS.wemo_connections, event)  # called from the dispatcher's threads
+
+    def checkout(self):
+        # Returns (connection, reused)
+        now = time.time()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection, returned = self.idle.pop()
+            sock = connection.sock
+            if sock is not None and now - returned < self.IDLE_TIMEOUT and not select.select([sock], [], [], 0)[0]:
+                self.count('reused')
+                return connection, True
+            connection.close()
+            self.count('dropped')
+        return self.connect(), False
+
+    def connect(self):
+        self.count('opened')
+        connection = httplib.HTTPConnection(self.host, self.port, timeout=self.TIMEOUT)
+        connection.connect()
+        # the request goes out as headers then body, do not hold the body back
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+
+    def checkin(self, connection):
+        if not self.keep_alive:
+            connection.close()
+            return
+        with self.lock:
+            self.idle.append((connection, time.time()))
+
+    def post(self, connection, action, service, body):
+        connection.request('POST', self.path, body, {
+            'Content-Type': 'text/xml; charset="utf-8"',
+            'SOAPACTION': '"%s#%s"' % (service, action),
+            'Connection': self.keep_alive and 'keep-alive' or 'close',
+        })
+        response = connection.getresponse()
+        return response, response.read()
+
+    def call(self, service, action, arguments):
+        """Send a SOAP action with {name: text} arguments, returns the
+        response's arguments as {name: text}. Raises soap_error or an
+        IOError (socket.error) if the request failed.
+        """
+        body = (SOAP_REQUEST % {'action': action, 'service': service, 'arguments': ''.join(
+            '<%s>%s</%s>' % (name, saxutils.escape(value), name) for name, value in sorted(arguments.items()))}
+                ).encode('utf-8')
+        with self.slots:
+            connection = None
+            try:
+                connection, reused = self.checkout()
+                try:
+                    response, data = self.post(connection, action, service, body)
+                except (socket.error, httplib.HTTPException):
+                    if not reused:
+                        raise
+                    # the bridge may have closed it in the meantime, and
+                    # the other idle ones too
+                    connection.close()
+                    self.count('retried')
+                    connection = self.connect()
+                    response, data = self.post(connection, action, service, body)
+            except (socket.error, httplib.HTTPException) as e:
+                if connection is not None:
+                    connection.close()
+                self.count('failed')
+                raise IOError('%s to %s:%s failed: %r' % (action, self.host, self.port, e))
+            if response.will_close:
+                connection.close()
+            else:
+                self.checkin(connection)
+        if response.status != 200:
+            raise soap_error('%s to %s:%s: HTTP %d' % (action, self.host, self.port, response.status))
+        try:
+            reply = ElementTree.fromstring(data).find('.//{%s}%sResponse' % (service, action))
+        except ElementTree.ParseError as e:
+            raise soap_error('%s to %s:%s: bad response: %s' % (action, self.host, self.port, e))
+        if reply is None:
+            raise soap_error('%s to %s:%s: no %sResponse' % (action, self.host, self.port, action))
+        return dict((child.tag.split('}')[-1], child.text or '') for child in reply)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, _returned in idle:
+            connection.close()
+
+
+class wemo_bridge_client(object):
+    """The light calls of a WeMo Link, over a soap_pool"""
+    SERVICE = 'urn:Belkin:service:bridge:1'
+    PATH = '/upnp/control/bridge1'
+    ON_OFF = '10006'
+    LEVEL = '10008'  # "dim:transition time"
+
+    def __init__(self, host, port, keep_alive=True, path=PATH):
+        self.pool = soap_pool(host, port, path, keep_alive)
+
+    def set_state(self, device_id, state=None, dim=None):
+        if self.set_states([(device_id, state, dim)]):
+            raise soap_error('WeMo light %s not set' % device_id)
+
+    def set_states(self, settings):
+        """Set several lights, [(device id, state or None, dim or None)],
+        in one request. Returns the ids of the lights that were not set.
+        """
+        statuses = []
+        for device_id, state, dim in settings:
+            capabilities = []
+            values = []
+            if state is not None:
+                capabilities.append(self.ON_OFF)
+                values.append(str(int(state)))
+            if dim is not None:
+                capabilities.append(self.LEVEL)
+                values.append('%d:0' % dim)
+            statuses.append('<DeviceStatus><IsGroupAction>NO</IsGroupAction>'
+                            '<DeviceID available="YES">%s</DeviceID><CapabilityID>%s</CapabilityID>'
+                            '<CapabilityValue>%s</CapabilityValue></DeviceStatus>' % (
+                                device_id, ','.join(capabilities), ','.join(values)))
+        if len(statuses) > 1:
+            statuses = ['<DeviceStatusList>'] + statuses + ['</DeviceStatusList>']
+        reply = self.pool.call(self.SERVICE, 'SetDeviceStatus', {
+            'DeviceStatusList': '<?xml version="1.0" encoding="utf-8"?>' + ''.join(statuses)})
+        return set(device_id for device_id in reply.get('ErrorDeviceIDs', '').split(',') if device_id)
+
+    def get_states(self, device_ids):
+        """{device id: {'state': 0 or 1, 'dim': 0-255}} for the lights that
+        answered, in one request
+        """
+        reply = self.pool.call(self.SERVICE, 'GetDeviceStatus', {'DeviceIDs': ','.join(device_ids)})
+        states = {}
+        try:
+            statuses = ElementTree.fromstring(reply.get('DeviceStatusList', '').encode('utf-8'))
+        except ElementTree.ParseError as e:
+            raise soap_error('Unparsable WeMo device status: %s' % e)
+        for status in statuses.iter('DeviceStatus'):
+            device = status.find('DeviceID')
+            if device is None or device.get('available', 'YES') != 'YES':
+                continue
+            values = dict(zip((status.findtext('CapabilityID') or '').split(','),
+                              (status.findtext('CapabilityValue') or '').split(',')))
+            try:
+                states[device.text] = {'state': int(values[self.ON_OFF]),
+                                       'dim': int(values[self.LEVEL].split(':')[0])}
+            except (KeyError, ValueError):
+                continue  # no answer from the light, an empty value
+        return states
+
+
+wemo_clients = {}  # (host, port) -> wemo_bridge_client
+wemo_clients_lock = threading.Lock()
+
+def wemo_control_address(bridgedata):
+    """(host, port, path) of an ouimeaux bridge's bridge1 service, None if
+    it has none. ouimeaux devices have no port of their own, it is in the
+    services' URLs.
+    """
+    control_url = getattr(getattr(bridgedata, 'bridge', None), 'controlURL', None)
+    if not control_url:
+        return None
+    url = urlsplit(control_url)
+    if not url.hostname:
+        return None
+    return url.hostname, url.port or 80, url.path or wemo_bridge_client.PATH
+
+def wemo_client(bridgedata):
+    """The pooled client for an ouimeaux bridge, None if it has no
+    control URL (then only its own calls can be used)
+    """
+    address = wemo_control_address(bridgedata)
+    if address is None:
+        return None
+    host, port, path = address
+    with wemo_clients_lock:
+        client = wemo_clients.get((host, port))
+        if client is None:
+            client = wemo_clients[(host, port)] = wemo_bridge_client(host, port, path=path)
+        return client
+
+def wemo_light_id(bridgedata, lightname):
+    return bridgedata.Lights[lightname].find('DeviceID').text
+
+def ouimeaux_set_state(bridgedata, lightname, state=None, dim=None):
+    # ouimeaux's light_set_state() sends only one of state and dim (the
+    # state if both are given), so setting both takes two calls, the dim
+    # first so a light being switched off stays off
+    light = bridgedata.Lights[lightname]
+    if dim is not None:
+        bridgedata.light_set_state(light, dim=dim)
+    if state is not None:
+        bridgedata.light_set_state(light, state=state)
+
+def wemo_set_state(bridgedata, lightname, state=None, dim=None):
+    client = wemo_client(bridgedata)
+    if client is None:
+        ouimeaux_set_state(bridgedata, lightname, state, dim)
+    else:
+        client.set_state(wemo_light_id(bridgedata, lightname), state, dim)
+
+def wemo_set_states(bridgedata, settings):
+    """Set several lights of a bridge, [(light name, state, dim)], one
+    request for the lot when the bridge has a client. Returns the names
+    of the lights that were not set.
+    """
+    client = wemo_client(bridgedata)
+    if client is None:
+        for lightname, state, dim in settings:
+            ouimeaux_set_state(bridgedata, lightname, state, dim)
+        return set()
+    names = dict((wemo_light_id(bridgedata, lightname), lightname) for lightname, _state, _dim in settings)
+    failed = client.set_states([(wemo_light_id(bridgedata, lightname), state, dim)
+                                for lightname, state, dim in settings])
+    return set(names[device_id] for device_id in failed if device_id in names)
+
+def wemo_get_states(bridgedata, lightnames):
+    """{light name: {'state': 0 or 1, 'dim': 0-255}} for the lights that
+    answered, one request for the lot when the bridge has a client
+    """
+    client = wemo_client(bridgedata)
+    states = {}
+    if client is None:
+        # ouimeaux reads the state from the light list it fetched at
+        # discovery (as strings), this sees no changes made since
+        for lightname in lightnames:
+            try:
+                state = bridgedata.light_get_state(bridgedata.Lights[lightname])
+                states[lightname] = {'state': int(state['state']), 'dim': int(str(state['dim']).split(':')[0])}
+            except Exception as e:
+                # one SOAP call per light, a light that does not answer
+                # is unreachable but does not fail the rest
+                log.info('WeMo light %s state not read: %r', lightname, e)
+        return states
+    names = dict((wemo_light_id(bridgedata, lightname), lightname) for lightname in lightnames)
+    for device_id, state in client.get_states(sorted(names)).items():
+        if device_id in names:
+            states[names[device_id]] = state
+    return states
+
+
 # Wemo Link handler for the Philips Hue compatibility. The fauxhue class
-# expects handlers to be instances of objects that have on(), off() and dim()
-# methods that return True on success and False otherwise.
+# expects handlers to be instances of api_handler, whose methods return
+# True on success and False otherwise.
+
+class wemo_api_handler(api_handler):
+    # Group commands and transition steps are batched per bridge and
+    # sent as one SetDeviceStatus with a DeviceStatus per light, over the
+    # bridge's pooled connections (see soap_pool). Bridges without an
+    # address get one ouimeaux call per light.
+    can_get_states = True
+    EVENT_STALE_AFTER = 600.0  # poll lights whose bridge has been quiet this long
+
+    def batch_key(self, data):
+        return id(data['bridge'])
+
+    def needs_polling(self, data):
+        # bridges with a live event subscription push their changes
+        return time.time() - data.get('event_time', 0) > self.EVENT_STALE_AFTER
+
+    def get_states(self, datas):
+        # one GetDeviceStatus per bridge for all its lights
+        by_bridge = {}
+        for data in datas:
+            if data['bridge'] is not None:
+                by_bridge.setdefault(id(data['bridge']), (data['bridge'], []))[1].append(data['light'])
+        states = {}
+        for key, (bridgedata, lightnames) in by_bridge.items():
+            try:
+                states[key] = wemo_get_states(bridgedata, lightnames)
+            except Exception as e:
+                log.info('WeMo bridge %r states not read: %r', bridgedata, e)
+                states[key] = {}
+        results = []
+        for data in datas:
+            state = data['bridge'] is not None and states[id(data['bridge'])].get(data['light'])
+            if not state:
+                results.append(None)  # unreachable
+                continue
+            results.append((data, {'on': bool(state['state']), 'bri': state['dim']}))
+        return results
+
+    @staticmethod
+    def settings(changes):
+        # (state, dim) for wemo_set_state(), None for those not changed
+        state = None
+        if changes.get('on') == True:
+            state = 1
+        elif changes.get('on') == False:
+            state = 0
+        return state, changes.get('bri')
+
+    def apply(self, data, changes):
+        if data['bridge'] is None:
+            return False  # registered from the discovery cache, bridge not found yet
+        state, dim = self.settings(changes)
+        if state is not None or dim is not None:
+            wemo_set_state(data['bridge'], data['light'], state, dim)
+        return True
+
+    def apply_each(self, datas, changes):
+        by_bridge = {}
+        result = True
+        for data, light_changes in zip(datas, changes):
+            if data['bridge'] is None:
+                result = False
+                continue
+            state, dim = self.settings(light_changes)
+            if state is not None or dim is not None:
+                by_bridge.setdefault(id(data['bridge']), (data['bridge'], []))[1].append(
+                    (data['light'], state, dim))
+        for bridgedata, settings in by_bridge.values():
+            failed = wemo_set_states(bridgedata, settings)
+            if failed:
+                log.info('WeMo lights %s not set', ', '.join(sorted(failed)))
+                result = False
+        return result
 
-class wemo_api_handler(object):
     def on(self, data):
-        bridgedata = data['bridge']
-        lightobj = bridgedata.Lights[data['light']]
-        bridgedata.light_set_state(lightobj, state=1)
+        wemo_set_state(data['bridge'], data['light'], state=1)
         return True
 
     def off(self, data):
-        bridgedata = data['bridge']
-        lightobj = bridgedata.Lights[data['light']]
-        bridgedata.light_set_state(lightobj, state=0)
+        wemo_set_state(data['bridge'], data['light'], state=0)
         return True
 
     def dim(self, data, value):
-        bridgedata = data['bridge']
-        lightobj = bridgedata.Lights[data['light']]
-        bridgedata.light_set_state(lightobj, dim=value)
+        wemo_set_state(data['bridge'], data['light'], dim=value)
         return True
 
 
 # Lifx handler for the Philips Hue compatibility. The fauxhue class expects
-# handlers to be instances of objects that have on(), off() and dim()
-# methods that return True on success and False otherwise.
+# handlers to be instances of api_handler, whose methods return True on
+# success and False otherwise.
+#
+# LIFX has no single message for power and color, apply_each() sets
+# the color and brightness first (fading over the Hue transitiontime)
+# and then the power, and skips the color when the light is being
+# switched off. The Hue colour settings are converted with COLORS.
+
+class lifx_api_handler(api_handler):
+    can_get_states = True
+    native_transitions = True
+
+    @staticmethod
+    def duration(changes):
+        # Hue transitiontime (100 ms steps) -> LIFX fade duration in ms
+        return int(changes.get('transitiontime', HUE_TRANSITIONTIME)) * 100
+
+    @staticmethod
+    def hue_states(bulbobjs, previous=None):
+        """Hue state values of LIFX bulb states. With the previous states
+        of the bulbs, the colour settings are only included for those
+        whose colour changed (the conversion back to xy is not exact, a
+        light set with xy would otherwise look changed on every poll).
+        """
+        colored = [n for n, bulbobj in enumerate(bulbobjs)
+                   if previous is None or (bulbobj.hue, bulbobj.saturation, bulbobj.kelvin) !=
+                   (previous[n].hue, previous[n].saturation, previous[n].kelvin)]
+        xys = dict(zip(colored, COLORS.hue_sat_to_xy([(bulbobjs[n].hue, bulbobjs[n].saturation * 254 // 65535)
+                                                      for n in colored])))
+        states = []
+        for n, bulbobj in enumerate(bulbobjs):
+            state = {'on': bool(bulbobj.power), 'bri': int(round(bulbobj.brightness * 255 / 65535.0))}
+            if n in xys:
+                state.update({'hue': bulbobj.hue, 'sat': bulbobj.saturation * 254 // 65535, 'xy': xys[n],
+                              'ct': COLORS.kelvin_to_mired(bulbobj.kelvin),
+                              'colormode': bulbobj.saturation and 'hs' or 'ct'})
+            states.append(state)
+        return states
+
+    def get_states(self, bulbobjs):
+        # one get_state() call for all the bulbs
+        found = dict((state.bulb.mac, state) for state in lazylights.get_state([bulbobj.bulb for bulbobj in bulbobjs]))
+        answered = [(bulbobj, found[bulbobj.bulb.mac]) for bulbobj in bulbobjs if bulbobj.bulb.mac in found]
+        states = iter(self.hue_states([state for _bulbobj, state in answered],
+                                      [bulbobj for bulbobj, _state in answered]))
+        results = []
+        for bulbobj in bulbobjs:
+            state = found.get(bulbobj.bulb.mac)
+            if state is None:
+                results.append(None)
+            else:
+                results.append((lifx_bulb(state), next(states)))
+        return results
+
+    def apply_each(self, bulbobjs, changes):
+        # The xy colours of all the bulbs are converted in one go, then
+        # set_state() is called once per distinct color (and fade) and
+        # set_power() once for on and once for off, each with all the
+        # bulbs concerned. The color goes first, it includes the brightness.
+        xys = iter(COLORS.xy_to_hue_sat([light_changes['xy'] for light_changes in changes
+                                         if color_mode(light_changes) == 'xy']))
+        colors = {}  # (hue, saturation, brightness, kelvin, duration) -> [bulb]
+        powers = {}  # on -> [bulb]
+        for bulbobj, light_changes in zip(bulbobjs, changes):
+            on = light_changes.get('on')
+            mode = color_mode(light_changes)
+            hue, saturation, kelvin = bulbobj.hue, bulbobj.saturation, bulbobj.kelvin
+            if mode == 'xy':
+                hue, sat = next(xys)
+                saturation = sat * 65535 // 254
+            elif mode == 'ct':
+                saturation = 0
+                kelvin = COLORS.mired_to_kelvin(light_changes['ct'])
+            elif mode == 'hs':
+                hue = light_changes.get('hue', hue)
+                if 'sat' in light_changes:
+                    saturation = light_changes['sat'] * 65535 // 254
+            brightness = bulbobj.brightness
+            if 'bri' in light_changes:
+                brightness = light_changes['bri'] * 65535 // 255
+            if (mode or 'bri' in light_changes) and on != False:
+                colors.setdefault((hue, saturation, brightness, kelvin, self.duration(light_changes)),
+                                  []).append(bulbobj.bulb)
+                # remembered for the next change that only sets some of them
+                bulbobj.hue, bulbobj.saturation, bulbobj.brightness, bulbobj.kelvin = hue, saturation, brightness, kelvin
+            if on == True or on == False:
+                powers.setdefault(on, []).append(bulbobj.bulb)
+        for (hue, saturation, brightness, kelvin, duration), bulbs in colors.items():
+            lazylights.set_state(bulbs, hue, saturation, brightness, kelvin, duration, raw=True)
+        for on, bulbs in powers.items():
+            lazylights.set_power(bulbs, on)
+        return True
+
+    def apply(self, bulbobj, changes):
+        return self.apply_each([bulbobj], [changes])
 
-class lifx_api_handler(object):
     def on(self, bulbobj):
         lazylights.set_power([bulbobj.bulb], True)
         return True
@@ -548,71 +3017,1062 @@ class lifx_api_handler(object):
 
     def dim(self, bulbobj, value):
         lazylights.set_state([bulbobj.bulb], bulbobj.hue, bulbobj.saturation,
-                             value * 65535 / 255, bulbobj.kelvin, 1000,
+                             value * 65535 / 255, bulbobj.kelvin, self.duration({}),
                              raw=True)
         return True
 
 
-if len(sys.argv) > 1 and sys.argv[1] == '-d':
-    DEBUG = True
+# Light state journal. Each light is registered with a key for the
+# device behind it (e.g. ('lifx', mac)); the journal remembers the
+# bridge and light number every key was given and the light's last
+# known state, so after a restart the lights keep their numbers (the
+# Echo knows them by those) and are served with their state before any
+# device has been asked.
+#
+# The file has a JSON line per light change, the last one for a key wins:
+#
+#   {"key": ["lifx", "d073d5000001"], "bridge": 0, "light": "2", "name": "...", "state": {...}}
+#
+# Changes are collected for FLUSH_DELAY seconds, then appended and
+# fsync()ed in one go on a backend worker, so a burst of PUTs costs a
+# single write. Once the file has more than COMPACT_RATIO lines per
+# light it is rewritten with just the latest ones (to a temporary file
+# that is renamed over the journal, as with the discovery cache).
 
-# Set up our singleton for polling the sockets for data ready
-p = poller()
+STATE_JOURNAL = os.path.join(os.path.expanduser('~'), '.ulfire_journal.jsonl')
 
-# Set up our singleton listener for UPnP broadcasts
-u = upnp_broadcast_responder()
-u.init_socket()
 
-# Add the UPnP broadcast listener to the poller so we can respond
-# when a broadcast is received.
-p.add(u)
+class state_journal(object):
+    FLUSH_DELAY = 0.5
+    COMPACT_RATIO = 4
+    COMPACT_MIN = 1000  # lines, smaller files are left alone
+
+    def __init__(self, filename, poller, dispatcher):
+        self.filename = filename
+        self.poller = poller
+        self.dispatcher = dispatcher
+        self.entries = {}  # key -> latest record
+        self.lights = {}  # (fauxhue, lightnum) -> (key, bridge index)
+        self.dirty = {}  # key -> (fauxhue, lightnum), changed since the last flush
+        self.lines = 0  # in the file
+        self.rewrite = False  # compact on the next flush
+        self.flushing = False  # a write is in progress
+        self.timer = None
+        self.file = None  # append handle, only used by the worker writing
+        self.load()
+
+    def load(self):
+        started = time.time()
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        self.entries[tuple(record['key'])] = record
+                    except (ValueError, KeyError, TypeError):
+                        continue  # e.g. a line cut short by a crash
+                    self.lines += 1
+        except (IOError, OSError) as e:
+            log.info('No state journal loaded from %s: %s', self.filename, e)
+            return
+        self.rewrite = self.needs_compacting()
+        log.info('Loaded %d lights from %s (%d lines) in %.1fms',
+                 len(self.entries), self.filename, self.lines, (time.time() - started) * 1000)
+
+    def needs_compacting(self):
+        return self.lines > max(self.COMPACT_MIN, self.COMPACT_RATIO * len(self.entries))
+
+    def placements(self):
+        """[(bridge index, lightnum), ...] of every journaled light"""
+        return [(record['bridge'], str(record['light'])) for record in self.entries.values()]
+
+    def placement(self, key):
+        """(bridge index, lightnum, state) the light had, None if unknown"""
+        record = self.entries.get(key)
+        if record is None:
+            return None
+        return record['bridge'], str(record['light']), record['state']
+
+    def assign(self, key, hue, bridge, lightnum):
+        self.lights[(hue, lightnum)] = (key, bridge)
+        self.light_changed(hue, lightnum)
+
+    def forget(self, hue, lightnum):
+        # a light that has been removed, its record goes on the next compaction
+        placed = self.lights.pop((hue, lightnum), None)
+        if placed is None:
+            return
+        self.dirty.pop(placed[0], None)
+        if self.entries.pop(placed[0], None) is not None:
+            self.rewrite = True
+            if self.timer is None and not self.flushing:
+                self.timer = self.poller.call_later(self.FLUSH_DELAY, self.flush)
+
+    def light_changed(self, hue, lightnum):
+        placed = self.lights.get((hue, lightnum))
+        if placed is None:
+            return  # not journaled
+        self.dirty[placed[0]] = (hue, lightnum)
+        if self.timer is None and not self.flushing:
+            self.timer = self.poller.call_later(self.FLUSH_DELAY, self.flush)
+
+    def records(self):
+        # Move the dirty lights' current state into entries, returns the
+        # new lines
+        lines = []
+        for key, (hue, lightnum) in self.dirty.items():
+            light = hue.lights[lightnum]
+            record = {'key': list(key), 'bridge': self.lights[(hue, lightnum)][1], 'light': lightnum,
+                      'name': light.name, 'state': light.state()}
+            self.entries[key] = record
+            lines.append(json.dumps(record) + '\n')
+        self.dirty = {}
+        self.lines += len(lines)
+        return lines
+
+    def flush(self):
+        self.timer = None
+        if self.flushing or not (self.dirty or self.rewrite):
+            return
+        lines = self.records()
+        compacted = None
+        if self.rewrite or self.needs_compacting():
+            compacted = ''.join(json.dumps(record) + '\n' for record in self.entries.values())
+            self.lines = len(self.entries)
+            self.rewrite = False
+        self.flushing = True
+        self.dispatcher.submit('journal', self.write, (''.join(lines), compacted), self.written,
+                               label='journal')
+
+    def write(self, data, compacted=None):
+        # runs on a worker thread, one write at a time
+        if compacted is not None:
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as f:
+                f.write(compacted)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp_filename, self.filename)
+            if self.file:
+                self.file.close()
+                self.file = None
+            return True
+        if self.file is None:
+            self.file = open(self.filename, 'a')
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return True
+
+    def written(self, result):
+        self.flushing = False
+        if not result:
+            log.warning('Failed to write the state journal %s', self.filename)
+            self.rewrite = True  # the lines may be lost, write all of them next time
+        if (self.dirty or self.rewrite) and self.timer is None:
+            self.timer = self.poller.call_later(self.FLUSH_DELAY, self.flush)
+
+    def close(self):
+        # Write what is left, blocking, e.g. on the way out
+        lines = self.records()
+        try:
+            if self.rewrite or self.needs_compacting():
+                self.write('', ''.join(json.dumps(record) + '\n' for record in self.entries.values()))
+            elif lines:
+                self.write(''.join(lines))
+        except (IOError, OSError) as e:
+            log.warning('Failed to write the state journal %s: %s', self.filename, e)
 
-hue = None  # FIXME init this once and only once here!
 
-if lazylights:
+# Discovery. Finding the bulbs takes a while (the WeMo search alone waits
+# 10 seconds), so it runs in the background while the lights known from
+# the previous run are served from a cache file.
+
+DISCOVERY_CACHE = os.path.join(os.path.expanduser('~'), '.ulfire_cache.json')
+
+
+def load_discovery_cache(filename):
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        log.info('No discovery cache loaded from %s: %s', filename, e)
+        cache = {}
+    cache.setdefault('lifx', [])
+    cache.setdefault('wemo', [])
+    return cache
+
+
+def save_discovery_cache(filename, cache):
+    temp_filename = filename + '.tmp'
+    try:
+        with open(temp_filename, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.rename(temp_filename, filename)
+    except (IOError, OSError) as e:
+        log.warning('Failed to save discovery cache %s: %s', filename, e)
+
+
+def merge_cache_entries(cached, found, key):
+    # A device that did not answer this time stays in the cache, it may
+    # only be switched off at the wall
+    merged = collections.OrderedDict((key(entry), entry) for entry in cached)
+    for entry in found:
+        merged[key(entry)] = entry
+    return list(merged.values())
+
+
+class lifx_bulb(object):
+    """A LIFX light's private data, its lazylights bulb and last known
+    state (raw LIFX values). lazylights states are immutable namedtuples,
+    this one is updated with the colour sent to the bulb.
+    """
+    __slots__ = ('bulb', 'label', 'power', 'brightness', 'hue', 'saturation', 'kelvin')
+
+    def __init__(self, state):
+        # from a lazylights state (or another lifx_bulb)
+        for name in self.__slots__:
+            setattr(self, name, getattr(state, name))
+
+    @classmethod
+    def cached(cls, entry):
+        bulb = cls.__new__(cls)
+        bulb.label = entry['label']
+        bulb.power = entry['power']
+        bulb.brightness = entry['brightness']
+        bulb.hue = entry['hue']
+        bulb.saturation = entry['saturation']
+        bulb.kelvin = entry['kelvin']
+        bulb.bulb = lazylights.Bulb(binascii.unhexlify(entry['gateway_mac']),
+                                    binascii.unhexlify(entry['mac']),
+                                    tuple(entry['addr']))
+        return bulb
+
+
+def lifx_cache_entry(bulb):
+    return {
+        'label': str(bulb.label).rstrip('\x00'),
+        'gateway_mac': binascii.hexlify(bulb.bulb.gateway_mac).decode('ascii'),
+        'mac': binascii.hexlify(bulb.bulb.mac).decode('ascii'),
+        'addr': list(bulb.bulb.addr),
+        'power': bool(bulb.power),
+        'brightness': bulb.brightness,
+        'hue': bulb.hue,
+        'saturation': bulb.saturation,
+        'kelvin': bulb.kelvin,
+    }
+
+
+def discover_lifx():
+    # runs on a worker thread
     bulbs = lazylights.find_bulbs(timeout=1)
-else:
-    warnings.warn('lazylights missing, no Lifx support')
-    bulbs = []
-if len(bulbs) > 0:
-    hue = fauxhue("Fauxhue", u, p, None, 0)
-    bulbstate = lazylights.get_state(bulbs)
-    for bulb in bulbstate:
-        bulbname = str(bulb.label)
-        bulbname = bulbname.rstrip('\x00')
-        hue.add_bulb(bulbname, state=bool(bulb.power), brightness=(255 * bulb.brightness / 255), action_handler = lifx_api_handler(), private=bulb)
-
-env = Environment()
-env.start()
-env.discover(10)
-for bridgename in env.list_bridges():
-    bridge = env.get_bridge(bridgename)
-    if len(bridge.Lights) > 0 and hue == None:
-        hue = fauxhue("Fauxhue", u, p, None, 0) 
-    for lightname in bridge.Lights.keys():
-        light = bridge.Lights[lightname]
-        lightdata = {'bridge': bridge, 'light': lightname}
-        state = bridge.light_get_state(light)
-        hue.add_bulb(lightname, state=bool(state['state']),
-                     brightness=state['dim'], private=lightdata,
-                     action_handler = wemo_api_handler())
-
-# fauxmo - like hack - static config
-fake_switches = (
+    if len(bulbs) > 0:
+        return [lifx_bulb(state) for state in lazylights.get_state(bulbs)]
+    return []
+
+
+def discover_wemo(env):
+    # runs on a worker thread, returns [(bridgename, bridge, lightname, state), ...]
+    # with state None for lights whose state could not be read
+    env.start()
+    env.discover(10)
+    found = []
+    for bridgename in env.list_bridges():
+        bridge = env.get_bridge(bridgename)
+        lightnames = list(bridge.Lights.keys())
+        try:
+            states = wemo_get_states(bridge, lightnames)
+        except Exception as e:
+            log.info('WeMo bridge %s states not read: %r', bridgename, e)
+            states = {}
+        for lightname in lightnames:
+            found.append((bridgename, bridge, lightname, states.get(lightname)))
+    return found
+
+
+# WeMo Link bridges push light changes as UPnP (GENA) events. ouimeaux
+# subscribes to every device it discovers, renews the subscriptions
+# and delivers the events through its "subscription" signal, from the
+# thread running the ouimeaux environment. Each event is handed over
+# to the poll loop and applied to the matching fauxhue light. The time
+# of the last event is kept with the lights of that bridge, a bridge
+# that goes quiet for wemo_api_handler.EVENT_STALE_AFTER seconds is
+# polled by state_sync again.
+
+class wemo_events(object):
+    ON_OFF = '10006'
+    LEVEL = '10008'  # "dim:transition time"
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.lights = {}  # device id -> (fauxhue, lightnum)
+        self.bridges = {}  # id(bridge) -> [(fauxhue, lightnum), ...]
+
+    def connect(self, signal=None):
+        """Start receiving events from signal (ouimeaux.signals.subscription
+        unless given, e.g. a local stand-in). Returns False if there is no
+        event source.
+        """
+        if signal is None:
+            if not ouimeaux:
+                return False
+            signal = ouimeaux.signals.subscription
+        signal.connect(self.on_subscription, weak=False)
+        return True
+
+    def watch(self, bridge, lightname, light):
+        try:
+            device_id = bridge.Lights[lightname].find('DeviceID').text
+        except AttributeError:
+            log.warning('No DeviceID for WeMo light %s, events ignored', lightname)
+            return
+        self.lights[device_id] = light
+        bridge_lights = self.bridges.setdefault(id(bridge), [])
+        if light not in bridge_lights:
+            bridge_lights.append(light)
+
+    def on_subscription(self, sender, **kwargs):
+        # called on the ouimeaux thread
+        if kwargs.get('type') == 'StatusChange':
+            self.dispatcher.post(self.handle_event, sender, kwargs.get('value'))
+
+    def handle_event(self, bridge, value):
+        now = time.time()
+        for hue, lightnum in self.bridges.get(id(bridge), ()):
+            light = hue.lights.get(lightnum)
+            if light is not None:
+                light.private['event_time'] = now
+        try:
+            event = ElementTree.fromstring(value)
+            device_id = event.find('DeviceID').text
+            capability = event.find('CapabilityId').text
+            event_value = event.find('Value').text
+        except (ElementTree.ParseError, AttributeError, TypeError) as e:
+            log.warning('Unparsable WeMo event %r: %s', value, e)
+            return
+        light = self.lights.get(device_id)
+        if light is None or not event_value:
+            return
+        hue, lightnum = light
+        if capability == self.ON_OFF:
+            changes = {'on': event_value == '1'}
+        elif capability == self.LEVEL:
+            changes = {'bri': int(event_value.split(':')[0])}
+        else:
+            return
+        changes['reachable'] = True
+        if hue.update_state(lightnum, changes):
+            log.debug('WeMo light %s/%s changed: %r', hue.name, lightnum, changes)
+
+
+class discovery(object):
+    """Registers the cached lights with the fauxhues and then updates (or
+    adds) them from the results of background discovery.
+    """
+    TIMEOUT = 60.0
+
+    def __init__(self, hues, dispatcher, cache_filename=DISCOVERY_CACHE, events=None):
+        self.hues = hues
+        self.dispatcher = dispatcher
+        self.events = events
+        self.cache_filename = cache_filename
+        self.cache = load_discovery_cache(cache_filename)
+        self.registry = hues.registry
+
+    def register_cached(self):
+        if lazylights:
+            # the entries hold LIFX values, served as Hue ones
+            bulbs = [lifx_bulb.cached(entry) for entry in self.cache['lifx']]
+            for entry, bulb, state in zip(self.cache['lifx'], bulbs, lifx_api_handler.hue_states(bulbs)):
+                key = ('lifx', entry['mac'])
+                self.hues.add_bulb(
+                    entry['label'], key=key, state=state['on'], brightness=state['bri'],
+                    action_handler=lifx_api_handler(), private=bulb)
+        if ouimeaux:
+            for entry in self.cache['wemo']:
+                lightdata = {'bridge': None, 'light': entry['light']}
+                key = ('wemo', entry['bridge'], entry['light'])
+                self.hues.add_bulb(
+                    entry['light'], key=key, state=entry['state'], brightness=entry['dim'],
+                    private=lightdata, action_handler=wemo_api_handler())
+        log.info('Registered %d lights from %s',
+                 len(self.registry.backend('lifx')) + len(self.registry.backend('wemo')), self.cache_filename)
+
+    def start(self):
+        if lazylights:
+            self.dispatcher.spawn(discover_lifx, (), self.lifx_found, timeout=self.TIMEOUT)
+        if ouimeaux:
+            thread = threading.Thread(target=self.run_wemo)
+            thread.daemon = True
+            thread.start()
+
+    def run_wemo(self):
+        # WeMo discovery thread. It stays in the ouimeaux environment
+        # afterwards so the event subscriptions are serviced and renewed.
+        env = Environment()
+        try:
+            found = discover_wemo(env)
+        except Exception as e:
+            log.warning('WeMo discovery failed: %r', e)
+            return  # keep going with the cached lights
+        self.dispatcher.post(self.wemo_found, found)
+        if self.events and hasattr(env, 'wait'):
+            env.wait()
+
+    def lifx_found(self, bulbstate):
+        if bulbstate is False:
+            return  # discovery failed, keep going with the cached lights
+        entries = []
+        for bulb, state in zip(bulbstate, lifx_api_handler.hue_states(bulbstate)):
+            entry = lifx_cache_entry(bulb)
+            entries.append(entry)
+            key = ('lifx', entry['mac'])
+            placed = self.registry.get(key)
+            if placed:
+                hue, lightnum = placed
+                hue.lights[lightnum].private = bulb
+            else:
+                hue, lightnum = self.hues.add_bulb(entry['label'], key=key, state=state['on'], brightness=state['bri'], action_handler = lifx_api_handler(), private=bulb)
+            hue.update_state(lightnum, state)
+        self.cache['lifx'] = merge_cache_entries(self.cache['lifx'], entries, lambda entry: entry['mac'])
+        save_discovery_cache(self.cache_filename, self.cache)
+
+    def wemo_found(self, lights):
+        if lights is False:
+            return
+        entries = []
+        for bridgename, bridge, lightname, state in lights:
+            if state is None:
+                changes = {'reachable': False}  # state_sync reads it later
+                state = {'state': 0, 'dim': 0}
+            else:
+                changes = {'on': bool(state['state']), 'bri': state['dim'], 'reachable': True}
+            entries.append({'bridge': bridgename, 'light': lightname,
+                            'state': bool(state['state']), 'dim': state['dim']})
+            key = ('wemo', bridgename, lightname)
+            placed = self.registry.get(key)
+            if placed:
+                hue, lightnum = placed
+                hue.lights[lightnum].private['bridge'] = bridge
+            else:
+                lightdata = {'bridge': bridge, 'light': lightname}
+                hue, lightnum = self.hues.add_bulb(lightname, key=key, state=bool(state['state']),
+                                                   brightness=state['dim'], private=lightdata,
+                                                   action_handler = wemo_api_handler())
+            hue.update_state(lightnum, changes)
+            if self.events:
+                self.events.watch(bridge, lightname, (hue, lightnum))
+        self.cache['wemo'] = merge_cache_entries(self.cache['wemo'], entries,
+                                                 lambda entry: (entry['bridge'], entry['light']))
+        save_discovery_cache(self.cache_filename, self.cache)
+
+
+# Lights can also be switched with the vendor apps or at the wall, so
+# their state is read back periodically. The lights of each handler
+# class are polled with a single get_states() call, every FAST_INTERVAL
+# seconds after something changed, backing off to SLOW_INTERVAL when
+# nothing does.
+
+class state_sync(object):
+    FAST_INTERVAL = 2.0
+    SLOW_INTERVAL = 60.0
+    SETTLE_TIME = 3.0  # leave lights alone this long after a command
+    TIMEOUT = 30.0
+
+    def __init__(self, hues, dispatcher, poller):
+        self.hues = hues
+        self.dispatcher = dispatcher
+        self.poller = poller
+        self.interval = self.FAST_INTERVAL
+        self.polled_at = 0
+
+    def start(self):
+        self.poller.call_later(self.interval, self.poll)
+
+    def poll(self):
+        jobs = {}  # handler class -> (handler, [(fauxhue, lightnum)], [private])
+        for hue in self.hues:
+            for lightnum, light in hue.lights.items():
+                handler = light.action_handler
+                if handler is not None and handler.needs_polling(light.private):
+                    job = jobs.setdefault(type(handler), (handler, [], []))
+                    job[1].append((hue, lightnum))
+                    job[2].append(light.private)
+        if not jobs:
+            self.start()
+            return
+        self.polled_at = time.time()
+        self.dispatcher.spawn(self.fetch, (list(jobs.values()),), self.fetched, timeout=self.TIMEOUT)
+
+    @staticmethod
+    def fetch(jobs):
+        # runs on a worker thread
+        results = []
+        for handler, lights, privates in jobs:
+            results.extend(zip(lights, handler.get_states(privates)))
+        return results
+
+    def fetched(self, results):
+        changed = False
+        for (hue, lightnum), result in results or ():
+            if lightnum not in hue.lights:
+                continue  # removed in the meantime
+            if lightnum in hue.pending_commands or \
+                    hue.last_command.get(lightnum, 0) > self.polled_at - self.SETTLE_TIME:
+                continue  # the light may not have caught up with the command yet
+            if result is None:
+                changes = {'reachable': False}
+            else:
+                private, changes = result
+                hue.lights[lightnum].private = private
+                changes['reachable'] = True
+            if hue.update_state(lightnum, changes):
+                log.debug('Light %s/%s changed outside of ulfire: %r', hue.name, lightnum, changes)
+                changed = True
+        last_command = max([0] + [max(hue.last_command.values()) for hue in self.hues if hue.last_command])
+        if changed or last_command > time.time() - self.SLOW_INTERVAL:
+            self.interval = self.FAST_INTERVAL
+        else:
+            self.interval = min(self.interval * 2, self.SLOW_INTERVAL)
+        self.start()
+
+
+# Pre-fork worker mode (--workers). The main process, the owner, runs
+# everything as usual. Each worker process also listens on every
+# fauxhue port (SO_REUSEPORT, the kernel spreads new connections over
+# all the listening sockets) and answers GETs from its own replica of
+# the lights. Anything else (PUT, POST, DELETE and /metrics) is
+# forwarded to the owner, which handles it like one of its own
+# requests and sends the response back, so all changes and commands
+# go through a single process. The owner pushes new bridges, light
+# changes (collected over a poll loop iteration) and group changes to
+# the workers. Only the owner answers SSDP.
+
+class message_channel(buffered_socket):
+    """Messages over a socket pair: a JSON header plus a byte payload
+    (a request body or a whole response), each length prefixed.
+    """
+    def send_message(self, message, payload=''):
+        header = json.dumps(message)
+        return self.write((struct.pack('!II', len(header), len(payload)), header, payload))
+
+    def messages(self):
+        # Returns the complete [(message, payload), ...] in the buffer
+        found = []
+        offset = 0
+        while len(self.buffer) - offset >= 8:
+            header_size, payload_size = struct.unpack('!II', self.buffer[offset:offset + 8])
+            end = offset + 8 + header_size + payload_size
+            if len(self.buffer) < end:
+                break
+            header_end = offset + 8 + header_size
+            found.append((json.loads(self.buffer[offset + 8:header_end]), self.buffer[header_end:end]))
+            offset = end
+        if offset:
+            self.buffer = self.buffer[offset:]
+        return found
+
+    def receive(self):
+        # read what is there, None once the other end has gone
+        try:
+            data = self.socket.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            data = None
+        if not data:
+            return None
+        self.feed(data)
+        return self.messages()
+
+
+class forwarded_connection(object):
+    """Stands in for the client connection of a request forwarded by a
+    worker, collects the response.
+    """
+    OUTPUT_HIGH_WATER = buffered_socket.OUTPUT_HIGH_WATER
+
+    def __init__(self, address, keep_alive):
+        self.address = address
+        self.keep_alive = keep_alive
+        self.paused = False
+        self.span = None
+        self.output = []
+        self.output_size = 0
+
+    def fileno(self):
+        return None
+
+    def write(self, buffers):
+        self.output.extend(buffers)
+        return True
+
+
+class worker_pool(object):
+    """The owner's side of worker mode. Forks the workers, so it has to
+    be created before any threads are started.
+    """
+    def __init__(self, count):
+        upnp_device.REUSE_PORT = True
+        self.poller = None
+        self.channels = {}  # fileno -> message_channel
+        self.bridges = {}  # name -> fauxhue
+        self.dirty = {}  # (bridge name, lightnum) -> fauxhue, not yet sent to the workers
+        for n in range(count):
+            owner_end, worker_end = socket.socketpair()
+            pid = os.fork()
+            if pid == 0:
+                owner_end.close()
+                for channel in self.channels.values():
+                    channel.socket.close()
+                worker_main(worker_end)  # does not return
+            worker_end.close()
+            owner_end.setblocking(0)
+            channel = message_channel(owner_end, 'worker %d' % pid)
+            self.channels[channel.fileno()] = channel
+            log.info('Started worker %d', pid)
+
+    def attach(self, owner_poller):
+        self.poller = owner_poller
+        for fileno in self.channels:
+            self.poller.add(self, fileno)
+
+    def broadcast(self, message, payload=''):
+        for channel in list(self.channels.values()):
+            self.send(channel, message, payload)
+
+    def send(self, channel, message, payload=''):
+        try:
+            done = channel.send_message(message, payload)
+        except socket.error as e:
+            log.warning('Lost %s: %s', channel.address, e)
+            self.remove(channel)
+            return
+        if not done:
+            self.poller.watch(channel.fileno(), read=True, write=True)
+
+    def remove(self, channel):
+        if self.channels.pop(channel.fileno(), None):
+            self.poller.remove(self, channel.fileno())
+            channel.close()
+
+    def bridge_added(self, hue):
+        self.bridges[hue.name] = hue
+        self.broadcast({'op': 'bridge', 'name': hue.name, 'ip': hue.ip_address, 'port': hue.port})
+
+    def light_changed(self, hue, lightnum):
+        if not self.dirty:
+            self.poller.call_later(0, self.send_lights)
+        self.dirty[(hue.name, lightnum)] = hue
+
+    def send_lights(self):
+        if not self.dirty:
+            return
+        lights = []
+        for (name, lightnum), hue in self.dirty.items():
+            light = hue.lights.get(lightnum)
+            if light is None:
+                lights.append((name, lightnum, None, None))  # removed
+            else:
+                lights.append((name, lightnum, light.name, light.state()))
+        self.dirty = {}
+        self.broadcast({'op': 'lights', 'lights': lights})
+
+    def groups_changed(self, hue):
+        self.send_lights()  # the groups may refer to new lights
+        self.broadcast({'op': 'groups', 'bridge': hue.name, 'groups': hue.groups, 'scenes': hue.scenes})
+
+    def do_read(self, fileno):
+        channel = self.channels[fileno]
+        messages = channel.receive()
+        if messages is None:
+            log.warning('%s has gone', channel.address)
+            self.remove(channel)
+            return
+        for message, payload in messages:
+            if message['op'] == 'request':
+                self.handle_request(channel, message, payload)
+
+    def do_write(self, fileno):
+        channel = self.channels.get(fileno)
+        try:
+            if channel and channel.flush():
+                self.poller.watch(fileno)
+        except socket.error as e:
+            log.warning('Lost %s: %s', channel.address, e)
+            self.remove(channel)
+
+    def handle_request(self, channel, message, payload):
+        hue = self.bridges[message['bridge']]
+        request = http_request(str(message['method']), str(message['path']), str(message['version']),
+                               dict((str(name), str(value)) for name, value in message['headers'].items()),
+                               payload)
+        connection = forwarded_connection(tuple(message['address']), request.keep_alive)
+        started = time.time()
+        try:
+            hue.handle_request(request, connection.address, connection)
+        except Exception:
+            # answer the worker, which closes the client's connection
+            log.error('%s %s from %r failed', request.method, request.path, connection.address, exc_info=True)
+            connection.keep_alive = False
+            connection.output = []
+            hue.send_error(connection, '500 Internal Server Error')
+        METRICS.requests[request.route].observe(time.time() - started)
+        self.send_lights()  # ahead of the response, so the client reads its own writes
+        self.send(channel, {'op': 'response', 'id': message['id'], 'close': not connection.keep_alive},
+                  ''.join(connection.output))
+
+
+class fauxhue_replica(fauxhue):
+    """A worker's copy of one of the owner's fauxhue bridges"""
+    def __init__(self, name, listener, poller, ip_address, port, owner):
+        fauxhue.__init__(self, name, listener, poller, ip_address, port)
+        self.owner = owner
+
+    def handle_request(self, request, sender, connection):
+        if request.method == 'GET' and not request.path.startswith('/metrics'):
+            fauxhue.handle_request(self, request, sender, connection)
+        else:
+            request.route = 'forwarded'
+            self.owner.forward(self, request, connection)
+
+
+class worker(object):
+    """A worker process' side of worker mode"""
+    def __init__(self, sock, worker_poller):
+        self.poller = worker_poller
+        self.channel = message_channel(sock, 'owner')
+        self.listener = upnp_broadcast_responder(self.poller)  # never listens, the owner answers SSDP
+        self.bridges = {}  # name -> fauxhue_replica
+        self.waiting = {}  # request id -> (fauxhue_replica, connection)
+        self.seq = 0
+        self.poller.add(self, self.channel.fileno())
+
+    def forward(self, hue, request, connection):
+        # the connection serves nothing else until the response is back
+        self.seq += 1
+        self.waiting[self.seq] = (hue, connection)
+        connection.paused = True
+        self.send({'op': 'request', 'id': self.seq, 'bridge': hue.name, 'method': request.method,
+                   'path': request.path, 'version': request.version, 'headers': request.headers,
+                   'address': connection.address}, request.body)
+
+    def send(self, message, payload=''):
+        if not self.channel.send_message(message, payload):
+            self.poller.watch(self.channel.fileno(), read=True, write=True)
+
+    def do_write(self, fileno):
+        if self.channel.flush():
+            self.poller.watch(fileno)
+
+    def do_read(self, fileno):
+        messages = self.channel.receive()
+        if messages is None:
+            log.info('Owner has gone, worker %d exiting', os.getpid())
+            os._exit(0)
+        for message, payload in messages:
+            getattr(self, 'on_' + message['op'])(message, payload)
+
+    def on_bridge(self, message, payload):
+        name = message['name']
+        self.bridges[name] = fauxhue_replica(name, self.listener, self.poller, str(message['ip']),
+                                             message['port'], self)
+
+    def on_lights(self, message, payload):
+        for bridge, lightnum, name, state in message['lights']:
+            hue = self.bridges[bridge]
+            if name is None:
+                hue.remove_bulb(lightnum)
+                continue
+            light = hue.lights.get(lightnum)
+            if light is None:
+                hue.lights[lightnum] = hue_light(name)
+                hue.light_changed(lightnum)
+            elif light.name != name:
+                light.name = name
+                hue.light_changed(lightnum)
+            hue.update_state(lightnum, state)
+
+    def on_groups(self, message, payload):
+        hue = self.bridges[message['bridge']]
+        hue.groups = message['groups']
+        hue.scenes = message['scenes']
+
+    def on_response(self, message, payload):
+        hue, connection = self.waiting.pop(message['id'])
+        # the client may have gone, and its fd been reused by another
+        if hue.connections.get(connection.fileno()) is connection:
+            if message.get('close'):
+                connection.keep_alive = False
+            hue.resume(connection, payload)
+
+
+def worker_main(sock):
+    # runs in a forked worker process, never returns
+    sock.setblocking(0)
+    worker_poller = poller()
+    worker(sock, worker_poller)
+    try:
+        while True:
+            worker_poller.poll(None)
+    except KeyboardInterrupt:
+        pass
+    os._exit(0)
+
+
+# fauxmo - like hack - static config, used when there is no device config
+FAKE_SWITCHES = (
     #(name, ),
     ('fake switch 1', 'fake switch 1', ),
 )
-if not hue:
-    hue = fauxhue("Fauxhue", u, p, None, 0)
-for fake_switch in fake_switches:
-    print('processing fake_switch %r', (fake_switch,))
-    switch_id, switch_name = fake_switch
-    #hue.add_bulb(switch_name, state=bool(switch_state), brightness=switch_dim, private=switch_data, action_handler=DebugPrintAPIhandler())
-    hue.add_bulb(switch_name, action_handler=DebugPrintAPIhandler())
-
-dbg("Entering main loop\n")
-
-while True:
-    # Allow time for a ctrl-c to stop the process
-    p.poll(100)
-    time.sleep(0.1)
+
+
+# The device config (--devices), a JSON file like
+#
+#   {
+#    "switches": [{"id": "porch", "name": "Porch light"}, {"name": "Fan"}],
+#    "names": {"lifx:d073d5000001": "Kitchen", "wemo:WeMo Link 1:Lamp 1": "Hall"}
+#   }
+#
+# "switches" are served as lights that only log what they are told
+# (DebugPrintAPIhandler), the id (default: the name) keeps their light
+# number. "names" serves discovered lights under another name, by device
+# id: the registry key joined with ":" (lifx:<mac>, wemo:<bridge>:<light>,
+# switch:<id>). Without the file FAKE_SWITCHES are served.
+#
+# The file is read again on SIGHUP, or when its modification time
+# changes (checked every CHECK_INTERVAL seconds), and only the
+# difference is applied: switches are added, removed or renamed, and
+# lights renamed, through the registry. Only the changed lights' cached
+# JSON is dropped (and their bridge's light list) and only their
+# bridges are announced again over SSDP. A file that cannot be read or
+# parsed is logged and the running config kept.
+
+DEVICE_CONFIG = os.path.join(os.path.expanduser('~'), '.ulfire_devices.json')
+
+
+def device_key(device_id):
+    # "wemo:<bridge>:<light>" -> ('wemo', bridge, light), "lifx:<mac>" -> ('lifx', mac)
+    backend, _sep, rest = device_id.partition(':')
+    if backend == 'wemo':
+        return tuple([backend] + rest.split(':', 1))
+    return (backend, rest)
+
+
+class device_config(object):
+    CHECK_INTERVAL = 2.0
+
+    def __init__(self, filename, hues, poller):
+        self.filename = filename
+        self.hues = hues
+        self.poller = poller
+        self.mtime = None
+        self.reload_requested = False
+
+    def read(self):
+        """(switches {key: name}, names {key: name}) from the file, None
+        if it is broken
+        """
+        if not self.filename or not os.path.exists(self.filename):
+            return dict((('switch', switch_id), name) for switch_id, name in FAKE_SWITCHES), {}
+        try:
+            self.mtime = os.stat(self.filename).st_mtime
+            with open(self.filename) as f:
+                config = json.load(f)
+            switches = {}
+            for entry in config.get('switches', []):
+                switches[('switch', entry.get('id', entry['name']))] = entry['name']
+            names = dict((device_key(device_id), name) for device_id, name in config.get('names', {}).items())
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+            log.warning('Device config %s not loaded: %r', self.filename, e)
+            return None
+        return switches, names
+
+    def load(self):
+        """Apply the config, returns the fauxhues whose lights changed,
+        None if the config could not be read
+        """
+        config = self.read()
+        if config is None:
+            return None
+        switches, names = config
+        registry = self.hues.registry
+        changed = set()
+        for key in registry.backend('switch') - set(switches):
+            changed.add(self.hues.remove_bulb(key))
+        self.hues.names = names
+        for key, name in switches.items():
+            if key not in registry:
+                hue, _lightnum = self.hues.add_bulb(name, key=key, action_handler=DebugPrintAPIhandler())
+                changed.add(hue)
+            else:
+                changed.add(self.hues.rename_bulb(key, name))
+        for key in registry:
+            changed.add(self.hues.rename_bulb(key))
+        changed.discard(None)
+        return changed
+
+    def reload(self):
+        started = time.time()
+        changed = self.load()
+        if changed is None:
+            return
+        for hue in changed:
+            hue.listener.announce(hue)
+        log.info('Reloaded %s in %.1fms, %d bridge(s) changed', self.filename, (time.time() - started) * 1000,
+                 len(changed))
+
+    def request_reload(self, signum=None, frame=None):
+        # signal handler, the reload runs from the poll loop
+        self.reload_requested = True
+
+    def start(self):
+        self.poller.call_later(self.CHECK_INTERVAL, self.check)
+
+    def check(self):
+        if self.filename:
+            try:
+                mtime = os.stat(self.filename).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != self.mtime:
+                self.mtime = mtime
+                self.reload_requested = True
+        if self.reload_requested:
+            self.reload_requested = False
+            self.reload()
+        self.start()
+
+
+class server(object):
+    """Everything ulfire runs, on a single poller: the SSDP responder,
+    the fauxhue bridges, the backend workers, discovery and state sync.
+    load_backends() first, then start() and poll() (or serve_forever()).
+    replicas is the worker_pool in worker mode, journal_filename None
+    runs without a state journal, devices_filename None serves
+    FAKE_SWITCHES.
+    """
+    def __init__(self, ip_address=None, cache_filename=DISCOVERY_CACHE, max_lights=None, replicas=None,
+                 journal_filename=STATE_JOURNAL, devices_filename=DEVICE_CONFIG):
+        # Set up our singleton for polling the sockets for data ready
+        self.poller = poller()
+        if replicas:
+            replicas.attach(self.poller)
+
+        # Set up our singleton listener for UPnP broadcasts
+        self.listener = upnp_broadcast_responder(self.poller)
+
+        # Worker pool for the (blocking) calls to the bulbs
+        self.dispatcher = command_dispatcher(self.poller)
+        self.listener.init_socket()
+
+        # Add the UPnP broadcast listener to the poller so we can respond
+        # when a broadcast is received.
+        self.poller.add(self.listener)
+
+        # Light numbers and state from the previous run
+        self.journal = None
+        if journal_filename:
+            self.journal = state_journal(journal_filename, self.poller, self.dispatcher)
+
+        # All the lights, spread over as many fauxhue bridges as needed
+        self.hues = fauxhue_shards("Fauxhue", self.listener, self.poller, ip_address,
+                                   dispatcher=self.dispatcher, max_lights=max_lights, replicas=replicas,
+                                   journal=self.journal, transitions=transition_scheduler(self.poller, self.dispatcher))
+
+        # The switches and renames from the device config
+        self.devices = device_config(devices_filename, self.hues, self.poller)
+        self.devices.load()
+
+        self.events = wemo_events(self.dispatcher)
+        if not self.events.connect():
+            self.events = None  # no ouimeaux, WeMo lights (if any) are polled
+        self.discoverer = discovery(self.hues, self.dispatcher, cache_filename, events=self.events)
+
+        # Pick up changes made with the vendor apps or wall switches
+        self.syncer = state_sync(self.hues, self.dispatcher, self.poller)
+
+    def start(self):
+        # Serve the lights found last time straight away, LIFX and WeMo
+        # discovery run concurrently in the background
+        self.discoverer.register_cached()
+        self.discoverer.start()
+        self.syncer.start()
+        self.devices.start()
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.devices.request_reload)
+
+    def poll(self, timeout=None):
+        self.poller.poll(timeout)
+
+    def serve_forever(self):
+        log.info('Entering main loop')
+        while True:
+            self.poller.poll(None)
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+        with wemo_clients_lock:
+            for client in wemo_clients.values():
+                client.pool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Philips Hue bridge emulation for LIFX and WeMo lights')
+    parser.add_argument('-d', '--debug', action='store_true', help='log debug messages, same as --log-level debug')
+    parser.add_argument('--log-level', default='info', choices=('debug', 'info', 'warning', 'error'),
+                        help='(default: %(default)s)')
+    parser.add_argument('--trace-sample', type=float, default=0.0, metavar='RATE',
+                        help='fraction of the Hue API requests to log trace spans for, 0 to 1 (default: none)')
+    parser.add_argument('--profile-dir', default=PROFILER.directory,
+                        help='where SIGUSR2 and /debug/profile write profiles (default: %(default)s)')
+    parser.add_argument('--profile-endpoint', action='store_true',
+                        help='serve GET /debug/profile/<seconds> on the Hue API')
+    parser.add_argument('--ip', help='address to serve the bridges on (default: the LAN address)')
+    parser.add_argument('--cache', default=DISCOVERY_CACHE,
+                        help='discovery cache file (default: %(default)s)')
+    parser.add_argument('--journal', default=STATE_JOURNAL,
+                        help='light numbers and state journal, "" for none (default: %(default)s)')
+    parser.add_argument('--devices', default=DEVICE_CONFIG,
+                        help='device config, reloaded on SIGHUP or when it changes (default: %(default)s)')
+    parser.add_argument('--max-lights', type=int, default=fauxhue_shards.MAX_LIGHTS,
+                        help='lights per emulated bridge (default: %(default)s)')
+    parser.add_argument('--no-lifx', dest='lifx', action='store_false', help='disable LIFX')
+    parser.add_argument('--no-wemo', dest='wemo', action='store_false', help='disable WeMo')
+    parser.add_argument('--simulate', action='store_true',
+                        help='use the simulated devices (see fake_devices.py) even if the real modules are installed')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='extra processes serving the Hue API (SO_REUSEPORT, Linux 3.9+)')
+    parser.add_argument('--backlog', type=int, default=upnp_device.BACKLOG,
+                        help='listen() backlog of the Hue API sockets (default: %(default)s)')
+    options = parser.parse_args(argv)
+    logging.basicConfig(format=LOG_FORMAT, level=options.debug and logging.DEBUG or options.log_level.upper())
+    TRACER.sample_rate = options.trace_sample
+    if options.trace_sample:
+        TRACER.log.setLevel(logging.INFO)  # wanted, whatever the --log-level
+    PROFILER.directory = options.profile_dir
+    PROFILER.endpoint = options.profile_endpoint
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, PROFILER.toggle)  # before forking, the workers take it too
+    upnp_device.BACKLOG = options.backlog
+
+    replicas = None
+    if options.workers > 0:
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)  # for the workers, the owner reloads the devices
+        # fork before any backend module or thread is started
+        replicas = worker_pool(options.workers)
+    load_backends(lifx=options.lifx, wemo=options.wemo, simulate=options.simulate)
+    ulfire = server(options.ip, options.cache, options.max_lights, replicas, options.journal, options.devices)
+    ulfire.start()
+    try:
+        ulfire.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    ulfire.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())